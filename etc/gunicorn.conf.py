@@ -0,0 +1,9 @@
+# Build log streams hold their request open while a build runs, so
+# requests are served by gevent workers instead of sync ones
+worker_class = 'gevent'
+
+
+def post_fork(server, worker):
+    # Let other requests run while one waits on postgres
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+"""
+Time Specter requests against a local fake agent, with and without a
+persistent connection pool.
+
+    python scripts/bench_specter.py [requests] [concurrency]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from twisted.internet import defer, task
+
+from sideloader import specter
+from sideloader.tests.fake_specter import FakeSpecter
+
+
+@defer.inlineCallbacks
+def run(fake, pool, requests, concurrency):
+    sc = specter.SpecterClient('127.0.0.1', 'auth', 'key', port=fake.port,
+        pool=pool, ssl=False)
+    sem = defer.DeferredSemaphore(concurrency)
+
+    fake.connections = 0
+    start = time.time()
+    yield defer.gatherResults([
+        sem.run(sc.get_all_stop) for i in range(requests)])
+    elapsed = time.time() - start
+
+    print "%-10s %d requests in %.3fs (%.0f req/s), %d connections" % (
+        pool and 'pooled' or 'unpooled', requests, elapsed,
+        requests / elapsed, fake.connections)
+
+
+@defer.inlineCallbacks
+def main(reactor, requests=1000, concurrency=4):
+    requests, concurrency = int(requests), int(concurrency)
+
+    fake = FakeSpecter()
+    yield fake.start()
+
+    yield run(fake, None, requests, concurrency)
+
+    pool = specter.createPool(maxPerHost=concurrency)
+    yield run(fake, pool, requests, concurrency)
+    yield pool.closeCachedConnections()
+
+    yield fake.stop()
+
+
+if __name__ == '__main__':
+    task.react(main, sys.argv[1:])
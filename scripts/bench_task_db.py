@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""
+Time task database queries from concurrent builds on each backend.
+
+Every simulated build bumps and reads back its own build number in a loop,
+which is as small as a task_db round trip gets. Rows are cleaned up
+afterwards.
+
+    python scripts/bench_task_db.py [builds] [queries] [pool size]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'skeleton.settings')
+
+from twisted.internet import defer, task
+
+from sideloader import task_db
+
+
+def percentile(times, p):
+    return times[min(len(times) - 1, int(len(times) * p))]
+
+
+@defer.inlineCallbacks
+def build(db, name, queries, times):
+    yield db.setBuildNumber(name, 0, create=True)
+    for i in range(queries):
+        start = time.time()
+        yield db.setBuildNumber(name, i)
+        yield db.getBuildNumber(name)
+        times.append((time.time() - start) / 2)
+
+
+@defer.inlineCallbacks
+def run(backend, builds, queries, size):
+    db = task_db.getDB({
+        'backend': backend, 'pool_min': size, 'pool_max': size})
+    # Connect before the clock starts
+    yield defer.gatherResults([
+        db.p.runQuery('SELECT 1') for i in range(size)])
+    names = ['bench-%s-%d' % (backend, i) for i in range(builds)]
+
+    times = []
+    start = time.time()
+    yield defer.gatherResults([
+        build(db, name, queries, times) for name in names])
+    elapsed = time.time() - start
+
+    yield db.p.runOperation(
+        'DELETE FROM sideloader_buildnumbers WHERE package = ANY(%s)',
+        (names,))
+    stats = db.stats()
+    db.p.close()
+
+    times.sort()
+    total = builds * queries * 2
+    print ("%-10s %d queries in %.3fs (%.0f q/s), latency avg %.2fms "
+           "p50 %.2fms p99 %.2fms, max pool wait %.2fms" % (
+        backend, total, elapsed, total / elapsed,
+        sum(times) / len(times) * 1000, percentile(times, 0.5) * 1000,
+        percentile(times, 0.99) * 1000, stats['wait_max'] * 1000))
+
+
+@defer.inlineCallbacks
+def main(reactor, builds=20, queries=100, size=10):
+    builds, queries, size = int(builds), int(queries), int(size)
+
+    yield run('adbapi', builds, queries, size)
+    if task_db.txpostgres is not None:
+        yield run('txpostgres', builds, queries, size)
+    else:
+        print "txpostgres is not installed, skipping it"
+
+
+if __name__ == '__main__':
+    task.react(main, sys.argv[1:])
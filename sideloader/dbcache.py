@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+# Metadata cache for the task database
+
+from twisted.internet import defer, reactor
+
+
+class CachedDB(object):
+    """
+    Keeps rarely changing rows (projects, release flows, release streams
+    and servers) from a SideloaderDB for `ttl` seconds, or until they're
+    invalidated. Everything else goes straight through to the database.
+    """
+    def __init__(self, db, ttl=60, clock=reactor):
+        self.db = db
+        self.ttl = ttl
+        self.clock = clock
+
+        self.rows = {}
+        self.pending = {}
+        self.generation = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+    def invalidate(self, table, id=None):
+        """ Forget a row, or every row in `table` if no id is given """
+        self.generation += 1
+        for key in self.rows.keys():
+            if key[0] == table and (id is None or key[1] == id):
+                del self.rows[key]
+
+    def clear(self):
+        self.generation += 1
+        self.rows.clear()
+
+    def stats(self):
+        """ Database pool counters, along with our hit and miss counts """
+        stats = dict(self.db.stats())
+        stats.update({
+            'cache_hits': self.hits,
+            'cache_misses': self.misses,
+            'cache_rows': len(self.rows),
+        })
+        return stats
+
+    def _store(self, row, key, generation):
+        # Rows which were invalidated while we fetched them are stale
+        if self.ttl and row is not None and generation == self.generation:
+            self.rows[key] = (self.clock.seconds() + self.ttl, row)
+
+        for d in self.pending.pop(key):
+            d.callback(row)
+        return row
+
+    def _fail(self, err, key):
+        for d in self.pending.pop(key):
+            d.errback(err)
+        return err
+
+    def cached(self, key, fetch, *args):
+        """
+        Returns the row for `key`, which is a (table, id, query) tuple,
+        calling fetch(*args) for it if we don't have it. Concurrent
+        misses share one fetch.
+        """
+        if key in self.rows:
+            expires, row = self.rows[key]
+            if expires > self.clock.seconds():
+                self.hits += 1
+                return defer.succeed(row)
+            del self.rows[key]
+
+        self.misses += 1
+
+        d = defer.Deferred()
+        if key in self.pending:
+            self.pending[key].append(d)
+            return d
+
+        self.pending[key] = [d]
+        f = defer.maybeDeferred(fetch, *args)
+        f.addCallback(self._store, key, self.generation)
+        f.addErrback(self._fail, key)
+        f.addErrback(lambda _: None)
+        return d
+
+    def getProject(self, id):
+        return self.cached(('sideloader_project', id, 'row'),
+            self.db.getProject, id)
+
+    def getProjectNotificationSettings(self, id):
+        return self.cached(('sideloader_project', id, 'notifications'),
+            self.db.getProjectNotificationSettings, id)
+
+    def getFlow(self, id):
+        return self.cached(('sideloader_releaseflow', id, 'row'),
+            self.db.getFlow, id)
+
+    def getReleaseStream(self, id):
+        return self.cached(('sideloader_releasestream', id, 'row'),
+            self.db.getReleaseStream, id)
+
+    def getServer(self, id):
+        return self.cached(('sideloader_server', id, 'row'),
+            self.db.getServer, id)
+
+    def updateServerStatus(self, id, status):
+        d = self.db.updateServerStatus(id, status)
+        d.addBoth(self._invalidated, 'sideloader_server', id)
+        return d
+
+    def _invalidated(self, result, table, id):
+        self.invalidate(table, id)
+        return result
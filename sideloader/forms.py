@@ -147,16 +147,52 @@ class FlowForm(BaseModelForm):
         required=False,
         initial=True)
 
+    max_parallel_targets = forms.IntegerField(
+        label='Parallel deployments',
+        min_value=1,
+        required=False,
+        initial=1,
+        help_text="Number of servers to deploy to at the same time")
+
+    rollout_batch = forms.IntegerField(
+        label='Rollout wave size',
+        min_value=0,
+        required=False,
+        initial=0,
+        help_text="Deploy to this many servers at a time, waiting for each wave to succeed. 0 deploys to all servers at once")
+
+    rollout_batch_percent = forms.BooleanField(
+        label='Wave size is a percentage',
+        help_text="Treat the wave size as a percentage of servers",
+        required=False)
+
+    rollout_max_failures = forms.IntegerField(
+        label='Tolerated failures',
+        min_value=0,
+        required=False,
+        initial=0,
+        help_text="Abort the rollout once more than this many servers fail")
+
     class Meta:
         exclude = ('project',)
         model = models.ReleaseFlow
         fields = (
             'name', 'stream_mode', 'stream', 'targets',
-            'service_restart', 'service_pre_stop', 'puppet_run',
-            'require_signoff', 'signoff_list', 'quorum', 'notify', 
-            'notify_list', 'auto_release'
+            'max_parallel_targets', 'rollout_batch', 'rollout_batch_percent',
+            'rollout_max_failures', 'service_restart', 'service_pre_stop',
+            'puppet_run', 'require_signoff', 'signoff_list', 'quorum',
+            'notify', 'notify_list', 'auto_release'
         )
 
+    def clean_max_parallel_targets(self):
+        return self.cleaned_data['max_parallel_targets'] or 1
+
+    def clean_rollout_batch(self):
+        return self.cleaned_data['rollout_batch'] or 0
+
+    def clean_rollout_max_failures(self):
+        return self.cleaned_data['rollout_max_failures'] or 0
+
 class ProjectForm(BaseModelForm):
     github_url = forms.CharField(label="Git checkout URL")
 
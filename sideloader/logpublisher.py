@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+# Live build log publishing from the Twisted worker, and the invalidations
+# it hears from the web tier
+
+import json
+import urlparse
+
+from twisted.internet import reactor, defer, protocol
+from twisted.python import log
+
+from txredis.client import RedisClient, RedisSubscriber
+
+from sideloader import logstream
+
+
+def redisAddress(url):
+    """ The host, port and database number of a redis:// URL """
+    url = urlparse.urlparse(url)
+    return (url.hostname or 'localhost', url.port or 6379,
+            int(url.path.strip('/') or 0))
+
+
+class RedisPublisher(object):
+    """
+    Publishes messages to redis from the Twisted worker, connecting on
+    first use
+    """
+    def __init__(self, url):
+        self.host, self.port, self.db = redisAddress(url)
+
+        self.client = None
+
+    @defer.inlineCallbacks
+    def publish(self, channel, message):
+        if self.client is None:
+            clientCreator = protocol.ClientCreator(
+                reactor, RedisClient, db=self.db)
+            self.client = clientCreator.connectTCP(self.host, self.port)
+
+        try:
+            client = yield self.client
+        except Exception:
+            # Try again on the next message
+            self.client = None
+            raise
+
+        # Later publishers can use the connection directly
+        self.client = defer.succeed(client)
+
+        r = yield client.publish(channel, message)
+        defer.returnValue(r)
+
+
+class BuildLogPublisher(object):
+    """
+    Publishes the output and final state of builds to a broker. Delivery
+    is best-effort, the database stays the authoritative copy of the log.
+    """
+    def __init__(self, broker):
+        self.broker = broker
+
+    def _publish(self, build_id, message):
+        d = defer.maybeDeferred(self.broker.publish,
+            logstream.channel(build_id), message)
+        d.addErrback(log.err, 'Could not publish log for build %s' % build_id)
+        return d
+
+    def publishLog(self, build_id, offset, data):
+        return self._publish(build_id, logstream.logMessage(offset, data))
+
+    def publishState(self, build_id, state):
+        return self._publish(build_id, logstream.stateMessage(state))
+
+
+class ListenerProtocol(RedisSubscriber):
+    def connectionMade(self):
+        RedisSubscriber.connectionMade(self)
+        self.factory.resetDelay()
+        self.subscribe(self.factory.channel)
+
+    def channelSubscribed(self, channel, numSubscriptions):
+        self.factory.subscribed()
+
+    def messageReceived(self, channel, message):
+        self.factory.received(message)
+
+
+class RedisListener(protocol.ReconnectingClientFactory):
+    """
+    Calls callback with each message published to a redis channel, and
+    subscribes again whenever the connection drops. Messages published
+    while it was down are lost, so onSubscribe is called every time it
+    subscribes.
+    """
+    protocol = ListenerProtocol
+    noisy = False
+
+    def __init__(self, channel, callback, onSubscribe=None):
+        self.channel = channel
+        self.callback = callback
+        self.onSubscribe = onSubscribe
+
+    def subscribed(self):
+        if self.onSubscribe:
+            self.onSubscribe()
+
+    def received(self, message):
+        try:
+            self.callback(json.loads(message))
+        except Exception:
+            log.err(None, 'Could not handle message on %s' % self.channel)
+
+    def close(self):
+        self.stopTrying()
+        if self.connector:
+            self.connector.disconnect()
+
+
+def getPublisher(url):
+    """ Broker to publish to from the worker, for a log_stream URL """
+    if url.startswith('local:'):
+        return BuildLogPublisher(logstream.localBroker)
+    return BuildLogPublisher(RedisPublisher(url))
+
+
+def listen(url, channel, callback, onSubscribe=None):
+    """
+    Listens to a channel on the broker for a log_stream URL, calling
+    callback with each message
+    """
+    if url.startswith('local:'):
+        return logstream.localBroker.listen(channel, callback)
+
+    # Channels aren't tied to a database
+    host, port = redisAddress(url)[:2]
+    listener = RedisListener(channel, callback, onSubscribe)
+    listener.connector = reactor.connectTCP(host, port, listener)
+    return listener
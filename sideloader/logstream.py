@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+# Live build log pub/sub, the web tier side. The worker publishes with
+# sideloader.logpublisher. Worker cache invalidations go the other way,
+# over the same server.
+
+import json
+import Queue
+
+import redis
+
+
+def channel(build_id):
+    return 'sideloader.buildlog.%s' % build_id
+
+
+# Every worker listens here for rows to drop from its metadata cache
+INVALIDATE_CHANNEL = 'sideloader.invalidate'
+
+
+def utf8Boundary(data):
+    """
+    The length of data without a UTF-8 character cut off at its end
+    """
+    for i in range(1, min(len(data), 4) + 1):
+        c = ord(data[-i])
+        if c & 0xc0 == 0x80:
+            # Continuation byte, the character started further back
+            continue
+        if c & 0xe0 == 0xc0:
+            size = 2
+        elif c & 0xf0 == 0xe0:
+            size = 3
+        elif c & 0xf8 == 0xf0:
+            size = 4
+        else:
+            size = 1
+        return len(data) - i if i < size else len(data)
+
+    return len(data)
+
+
+def logMessage(offset, data):
+    """ Message for a chunk of log which starts at byte offset """
+    return json.dumps({
+        'offset': offset,
+        'end': offset + len(data),
+        'log': data.decode('utf-8', 'replace')
+    })
+
+
+def stateMessage(state):
+    """ Message for the final state of a build """
+    return json.dumps({'state': state})
+
+
+class LocalBroker(object):
+    """
+    In-process stand-in for a pub/sub server, used where the worker and
+    the web tier share a process (ie. in tests)
+    """
+    def __init__(self):
+        self.subscriptions = {}
+
+    def publish(self, channel, message):
+        subs = self.subscriptions.get(channel, [])
+        for sub in list(subs):
+            sub.deliver(message)
+
+        return len(subs)
+
+    def subscribe(self, channel):
+        sub = LocalSubscription(self, channel)
+        self.subscriptions.setdefault(channel, []).append(sub)
+        return sub
+
+    def listen(self, channel, callback):
+        """ Call callback with each message as it's published """
+        sub = LocalListener(self, channel, callback)
+        self.subscriptions.setdefault(channel, []).append(sub)
+        return sub
+
+
+class LocalSubscription(object):
+    def __init__(self, broker, channel):
+        self.broker = broker
+        self.channel = channel
+        self.queue = Queue.Queue()
+
+    def deliver(self, message):
+        self.queue.put(message)
+
+    def get(self, timeout=None):
+        """ Wait for the next message, returns None on timeout """
+        try:
+            return json.loads(self.queue.get(timeout=timeout))
+        except Queue.Empty:
+            return None
+
+    def close(self):
+        self.broker.subscriptions[self.channel].remove(self)
+
+
+class LocalListener(object):
+    def __init__(self, broker, channel, callback):
+        self.broker = broker
+        self.channel = channel
+        self.callback = callback
+
+    def deliver(self, message):
+        self.callback(json.loads(message))
+
+    def close(self):
+        self.broker.subscriptions[self.channel].remove(self)
+
+
+class RedisBroker(object):
+    """
+    Blocking redis client for the web tier
+    """
+    def __init__(self, url):
+        self.redis = redis.StrictRedis.from_url(url)
+
+    def publish(self, channel, message):
+        return self.redis.publish(channel, message)
+
+    def subscribe(self, channel):
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(channel)
+        return RedisSubscription(pubsub)
+
+
+class RedisSubscription(object):
+    def __init__(self, pubsub):
+        self.pubsub = pubsub
+
+    def get(self, timeout=None):
+        """ Wait for the next message, returns None on timeout """
+        msg = self.pubsub.get_message(timeout=timeout)
+        if msg and msg['type'] == 'message':
+            return json.loads(msg['data'])
+        return None
+
+    def close(self):
+        self.pubsub.close()
+
+
+# Shared by everything in this process which is configured with local://
+localBroker = LocalBroker()
+
+
+def getBroker(url):
+    """ Broker for the web tier, for a log_stream URL """
+    if url.startswith('local:'):
+        return localBroker
+    return RedisBroker(url)
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+# Outbound mail queue
+
+from StringIO import StringIO
+
+from email.MIMEText import MIMEText
+from email.MIMEMultipart import MIMEMultipart
+
+from twisted.internet import defer, reactor, protocol
+from twisted.mail import smtp
+from twisted.python import log
+
+
+class Message(object):
+    """
+    An HTML email, and everyone it's going to. Each recipient has their
+    own Deferred which fires once the message is delivered to them.
+    """
+    def __init__(self, fromAddr, subject, html, attempts=0):
+        self.fromAddr = fromAddr
+        self.subject = subject
+        self.html = html
+        self.attempts = attempts
+
+        self.recipients = []
+        self.waiters = {}
+
+    def addRecipient(self, to, d):
+        if to not in self.waiters:
+            self.recipients.append(to)
+            self.waiters[to] = []
+        self.waiters[to].append(d)
+
+    def data(self):
+        msg = MIMEMultipart('related')
+        msg['Subject'] = self.subject
+        msg['From'] = self.fromAddr
+        if len(self.recipients) == 1:
+            msg['To'] = self.recipients[0]
+        else:
+            # Everyone in a batch is only on the envelope, so they don't
+            # see who else it went to
+            msg['To'] = 'undisclosed-recipients:;'
+        msg.attach(MIMEText(self.html, 'html'))
+        return msg.as_string()
+
+    def envelopeFrom(self):
+        return self.fromAddr.split('<')[-1].strip('>')
+
+    def delivered(self, to):
+        for d in self.waiters.pop(to):
+            d.callback(to)
+
+    def failed(self, to, err):
+        for d in self.waiters.pop(to):
+            d.errback(err)
+
+
+class MailerProtocol(smtp.SMTPClient):
+    """
+    Sends queued messages one after the other over a single SMTP session,
+    and says goodbye once the queue is empty.
+    """
+    debug = False
+    timeout = 60
+
+    def __init__(self, mailer, identity):
+        smtp.SMTPClient.__init__(self, identity)
+        self.mailer = mailer
+        self.current = None
+        self.error = None
+
+    def getMailFrom(self):
+        self.current = self.mailer.nextMessage()
+        if self.current is None:
+            return None
+        return self.current.envelopeFrom()
+
+    def getMailTo(self):
+        return self.current.recipients
+
+    def getMailData(self):
+        return StringIO(self.current.data())
+
+    def sentMail(self, code, resp, numOk, addresses, log):
+        msg, self.current = self.current, None
+        self.mailer.sent(msg, code, resp, addresses)
+
+    def sendError(self, exc):
+        self.error = exc
+        msg, self.current = self.current, None
+        if msg is not None:
+            self.mailer.retry(msg, msg.recipients, exc)
+        smtp.SMTPClient.sendError(self, exc)
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        smtp.SMTPClient.connectionLost(self, reason)
+        msg, self.current = self.current, None
+        if msg is not None:
+            self.error = reason.value
+            self.mailer.retry(msg, msg.recipients, reason.value)
+        self.mailer.sessionEnded(self.error)
+
+
+class MailQueue(object):
+    """
+    Queues outgoing mail and delivers it over as few SMTP sessions as
+    possible. Messages with the same sender, subject and body which are
+    queued within `window` seconds of each other are sent once to all
+    their recipients. Transient failures are retried up to `retries`
+    times, with exponential backoff starting at `backoff` seconds.
+    """
+    def __init__(self, host='localhost', port=25, identity='localhost',
+                 window=1.0, maxRecipients=50, retries=3, backoff=30.0,
+                 clock=reactor):
+        self.host = host
+        self.port = port
+        self.identity = identity
+        self.window = window
+        self.maxRecipients = maxRecipients
+        self.retries = retries
+        self.backoff = backoff
+        self.clock = clock
+
+        self.queue = []
+        self.call = None
+        self.session = None
+        self.retries_pending = set()
+        self.idle = []
+
+        self.sessions = 0
+        self.messages = 0
+
+    def send(self, fromAddr, to, subject, html):
+        """
+        Queues an email, returns a Deferred which fires once it's been
+        delivered to `to`, or has failed for good
+        """
+        d = defer.Deferred()
+        self.getMessage(fromAddr, subject, html).addRecipient(to, d)
+        self.schedule(self.window)
+        return d
+
+    def getMessage(self, fromAddr, subject, html, attempts=0):
+        for msg in self.queue:
+            if ((msg.fromAddr, msg.subject, msg.html, msg.attempts) == (
+                    fromAddr, subject, html, attempts)
+                    and len(msg.recipients) < self.maxRecipients):
+                return msg
+
+        msg = Message(fromAddr, subject, html, attempts)
+        self.queue.append(msg)
+        return msg
+
+    def schedule(self, delay):
+        # A running session picks up whatever is queued when it's ready
+        if self.call is None and self.session is None:
+            self.call = self.clock.callLater(delay, self.flush)
+
+    def flush(self):
+        self.call = None
+        if not self.queue or self.session is not None:
+            return
+
+        self.sessions += 1
+        self.session = protocol.ClientCreator(
+            reactor, MailerProtocol, self, self.identity
+        ).connectTCP(self.host, self.port, timeout=30)
+        self.session.addErrback(self.connectFailed)
+
+    def connectFailed(self, err):
+        self.sessionEnded(err.value)
+
+    def sessionEnded(self, err=None):
+        self.session = None
+        idle, self.idle = self.idle, []
+        for d in idle:
+            d.callback(None)
+
+        if err is not None:
+            # Everything still queued waits until the server's back
+            queue, self.queue = self.queue, []
+            for msg in queue:
+                self.retry(msg, msg.recipients, err)
+        elif self.queue:
+            self.schedule(0)
+
+    def nextMessage(self):
+        if self.queue:
+            self.messages += 1
+            return self.queue.pop(0)
+        return None
+
+    def sent(self, msg, code, resp, addresses):
+        """
+        Sorts out the recipients of a message the server has answered for.
+        Recipients it refused get their own response, the rest share the
+        response to the whole message.
+        """
+        refused = dict((to, (rcptCode, rcptResp))
+            for to, rcptCode, rcptResp in addresses
+            if rcptCode not in smtp.SUCCESS)
+
+        transient = []
+        for to in list(msg.recipients):
+            toCode, toResp = refused.get(to, (code, resp))
+            if toCode in smtp.SUCCESS:
+                msg.delivered(to)
+            elif 400 <= toCode < 500:
+                transient.append(to)
+            else:
+                log.msg('Could not send %r to %s: %s %s' % (
+                    msg.subject, to, toCode, toResp))
+                msg.failed(to, smtp.SMTPDeliveryError(toCode, toResp))
+
+        if transient:
+            self.retry(msg, transient, smtp.SMTPDeliveryError(code, resp))
+
+    def retry(self, msg, recipients, err):
+        """
+        Queues recipients of a message to try again later, or fails them
+        once they've been tried enough
+        """
+        attempts = msg.attempts + 1
+        if attempts > self.retries:
+            log.msg('Giving up on sending %r to %s: %s' % (
+                msg.subject, ', '.join(recipients), err))
+            for to in recipients:
+                msg.failed(to, err)
+            return
+
+        def requeue():
+            self.retries_pending.discard(call)
+            retried = self.getMessage(
+                msg.fromAddr, msg.subject, msg.html, attempts)
+            for to in recipients:
+                for d in msg.waiters.pop(to):
+                    retried.addRecipient(to, d)
+            self.schedule(0)
+
+        call = self.clock.callLater(
+            self.backoff * 2 ** (attempts - 1), requeue)
+        self.retries_pending.add(call)
+
+    def stop(self):
+        """
+        Stops sending anything new, and waits for the current session to
+        finish. Queued mail is dropped.
+        """
+        if self.call is not None:
+            self.call.cancel()
+            self.call = None
+        for call in self.retries_pending:
+            call.cancel()
+        self.retries_pending.clear()
+        self.queue = []
+
+        if self.session is None:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self.idle.append(d)
+        return d
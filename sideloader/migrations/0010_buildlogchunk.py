@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sideloader', '0009_webhook_last_response'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BuildLogChunk',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('seq', models.IntegerField()),
+                ('data', models.TextField(default=b'')),
+                ('build', models.ForeignKey(to='sideloader.Build')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='buildlogchunk',
+            unique_together=set([('build', 'seq')]),
+        ),
+    ]
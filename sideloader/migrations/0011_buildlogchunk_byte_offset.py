@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sideloader', '0010_buildlogchunk'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='buildlogchunk',
+            name='byte_offset',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sideloader', '0011_buildlogchunk_byte_offset'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='releaseflow',
+            name='max_parallel_targets',
+            field=models.IntegerField(default=1),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sideloader', '0012_releaseflow_max_parallel_targets'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='releaseflow',
+            name='rollout_batch',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='releaseflow',
+            name='rollout_batch_percent',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='releaseflow',
+            name='rollout_max_failures',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sideloader', '0013_releaseflow_rollout'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='build',
+            name='build_time',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='project',
+            name='idhash',
+            field=models.CharField(max_length=48, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='releasesignoff',
+            name='idhash',
+            field=models.CharField(max_length=48, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='server',
+            name='name',
+            field=models.CharField(max_length=255, db_index=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='build',
+            index_together=set([('project', 'build_time')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='release',
+            index_together=set([('flow', 'release_date'), ('flow', 'waiting', 'lock')]),
+        ),
+        # Partial indexes for the small sets of waiting releases and queued
+        # builds which the scheduler and dashboard poll
+        migrations.RunSQL(
+            'CREATE INDEX sideloader_release_waiting ON sideloader_release'
+            ' (flow_id, release_date) WHERE waiting',
+            'DROP INDEX sideloader_release_waiting',
+        ),
+        migrations.RunSQL(
+            'CREATE INDEX sideloader_build_queued ON sideloader_build'
+            ' (build_time) WHERE state = 0',
+            'DROP INDEX sideloader_build_queued',
+        ),
+    ]
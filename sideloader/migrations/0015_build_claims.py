@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sideloader', '0014_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='build',
+            name='commit',
+            field=models.CharField(default='', max_length=40, blank=True),
+        ),
+        migrations.AddField(
+            model_name='build',
+            name='worker',
+            field=models.CharField(default='', max_length=255, blank=True),
+        ),
+        migrations.AddField(
+            model_name='build',
+            name='heartbeat',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+        # Only one worker at a time gets to build a project
+        migrations.RunSQL(
+            'CREATE UNIQUE INDEX sideloader_build_running ON sideloader_build'
+            " (project_id) WHERE state = 0 AND worker <> ''",
+            'DROP INDEX sideloader_build_running',
+        ),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sideloader', '0015_build_claims'),
+    ]
+
+    operations = [
+        # A plain ::bytea cast would read backslashes in logs as escapes
+        migrations.RunSQL(
+            'ALTER TABLE sideloader_buildlogchunk ALTER COLUMN data'
+            " TYPE bytea USING convert_to(data, 'UTF8')",
+            'ALTER TABLE sideloader_buildlogchunk ALTER COLUMN data'
+            " TYPE text USING convert_from(data, 'UTF8')",
+            state_operations=[
+                migrations.AlterField(
+                    model_name='buildlogchunk',
+                    name='data',
+                    field=models.BinaryField(default=b''),
+                ),
+            ],
+        ),
+    ]
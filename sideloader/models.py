@@ -1,11 +1,23 @@
+import json
+import logging
+import threading
 import time
-from django.db import models
+from django.conf import settings
+from django.core.signals import request_started, request_finished
+from django.db import models, transaction
+from django.db.models.signals import post_save, post_delete
 from django.contrib.auth.models import User
 from django.utils import timezone
 
+from rhumba.client import RhumbaClient
+
+from sideloader import logstream
+
+logger = logging.getLogger(__name__)
+
 
 class Server(models.Model):
-    name = models.CharField(max_length=255)
+    name = models.CharField(max_length=255, db_index=True)
     last_checkin = models.DateTimeField(auto_now_add=True)
     last_puppet_run = models.DateTimeField(auto_now_add=True)
     status = models.CharField(max_length=255, default='', blank=True)
@@ -49,11 +61,39 @@ class Project(models.Model):
 
     created_by_user = models.ForeignKey(User, related_name="ProjectCreatedBy")
     release_stream = models.ForeignKey(ReleaseStream, null=True)
-    idhash = models.CharField(max_length=48)
+    idhash = models.CharField(max_length=48, db_index=True)
     allowed_users = models.ManyToManyField(User, blank=True)
     notifications = models.BooleanField(default=True)
     slack_channel = models.CharField(max_length=255, default='', blank=True)
 
+    def pending_build(self, commit=''):
+        """
+        Returns the build of this project which is waiting to start,
+        creating it if there isn't one, and whether it was created. Later
+        requests fold into the waiting build, which takes on their commit.
+        """
+        with transaction.atomic():
+            # Requests for the same project queue up behind this lock
+            Project.objects.select_for_update().get(id=self.id)
+            build = self.build_set.filter(
+                state=0, worker='').order_by('-id').first()
+            if build is None:
+                build = Build.objects.create(
+                    project=self, state=0, commit=commit)
+                return build, True
+
+            if commit and build.commit != commit:
+                # A worker can claim the build at any point, and then it's
+                # too late for it to take on the commit
+                updated = Build.objects.filter(
+                    id=build.id, worker='').update(commit=commit)
+                if not updated:
+                    build = Build.objects.create(
+                        project=self, state=0, commit=commit)
+                    return build, True
+                build.commit = commit
+            return build, False
+
 
 class BuildNumbers(models.Model):
     package = models.CharField(max_length=255, unique=True)
@@ -74,6 +114,14 @@ class ReleaseFlow(models.Model):
     service_pre_stop = models.BooleanField(default=False)
     puppet_run = models.BooleanField(default=True)
     auto_release = models.BooleanField(default=False)
+    # Number of targets which are deployed to at the same time
+    max_parallel_targets = models.IntegerField(default=1)
+    # Rolling deployments go out in waves of rollout_batch targets, or
+    # percent of targets, 0 deploys to everything in one wave
+    rollout_batch = models.IntegerField(default=0)
+    rollout_batch_percent = models.BooleanField(default=False)
+    # Failed targets tolerated before the remaining waves are abandoned
+    rollout_max_failures = models.IntegerField(default=0)
 
     def __unicode__(self):
         return self.name
@@ -122,12 +170,72 @@ class WebHook(models.Model):
 
 class Build(models.Model):
     project = models.ForeignKey(Project)
-    build_time = models.DateTimeField(auto_now_add=True)
+    build_time = models.DateTimeField(auto_now_add=True, db_index=True)
     # 0 - queued, 1 - Success, 2 - Failed, 3 - Canceled
     state = models.IntegerField(default=0)
     task_id = models.CharField(max_length=255, default='')
     log = models.TextField(default="")
     build_file = models.CharField(max_length=255)
+    # The newest commit asked for
+    commit = models.CharField(max_length=40, default='', blank=True)
+    # host:pid of the worker which claimed the build, empty until then
+    worker = models.CharField(max_length=255, default='', blank=True)
+    heartbeat = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        index_together = (('project', 'build_time'),)
+
+    def get_log(self):
+        """Returns the full build log, reassembled from its chunks"""
+        chunks = self.buildlogchunk_set.order_by('seq').values_list(
+            'data', flat=True)
+        return self.log + ''.join(map(bytes, chunks)).decode(
+            'utf-8', 'replace')
+
+    def get_log_tail(self, offset):
+        """
+        Returns the log bytes after offset, and the new end offset. A
+        character which is only partly written yet is left for next time.
+        """
+        prefix = self.log.encode('utf-8')
+        chunks = self.buildlogchunk_set.order_by('seq')
+
+        if offset < len(prefix):
+            data = [prefix[offset:]]
+        else:
+            # Only fetch the chunk straddling the offset and those after it
+            data = []
+            pos = offset - len(prefix)
+            first = chunks.filter(byte_offset__lte=pos).order_by('-seq')[:1]
+            if first:
+                chunks = chunks.filter(seq__gte=first[0].seq)
+
+        end = max(offset, len(prefix))
+        for chunk in chunks:
+            chunk_data = bytes(chunk.data)
+            start = chunk.byte_offset + len(prefix)
+            end = start + len(chunk_data)
+            if end > offset:
+                data.append(chunk_data[max(offset - start, 0):])
+
+        data = ''.join(data)
+        complete = logstream.utf8Boundary(data)
+        end = max(end, offset) - (len(data) - complete)
+        return data[:complete], end
+
+
+class BuildLogChunk(models.Model):
+    # Build output is appended here as it arrives rather than rewriting
+    # Build.log, chunks are ordered by seq within a build.
+    build = models.ForeignKey(Build)
+    seq = models.IntegerField()
+    # Position of this chunk in the log, in bytes. Chunks hold the raw
+    # output, which needn't be valid UTF-8 on its own.
+    byte_offset = models.BigIntegerField(default=0)
+    data = models.BinaryField(default=b'')
+
+    class Meta:
+        unique_together = (('build', 'seq'),)
 
 
 class Target(models.Model):
@@ -171,6 +279,10 @@ class Release(models.Model):
     waiting = models.BooleanField(default=True)
     lock = models.BooleanField(default=False)
 
+    class Meta:
+        index_together = (('flow', 'waiting', 'lock'),
+                          ('flow', 'release_date'))
+
     def signoff_count(self):
         return self.releasesignoff_set.filter(signed=True).count()
 
@@ -234,6 +346,76 @@ class Release(models.Model):
 class ReleaseSignoff(models.Model):
     release = models.ForeignKey(Release)
     signature = models.CharField(max_length=255)
-    idhash = models.CharField(max_length=48)
+    idhash = models.CharField(max_length=48, db_index=True)
     signed = models.BooleanField(default=False)
 
+
+# Columns the worker never reads from its cached rows. Servers touch these
+# every time they check in, which shouldn't reach the worker.
+WORKER_IGNORED_FIELDS = {
+    Server: frozenset(['last_checkin', 'last_puppet_run']),
+}
+
+# Invalidations held back until the end of the current request
+_pending_invalidations = threading.local()
+
+
+def queue_invalidation(table, id):
+    """
+    Tells the workers to drop a row from their metadata cache. Every
+    worker hears about it over the log stream's pub/sub server, without
+    one it's queued for whichever worker takes it. Rows expire anyway, so
+    failures here aren't fatal.
+    """
+    message = {'table': table, 'id': id}
+    try:
+        if settings.SIDELOADER_LOG_STREAM:
+            logstream.getBroker(settings.SIDELOADER_LOG_STREAM).publish(
+                logstream.INVALIDATE_CHANNEL, json.dumps(message))
+        else:
+            RhumbaClient().queue('sideloader', 'invalidate', message)
+    except Exception as e:
+        logger.warning("Could not invalidate %s %s in the worker cache: %s",
+            table, id, e)
+
+
+def invalidate_worker_cache(sender, instance, update_fields=None, **kw):
+    """
+    Invalidates a saved or deleted row in the worker cache. During a
+    request this waits until the request is done, so the worker can't
+    fetch the row again before the change is committed, and each row is
+    only sent once.
+    """
+    ignored = WORKER_IGNORED_FIELDS.get(sender)
+    if update_fields and ignored and ignored.issuperset(update_fields):
+        return
+
+    row = (sender._meta.db_table, instance.pk)
+    pending = getattr(_pending_invalidations, 'rows', None)
+    if pending is None:
+        queue_invalidation(*row)
+    elif row not in pending:
+        pending.append(row)
+
+
+def hold_invalidations(**kw):
+    _pending_invalidations.rows = []
+
+
+def send_invalidations(**kw):
+    pending = getattr(_pending_invalidations, 'rows', None) or []
+    _pending_invalidations.rows = None
+    for table, id in pending:
+        queue_invalidation(table, id)
+
+
+request_started.connect(hold_invalidations,
+    dispatch_uid='hold_invalidations')
+request_finished.connect(send_invalidations,
+    dispatch_uid='send_invalidations')
+
+for model in [Project, ReleaseFlow, ReleaseStream, Server]:
+    post_save.connect(invalidate_worker_cache, sender=model,
+        dispatch_uid='invalidate_worker_cache')
+    post_delete.connect(invalidate_worker_cache, sender=model,
+        dispatch_uid='invalidate_worker_cache')
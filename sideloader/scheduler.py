@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# Release scheduler
+
+import heapq
+import time
+
+from twisted.internet import reactor
+
+
+def releaseTime(scheduled):
+    """ Epoch time for a release's scheduled datetime, as checkReleaseSchedule
+    reads it """
+    return time.mktime(scheduled.timetuple())
+
+
+class ReleaseScheduler(object):
+    """
+    Keeps a heap of the times releases fall due at, and calls wake() when
+    the earliest of them is reached. Only one delayed call is armed at a
+    time, and releases falling due together cause a single wake().
+    """
+    def __init__(self, wake, clock=reactor):
+        self.wake = wake
+        self.clock = clock
+
+        self.heap = []
+        self.due = {}
+        self.call = None
+        self.armed = None
+
+    def schedule(self, release_id, when=None):
+        """
+        Wake up at epoch time `when` for a release, or as soon as possible.
+        Rescheduling a release replaces its previous time.
+        """
+        if when is None:
+            when = self.clock.seconds()
+
+        if self.due.get(release_id) == when:
+            return
+
+        self.due[release_id] = when
+        heapq.heappush(self.heap, (when, release_id))
+        self.arm()
+
+    def discard(self, release_id):
+        """ Forget about a release """
+        if self.due.pop(release_id, None) is not None:
+            self.arm()
+
+    def __len__(self):
+        return len(self.due)
+
+    def _current(self, entry):
+        when, release_id = entry
+        return self.due.get(release_id) == when
+
+    def arm(self):
+        # Entries for discarded or rescheduled releases are dropped lazily
+        while self.heap and not self._current(self.heap[0]):
+            heapq.heappop(self.heap)
+
+        if not self.heap:
+            self.disarm()
+            return
+
+        when = self.heap[0][0]
+        if self.call and self.call.active():
+            if self.armed == when:
+                return
+            self.call.cancel()
+
+        self.armed = when
+        self.call = self.clock.callLater(
+            max(0, when - self.clock.seconds()), self.fire)
+
+    def disarm(self):
+        if self.call and self.call.active():
+            self.call.cancel()
+        self.call = None
+        self.armed = None
+
+    def fire(self):
+        self.call = None
+        self.armed = None
+        now = self.clock.seconds()
+
+        released = []
+        while self.heap and self.heap[0][0] <= now:
+            entry = heapq.heappop(self.heap)
+            if self._current(entry):
+                del self.due[entry[1]]
+                released.append(entry[1])
+
+        self.arm()
+
+        if released:
+            self.wake(released)
@@ -4,6 +4,9 @@
 import urllib
 import json
 
+from twisted.internet import reactor
+from twisted.python import log
+
 from rhumba.plugin import HTTPRequest
 
 
@@ -13,14 +16,14 @@ class SlackClient(object):
         self.token = token
         self.channel = channel
 
-    def message(self, text, fields=[]):
+    def message(self, text, fields=[], fallback=None):
         params = urllib.urlencode({
             'payload': json.dumps({
                 'channel': self.channel,
                 'username': 'sideloader',
                 'icon_emoji': ':greenrocket:',
                 'attachments':[{
-                    'fallback': text,
+                    'fallback': fallback or text,
                     'pretext': text,
                     'color': '#0000D0',
                     'fields': fields
@@ -34,3 +37,102 @@ class SlackClient(object):
         return HTTPRequest().getBody(url, method='POST', data=params, headers={
                 'Content-Type': ['application/x-www-form-urlencoded']
             })
+
+
+class TokenBucket(object):
+    """
+    Allows `rate` events a second on average, and bursts of up to `burst`
+    """
+    def __init__(self, rate, burst=1, clock=reactor):
+        self.rate = float(rate)
+        self.burst = burst
+        self.clock = clock
+
+        self.tokens = float(burst)
+        self.last = clock.seconds()
+
+    def refill(self):
+        now = self.clock.seconds()
+        self.tokens = min(self.burst,
+            self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def take(self):
+        """
+        Takes a token and returns 0 if one is available, otherwise returns
+        how many seconds to wait until there is one
+        """
+        self.refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class SlackDispatcher(object):
+    """
+    Queues notifications per channel, and sends everything which arrives
+    for a channel within `window` seconds as one message. Messages are
+    sent no faster than the token bucket allows, and anything which has
+    to wait keeps collecting notifications in the meantime.
+    """
+    def __init__(self, host, token, window=2.0, rate=1.0, burst=3,
+                 maxFields=20, clock=reactor, client=SlackClient):
+        self.host = host
+        self.token = token
+        self.window = window
+        self.maxFields = maxFields
+        self.clock = clock
+        self.client = client
+
+        self.bucket = TokenBucket(rate, burst, clock=clock)
+        self.queues = {}
+        self.calls = {}
+
+        self.sent = 0
+        self.coalesced = 0
+
+    def notify(self, channel, text):
+        """
+        Queues a notification, this never waits for Slack
+        """
+        self.queues.setdefault(channel, []).append(text)
+        if channel not in self.calls:
+            self.schedule(channel, self.window)
+
+    def schedule(self, channel, delay):
+        self.calls[channel] = self.clock.callLater(delay, self.flush, channel)
+
+    def flush(self, channel):
+        del self.calls[channel]
+
+        wait = self.bucket.take()
+        if wait:
+            self.schedule(channel, wait)
+            return
+
+        queue = self.queues[channel]
+        texts = queue[:self.maxFields]
+        del queue[:self.maxFields]
+
+        if queue:
+            # Send the rest once the bucket allows it
+            self.schedule(channel, 0)
+        else:
+            del self.queues[channel]
+
+        d = self.send(channel, texts)
+        d.addErrback(log.err, 'Could not notify Slack channel %s' % channel)
+        return d
+
+    def send(self, channel, texts):
+        sc = self.client(self.host, self.token, channel)
+        self.sent += 1
+
+        if len(texts) == 1:
+            return sc.message(texts[0])
+
+        self.coalesced += len(texts) - 1
+        return sc.message('%s notifications' % len(texts),
+            fields=[{'value': text, 'short': False} for text in texts],
+            fallback='\n'.join(texts))
@@ -3,17 +3,21 @@
 
 import hashlib
 import base64
+import collections
+import codecs
 import hmac
 import urllib
 import json
-
-from StringIO import StringIO
+import random
+import re
+import tempfile
 
 from zope.interface import implements
 
 from twisted.web.iweb import IBodyProducer
-from twisted.web.client import Agent
-from twisted.internet import reactor, defer, protocol
+from twisted.web.client import Agent, HTTPConnectionPool, ResponseDone
+from twisted.web.http import PotentialDataLoss
+from twisted.internet import reactor, defer, protocol, task, error, threads
 from twisted.internet.ssl import ClientContextFactory
 from twisted.web.http_headers import Headers
 
@@ -28,17 +32,24 @@ class WebClientContextFactory(ClientContextFactory):
         return ClientContextFactory.getContext(self)
 
 class BodyReceiver(protocol.Protocol):
-    """ Simple buffering consumer for body objects """
-    def __init__(self, finished):
+    """
+    Buffering consumer for body objects. Bodies larger than maxMemory
+    bytes are spilled to a temporary file.
+    """
+    def __init__(self, finished, maxMemory=1024*1024):
         self.finished = finished
-        self.buffer = StringIO()
+        self.buffer = tempfile.SpooledTemporaryFile(max_size=maxMemory)
 
     def dataReceived(self, buffer):
         self.buffer.write(buffer)
 
     def connectionLost(self, reason):
-        self.buffer.seek(0)
-        self.finished.callback(self.buffer)
+        if reason.check(ResponseDone, PotentialDataLoss):
+            self.buffer.seek(0)
+            self.finished.callback(self.buffer)
+        else:
+            self.buffer.close()
+            self.finished.errback(reason)
 
 class StringProducer(object):
     """
@@ -60,13 +71,391 @@ class StringProducer(object):
     def stopProducing(self):
         pass
 
+class SpecterTimeout(Exception):
+    """ A Specter request did not complete in time """
+
+def truncateOutput(output, maxSize, length=None):
+    """
+    Keep the last maxSize characters of command output, which is where
+    errors end up. length is the size of the whole output if only its
+    tail was passed in.
+    """
+    if length is None:
+        length = output and len(output)
+    if maxSize and output and length > maxSize:
+        return '[%s characters truncated]\n%s' % (
+            length - maxSize, output[-maxSize:])
+    return output
+
+class OutputTail(object):
+    """
+    Collects output a piece at a time, keeping only its last maxSize
+    characters. Pieces are handed to output in batches of about
+    flushSize characters as they're collected.
+    """
+    def __init__(self, maxSize, output=None, flushSize=64*1024):
+        self.maxSize = maxSize
+        self.output = output
+        self.flushSize = flushSize
+        self.pending = []
+        self.pendingSize = 0
+        self.pieces = collections.deque()
+        self.kept = 0
+        self.length = 0
+
+    @property
+    def size(self):
+        return self.kept + self.pendingSize
+
+    def append(self, text):
+        if text:
+            self.pending.append(text)
+            self.pendingSize += len(text)
+            if self.pendingSize >= self.flushSize:
+                self.flush()
+
+    def flush(self):
+        text = u''.join(self.pending)
+        self.pending = []
+        self.pendingSize = 0
+        if not text:
+            return
+
+        self.length += len(text)
+        if self.output:
+            self.output(text)
+
+        if len(text) >= self.maxSize:
+            self.pieces.clear()
+            self.kept = 0
+            text = text[-self.maxSize:]
+
+        self.pieces.append(text)
+        self.kept += len(text)
+        while self.kept > self.maxSize:
+            excess = self.kept - self.maxSize
+            if len(self.pieces[0]) <= excess:
+                self.kept -= len(self.pieces.popleft())
+            else:
+                self.pieces[0] = self.pieces[0][excess:]
+                self.kept -= excess
+
+    def value(self):
+        self.flush()
+        return truncateOutput(u''.join(self.pieces), self.maxSize, self.length)
+
+class BodyParser(object):
+    """
+    Parses a JSON response body from a file a chunk at a time, decoding
+    it as json.loads would.
+
+    The top level stdout and stderr strings are passed to output(key,
+    text) as they're decoded, and only their last maxOutput characters
+    are kept. The body is read an eighth of maxMemory at a time and no
+    value held may be over half of it, so parsing never holds more than
+    maxMemory of the body. The most it held at once is kept in `peak`.
+    """
+    outputKeys = ('stdout', 'stderr')
+
+    nonSpace = re.compile(r'\S')
+    plain = re.compile(r'[^"\\]*')
+    escape = re.compile(r'\\(?:u[0-9a-fA-F]{4}|[^u])')
+    # Runs of characters and escapes which decode the same by themselves
+    # as they do in the whole string, so high surrogates only with the
+    # low surrogate they pair with
+    stringRun = re.compile(r'(?:[^"\\]+|\\[^u]'
+        r'|\\u(?![dD][89abAB])[0-9a-fA-F]{4}'
+        r'|\\u[dD][89abAB][0-9a-fA-F]{2}\\u[dD][c-fC-F][0-9a-fA-F]{2})*')
+    valueSpecial = re.compile(r'["{}\[\],]')
+
+    def __init__(self, body, maxMemory, maxOutput=None, output=None,
+                 chunkSize=64*1024):
+        self.body = body
+        self.limit = maxMemory // 2
+        self.chunkSize = max(1, min(chunkSize, maxMemory // 8))
+        self.maxOutput = min(maxOutput or self.limit, self.limit)
+        self.output = output
+        self.buf = ''
+        self.pos = 0
+        self.held = 0
+        self.taken = 0
+        self.peak = 0
+
+    def hold(self, size):
+        """
+        Record that size characters of the current value are held
+        """
+        self.held = size
+        self.peak = max(self.peak, len(self.buf) + size)
+
+    def fill(self, n=1):
+        """
+        Buffer at least n bytes past pos, returns False at the end of the
+        body
+        """
+        while len(self.buf) - self.pos < n:
+            data = self.body.read(self.chunkSize)
+            if not data:
+                return False
+            self.buf = self.buf[self.pos:] + data
+            self.pos = 0
+            self.hold(self.held)
+        return True
+
+    def peek(self):
+        """
+        Skip whitespace and return the next character
+        """
+        while True:
+            if not self.fill():
+                raise ValueError("Unexpected end of JSON body")
+            m = self.nonSpace.search(self.buf, self.pos)
+            if m:
+                self.pos = m.start()
+                return self.buf[self.pos]
+            self.pos = len(self.buf)
+
+    def expect(self, chars):
+        c = self.peek()
+        if c not in chars:
+            raise ValueError("Expected one of %r in JSON body, got %r" % (
+                chars, c))
+        self.pos += 1
+        return c
+
+    def parse(self):
+        if self.peek() != '{':
+            # Only objects carry command output
+            text = []
+            self.taken = 0
+            while self.fill():
+                self.take(text, len(self.buf))
+            return json.loads(''.join(text))
+
+        self.pos += 1
+        result = {}
+        if self.peek() == '}':
+            self.pos += 1
+            self.finish()
+            return result
+
+        while True:
+            self.expect('"')
+            text = ['"']
+            self.taken = 0
+            self.rawString(text)
+            key = json.loads(''.join(text))
+
+            self.expect(':')
+            if key in self.outputKeys and self.peek() == '"':
+                self.pos += 1
+                result[key] = self.string(key)
+            else:
+                result[key] = self.value()
+            self.hold(0)
+
+            if self.expect(',}') == '}':
+                self.finish()
+                return result
+
+    def finish(self):
+        while self.fill():
+            if self.nonSpace.search(self.buf, self.pos):
+                raise ValueError("Extra data after JSON body")
+            self.pos = len(self.buf)
+
+    def take(self, text, end):
+        """
+        Move on to end, adding what was passed over to the text of the
+        current value
+        """
+        piece = self.buf[self.pos:end]
+        self.pos = end
+        self.taken += len(piece)
+        if self.taken > self.limit:
+            raise ValueError("JSON value over %s bytes in body" % self.limit)
+        text.append(piece)
+        self.hold(self.taken)
+
+    def string(self, key):
+        """
+        Decode an output string whose opening quote has been read
+        """
+        output = None
+        if self.output:
+            output = lambda text: self.output(key, text)
+        tail = OutputTail(self.maxOutput, output, self.chunkSize)
+        decoder = codecs.getincrementaldecoder('utf-8')()
+
+        while True:
+            if not self.fill():
+                raise ValueError("Unterminated string in JSON body")
+            end = self.stringRun.match(self.buf, self.pos).end()
+            if end > self.pos:
+                text = decoder.decode(self.buf[self.pos:end])
+                tail.append(json.decoder.scanstring(u'"%s"' % text, 1)[0])
+                self.pos = end
+                self.hold(tail.size)
+            if end == len(self.buf):
+                continue
+
+            if self.buf[end] == '"':
+                self.pos += 1
+                decoder.decode('', True)
+                return tail.value()
+
+            # An escape cut off at the end of the buffer, or a lone high
+            # surrogate. Both halves of a pair are decoded together, and
+            # lone surrogates by themselves, as json.loads has them.
+            self.fill(12)
+            m = self.escape.match(self.buf, self.pos)
+            if not m:
+                raise ValueError("Invalid escape in JSON string")
+            escape = m.group()
+            if 0xd800 <= self.codePoint(escape) <= 0xdbff:
+                m = self.escape.match(self.buf, m.end())
+                if m and 0xdc00 <= self.codePoint(m.group()) <= 0xdfff:
+                    escape += m.group()
+            tail.append(json.loads('"%s"' % escape))
+            self.pos += len(escape)
+            self.hold(tail.size)
+
+    def codePoint(self, escape):
+        if escape[1] == 'u':
+            return int(escape[2:], 16)
+        return 0
+
+    def value(self):
+        """
+        Decode the next value in the object
+        """
+        text = []
+        self.taken = 0
+        depth = 0
+        while True:
+            if not self.fill():
+                raise ValueError("Unexpected end of JSON body")
+            m = self.valueSpecial.search(self.buf, self.pos)
+            if not m:
+                self.take(text, len(self.buf))
+                continue
+
+            c = m.group()
+            if c in ',}]' and depth == 0:
+                self.take(text, m.start())
+                return json.loads(''.join(text))
+
+            self.take(text, m.end())
+            if c == '"':
+                self.rawString(text)
+            elif c in '{[':
+                depth += 1
+            elif c in '}]':
+                depth -= 1
+
+    def rawString(self, text):
+        """
+        Add the undecoded rest of a string whose opening quote has been
+        read to text
+        """
+        while True:
+            if not self.fill():
+                raise ValueError("Unterminated string in JSON body")
+            end = self.plain.match(self.buf, self.pos).end()
+            self.take(text, end)
+            if end == len(self.buf):
+                continue
+
+            if self.buf[end] == '"':
+                self.take(text, end + 1)
+                return
+
+            # Keep an escape with its backslash, so an escaped quote
+            # doesn't end the string
+            self.fill(2)
+            self.take(text, min(self.pos + 2, len(self.buf)))
+
+class SpecterConnectionPool(HTTPConnectionPool):
+    """
+    Persistent connection pool which also limits how many requests
+    SpecterClients sharing it make to each host at once
+    """
+    def __init__(self, reactor, maxPerHost=2):
+        HTTPConnectionPool.__init__(self, reactor, persistent=True)
+        self.maxPersistentPerHost = maxPerHost
+        self.hostLimits = {}
+
+    def hostLimit(self, host, port):
+        """
+        The semaphore requests to host:port run under
+        """
+        key = '%s:%s' % (host, port)
+        if key not in self.hostLimits:
+            self.hostLimits[key] = defer.DeferredSemaphore(
+                self.maxPersistentPerHost)
+        return self.hostLimits[key]
+
+def createPool(maxPerHost=2, idleTimeout=240):
+    """
+    Persistent connection pool which can be shared between SpecterClients.
+    At most maxPerHost requests are made to a host at once, and idle
+    connections are closed after idleTimeout seconds.
+    """
+    pool = SpecterConnectionPool(reactor, maxPerHost)
+    pool.cachedConnectionTimeout = idleTimeout
+    return pool
+
 class SpecterClient(object):
-    def __init__(self, host, auth, key, port=2400, async=True):
+    """
+    Client for a Specter agent.
+
+    Requests which take longer than connectTimeout to connect, or
+    readTimeout to complete, fail with SpecterTimeout. GET requests are
+    idempotent so failed ones are retried up to `retries` times, waiting
+    a jittered exponential backoff between attempts. Retries and their
+    outcome are recorded in `history`.
+
+    Response bodies over maxMemory bytes are spooled to disk while they
+    are received, and parsed from the spool a chunk at a time. Command
+    output in them is passed to output(key, text) as it's decoded, and
+    only its last maxOutput characters are kept.
+    """
+    def __init__(self, host, auth, key, port=2400, async=True, pool=None,
+                 ssl=True, connectTimeout=None, readTimeout=None, retries=0,
+                 backoff=1.0, maxBackoff=30.0, clock=reactor,
+                 maxMemory=1024*1024, maxOutput=None, output=None):
         self.host = host
         self.port = port
         self.auth = auth
         self.key = key
         self.async = async
+        self.pool = pool
+        self.scheme = ssl and 'https' or 'http'
+
+        self.connectTimeout = connectTimeout
+        self.readTimeout = readTimeout
+        self.retries = retries
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.clock = clock
+        self.maxMemory = maxMemory
+        self.maxOutput = maxOutput
+        self.output = output
+
+        self.history = []
+        self.agents = {}
+
+    def getAgent(self, url):
+        scheme = url.split(':', 1)[0]
+        if scheme not in self.agents:
+            if scheme == 'https':
+                self.agents[scheme] = Agent(reactor, WebClientContextFactory(),
+                    connectTimeout=self.connectTimeout, pool=self.pool)
+            else:
+                self.agents[scheme] = Agent(reactor,
+                    connectTimeout=self.connectTimeout, pool=self.pool)
+
+        return self.agents[scheme]
 
     def createSignature(self, path, data=None):
         if data:
@@ -84,32 +473,102 @@ class SpecterClient(object):
 
         return base64.b64encode(mysig)
 
-    @defer.inlineCallbacks
     def httpsRequest(self, url, headers={}, method='GET', data=None):
+        if self.pool is None:
+            return self.sendRequest(url, headers, method, data)
+
+        # Wait for our turn at the host, and hold it until the body is read
+        return self.pool.hostLimit(self.host, self.port).run(
+            self.sendRequest, url, headers, method, data)
+
+    def sendRequest(self, url, headers, method, data):
         headers['Content-Type'] = ['application/json']
-        if url.startswith('https'):
-            agent = Agent(reactor, WebClientContextFactory())
-        else:
-            agent = Agent(reactor)
+        agent = self.getAgent(url)
 
         if data:
             data = StringProducer(data)
 
-        request = yield agent.request(
+        d = agent.request(
             method,
             url,
             Headers(headers),
             data
         )
 
-        if request.length:
-            d = defer.Deferred()
-            request.deliverBody(BodyReceiver(d))
-            body = yield d
+        def readJson(response):
+            if not response.length:
+                return None
 
-            defer.returnValue(json.loads(body.read()))
-        else:
-            defer.returnValue(None)
+            body = defer.Deferred()
+            response.deliverBody(BodyReceiver(body, self.maxMemory))
+            return body.addCallback(self.parseBody)
+
+        def connectTimedOut(failure):
+            failure.trap(error.TimeoutError)
+            raise SpecterTimeout('Timed out connecting to %s after %ss' % (
+                self.host, self.connectTimeout))
+
+        def readTimedOut(result, timeout):
+            raise SpecterTimeout('No response from %s after %ss' % (
+                self.host, timeout))
+
+        d.addCallbacks(readJson, connectTimedOut)
+
+        if self.readTimeout:
+            d.addTimeout(self.readTimeout, self.clock,
+                onTimeoutCancel=readTimedOut)
+
+        return d
+
+    def parseBody(self, body):
+        if self.output is None:
+            return self.readBody(body, None)
+
+        # Parsing waits for each piece of output to be taken, which is
+        # done in the reactor, so it happens in a thread
+        def output(key, text):
+            return threads.blockingCallFromThread(
+                reactor, self.output, key, text)
+
+        return threads.deferToThread(self.readBody, body, output)
+
+    def readBody(self, body, output):
+        try:
+            return BodyParser(body, self.maxMemory, self.maxOutput,
+                output).parse()
+        finally:
+            body.close()
+
+    def getBackoff(self, attempt):
+        """
+        Seconds to wait before retrying after `attempt` failures
+        """
+        delay = min(self.maxBackoff, self.backoff * (2 ** (attempt - 1)))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    @defer.inlineCallbacks
+    def retryRequest(self, description, request):
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                result = yield request()
+            except Exception, e:
+                if attempt > self.retries:
+                    if self.retries:
+                        self.history.append('%s failed after %s attempts: %s' % (
+                            description, attempt, e))
+                    raise
+
+                delay = self.getBackoff(attempt)
+                self.history.append('%s failed (%s), retrying in %.1fs' % (
+                    description, e, delay))
+                yield task.deferLater(self.clock, delay, lambda: None)
+            else:
+                if attempt > 1:
+                    self.history.append('%s succeeded after %s attempts' % (
+                        description, attempt))
+                defer.returnValue(result)
 
     def signHeaders(self, path, data=None):
         sig = self.createSignature(path, data)
@@ -123,15 +582,13 @@ class SpecterClient(object):
         if a:
             path = path + '/' + '/'.join([str(i) for i in a])
 
-        url = 'https://%s:%s/%s' % (self.host, self.port, path)
+        url = '%s://%s:%s/%s' % (self.scheme, self.host, self.port, path)
 
-        return self.httpsRequest(
-            url,
-            headers=self.signHeaders(path)
-        )
+        return self.retryRequest('GET /%s' % path,
+            lambda: self.httpsRequest(url, headers=self.signHeaders(path)))
 
     def postRequest(self, path, data, *a):
-        url = 'https://%s:%s/%s' % (self.host, self.port, path)
+        url = '%s://%s:%s/%s' % (self.scheme, self.host, self.port, path)
         return self.httpsRequest(
             url,
             headers=self.signHeaders(path, data),
@@ -1,16 +1,330 @@
+import threading
 import time
 
-from twisted.internet import defer, reactor, protocol
+import psycopg2
+from psycopg2 import sql
+
+from twisted.internet import defer, reactor, protocol, threads
 from twisted.python import log
 from twisted.enterprise import adbapi
 
+from skeleton import settings
+
+try:
+    from txpostgres import txpostgres
+except ImportError:
+    txpostgres = None
+
+
+class Record(object):
+    """
+    A compact, read-only row which is accessed like a dict. Subclasses are
+    made by recordType for each set of columns.
+    """
+    __slots__ = ()
+    _fields = ()
+
+    def __init__(self, *values):
+        for field, value in zip(self._fields, values):
+            object.__setattr__(self, field, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Records are read-only')
+
+    def __getitem__(self, key):
+        if key not in self._fields:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        if key in self._fields:
+            return getattr(self, key)
+        return default
+
+    def __contains__(self, key):
+        return key in self._fields
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def keys(self):
+        return list(self._fields)
+
+    def values(self):
+        return [getattr(self, f) for f in self._fields]
+
+    def items(self):
+        return zip(self._fields, self.values())
+
+    def __eq__(self, other):
+        if isinstance(other, (Record, dict)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        if eq is NotImplemented:
+            return eq
+        return not eq
+
+    __hash__ = None
+
+    def __reduce__(self):
+        return (recordType(self._fields), tuple(self.values()))
+
+    def __repr__(self):
+        return '<Record(%s)>' % ', '.join(
+            '%s=%r' % item for item in self.items())
+
+
+_recordTypes = {}
+
+def recordType(fields):
+    """ The Record class for rows with these columns """
+    fields = tuple(fields)
+    if fields not in _recordTypes:
+        _recordTypes[fields] = type('Record', (Record,), {
+            '__slots__': fields, '_fields': fields})
+    return _recordTypes[fields]
+
+
+def records(rows, fields):
+    """ Map rows of these columns to Records """
+    record = recordType(fields)
+    return [record(*row) for row in rows]
+
+
+# Columns fetched by default, large logs are only fetched when asked for
+BUILD_FIELDS = ('id', 'build_time', 'task_id', 'project_id', 'state',
+                'build_file', 'commit', 'worker', 'heartbeat')
+TARGET_FIELDS = ('id', 'deploy_state', 'current_build_id', 'release_id',
+                 'server_id')
+
+
+def poolConfig(config=None):
+    """
+    Pool sizes and psycopg2 connection parameters for the task database.
+    These come from Django's default database and the TASK_DB settings,
+    and anything in `config` (the task_db section of config.yaml) overrides
+    them.
+    """
+    db = settings.DATABASES['default']
+    params = {
+        'database': db.get('NAME'),
+        'host': db.get('HOST'),
+        'port': db.get('PORT'),
+        'user': db.get('USER'),
+        'password': db.get('PASSWORD'),
+        'pool_min': settings.TASK_DB_POOL_MIN,
+        'pool_max': settings.TASK_DB_POOL_MAX,
+        'statement_timeout': settings.TASK_DB_STATEMENT_TIMEOUT,
+    }
+    params.update(settings.TASK_DB)
+    params.update(config or {})
+    params.pop('backend', None)
+
+    kw = {
+        'cp_min': int(params.pop('pool_min')),
+        'cp_max': int(params.pop('pool_max')),
+    }
+
+    # Statements are cancelled by the server after this many milliseconds
+    timeout = params.pop('statement_timeout')
+    if timeout:
+        options = params.get('options')
+        params['options'] = ' '.join(filter(None,
+            [options, '-c statement_timeout=%d' % int(timeout)]))
+
+    # Empty values fall back to libpq's defaults
+    for k, v in params.items():
+        if v not in (None, ''):
+            kw[k] = v
+
+    return kw
+
+
+class MeteredConnectionPool(adbapi.ConnectionPool):
+    """
+    A ConnectionPool which keeps count of how many interactions are waiting
+    for a connection, how many are holding one, and how long they waited.
+    """
+    def __init__(self, *a, **kw):
+        adbapi.ConnectionPool.__init__(self, *a, **kw)
+        self.statsLock = threading.Lock()
+        self.waiting = 0
+        self.in_use = 0
+        self.requests = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _metered(self, queued, f, *args, **kw):
+        # Runs in the pool thread which owns the connection
+        started = time.time()
+        wait = started - queued
+        with self.statsLock:
+            self.waiting -= 1
+            self.in_use += 1
+            self.requests += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+        try:
+            return f(*args, **kw)
+        finally:
+            with self.statsLock:
+                self.in_use -= 1
+
+    def _defer(self, f, *args, **kw):
+        with self.statsLock:
+            self.waiting += 1
+        return threads.deferToThreadPool(self._reactor, self.threadpool,
+            self._metered, time.time(), f, *args, **kw)
+
+    def runWithConnection(self, func, *args, **kw):
+        return self._defer(self._runWithConnection, func, *args, **kw)
+
+    def runInteraction(self, interaction, *args, **kw):
+        return self._defer(self._runInteraction, interaction, *args, **kw)
+
+    def stats(self):
+        """
+        Pool saturation counters. Wait times are in seconds, from an
+        interaction being queued to it getting a connection.
+        """
+        with self.statsLock:
+            return {
+                'min': self.min,
+                'max': self.max,
+                'waiting': self.waiting,
+                'in_use': self.in_use,
+                'requests': self.requests,
+                'wait_total': self.wait_total,
+                'wait_max': self.wait_max,
+                'wait_avg': self.requests and (
+                    self.wait_total / self.requests) or 0.0,
+            }
+
+
+if txpostgres is not None:
+    class AsyncConnectionPool(txpostgres.ConnectionPool):
+        """
+        A txpostgres pool of non-blocking connections, keeping the same
+        counters as MeteredConnectionPool. cp_min connections are opened up
+        front, and more up to cp_max while every open one is in use.
+        Queries wait for a connection until the pool has started.
+        """
+        def __init__(self, _ignored, cp_min=3, cp_max=5, **connkw):
+            cp_min = min(cp_min, cp_max)
+            txpostgres.ConnectionPool.__init__(
+                self, _ignored, min=cp_min, **connkw)
+            self.max = cp_max
+            # Connections open or being opened
+            self.size = cp_min
+            self.waiting = 0
+            self.in_use = 0
+            self.requests = 0
+            self.wait_total = 0.0
+            self.wait_max = 0.0
+
+            # Hold every slot until the first connections are up
+            self.slots = defer.DeferredSemaphore(cp_max)
+            for i in range(cp_max):
+                self.slots.acquire()
+
+            d = self.start()
+            d.addErrback(log.err, 'Could not connect to the task database')
+            d.addBoth(self._started)
+
+        def _started(self, _):
+            # Releasing runs waiting queries, which take connections
+            for i in range(self.max):
+                self.slots.release()
+
+        def _grow(self):
+            self.size += 1
+            connection = self.connectionFactory(self.reactor, self.cooperator)
+
+            def failed(err):
+                self.size -= 1
+                log.err(err, 'Could not open a task database connection')
+
+            d = connection.connect(*self.connargs, **self.connkw)
+            d.addCallbacks(lambda _: self.add(connection), failed)
+
+        def _metered(self, f, *args, **kw):
+            self.waiting += 1
+            return self.slots.run(
+                self._timed, time.time(), f, *args, **kw)
+
+        def _timed(self, queued, f, *args, **kw):
+            wait = time.time() - queued
+            self.waiting -= 1
+            self.in_use += 1
+            self.requests += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            if self.in_use > self.size:
+                self._grow()
+
+            d = f(self, *args, **kw)
+            d.addBoth(self._done)
+            return d
+
+        def _done(self, result):
+            self.in_use -= 1
+            return result
+
+        def runQuery(self, *args, **kw):
+            return self._metered(
+                txpostgres.ConnectionPool.runQuery, *args, **kw)
+
+        def runOperation(self, *args, **kw):
+            return self._metered(
+                txpostgres.ConnectionPool.runOperation, *args, **kw)
+
+        def runInteraction(self, interaction, *args, **kw):
+            return self._metered(
+                txpostgres.ConnectionPool.runInteraction, interaction,
+                *args, **kw)
+
+        def stats(self):
+            """ Pool saturation counters, see MeteredConnectionPool """
+            return {
+                'min': self.min,
+                'max': self.max,
+                'waiting': self.waiting,
+                'in_use': self.in_use,
+                'requests': self.requests,
+                'wait_total': self.wait_total,
+                'wait_max': self.wait_max,
+                'wait_avg': self.requests and (
+                    self.wait_total / self.requests) or 0.0,
+            }
+
+
+def getDB(config=None):
+    """
+    A SideloaderDB for the task_db section of config.yaml, using the
+    backend it names (or TASK_DB_BACKEND).
+    """
+    backend = (config or {}).get('backend', settings.TASK_DB_BACKEND)
+    if backend == 'adbapi':
+        return SideloaderDB(config)
+    if backend == 'txpostgres':
+        return AsyncSideloaderDB(config)
+    raise ValueError('Unknown task_db backend: %r' % (backend,))
+
+
 class SideloaderDB(object):
-    def __init__(self):
-        self.p = adbapi.ConnectionPool('psycopg2',
-            database='sideloader',
-            host='localhost',
-            user='postgres',
-        )
+    """ Task database queries, run on adbapi's thread pool """
+    def __init__(self, config=None):
+        self.p = MeteredConnectionPool('psycopg2', **poolConfig(config))
+
+    def stats(self):
+        """ Connection pool saturation counters """
+        return self.p.stats()
 
     def _fetchOneTxn(self, txn, *a, **kw):
         " Transaction callback for self.fetchOne "
@@ -40,34 +354,33 @@ class SideloaderDB(object):
 
         return self.fetchOne(st, values)
 
-    @defer.inlineCallbacks
-    def select(self, table, fields, **kw):
-        q = []
-        args = []
-        for k, v in kw.items():
-            q.append('%s=%%%%s' % k)
-            args.append(v)
+    def _selectTxn(self, txn, query, args, fields):
+        " Transaction callback for self.select "
+        txn.execute(query, args)
+        return records(txn.fetchall(), fields)
 
-        query = "SELECT %s FROM %s" 
-
-        if q:
-            query += " WHERE " + ' and '.join(q)
+    def selectQuery(self, table, fields, kw):
+        " SELECT statement and arguments for self.select "
+        keys = sorted(kw)
 
-        results = yield self.p.runQuery(query % (
-                ','.join(fields),
-                table,
-            ), tuple(args))
+        query = sql.SQL("SELECT {} FROM {}").format(
+            sql.SQL(',').join(map(sql.Identifier, fields)),
+            sql.Identifier(table))
 
-        res = []
+        if keys:
+            query += sql.SQL(" WHERE ") + sql.SQL(' and ').join([
+                sql.SQL("{}=%s").format(sql.Identifier(k)) for k in keys])
 
-        for r in results:
-            obj = {}
-            for i, col in enumerate(r):
-                obj[fields[i]] = col
+        return query, tuple(kw[k] for k in keys)
 
-            res.append(obj)
+    def selectRecords(self, query, args, fields):
+        " Run a query returning these columns, as Records "
+        return self.p.runInteraction(self._selectTxn, query, args, fields)
 
-        defer.returnValue(res)
+    def select(self, table, fields, **kw):
+        " SELECT fields from table WHERE each keyword matches, as Records "
+        query, args = self.selectQuery(table, fields, kw)
+        return self.selectRecords(query, args, fields)
 
     # Project queries
 
@@ -84,6 +397,22 @@ class SideloaderDB(object):
     def updateBuildLog(self, id, log):
         return self.p.runOperation('UPDATE sideloader_build SET log=%s WHERE id=%s', (log, id))
 
+    def appendBuildLog(self, id, seq, offset, data):
+        " Append a chunk of output to a build log "
+        return self.p.runOperation(
+            'INSERT INTO sideloader_buildlogchunk'
+            ' (build_id, seq, byte_offset, data)'
+            ' SELECT id, %s, %s, %s FROM sideloader_build WHERE id=%s',
+            (seq, offset, psycopg2.Binary(data), id))
+
+    @defer.inlineCallbacks
+    def getBuildLog(self, id):
+        q = yield self.p.runQuery(
+            'SELECT data FROM sideloader_buildlogchunk WHERE build_id=%s'
+            ' ORDER BY seq', (id,))
+
+        defer.returnValue(''.join([bytes(r[0]) for r in q]))
+
     @defer.inlineCallbacks
     def getProjectNotificationSettings(self, id):
         
@@ -96,9 +425,8 @@ class SideloaderDB(object):
     # Build queries
 
     @defer.inlineCallbacks
-    def getBuild(self, id):
-        r = yield self.select('sideloader_build', ['id', 'build_time',
-            'task_id', 'log', 'project_id', 'state', 'build_file'], id=id)
+    def getBuild(self, id, fields=BUILD_FIELDS):
+        r = yield self.select('sideloader_build', fields, id=id)
 
         defer.returnValue(r[0])
 
@@ -122,6 +450,62 @@ class SideloaderDB(object):
     def setBuildFile(self, id, f):
         return self.p.runOperation('UPDATE sideloader_build SET build_file=%s WHERE id=%s', (f, id))
 
+    def setBuildCommit(self, id, commit):
+        return self.p.runOperation('UPDATE sideloader_build SET commit=%s WHERE id=%s', (commit, id))
+
+    @defer.inlineCallbacks
+    def claimBuild(self, id, worker, fields=BUILD_FIELDS):
+        """
+        Marks a build which hasn't started as running on worker, and returns
+        it as it was claimed. Returns None if it has started, or another
+        build of its project is running.
+        """
+        query = sql.SQL(
+            "UPDATE sideloader_build SET worker=%s, heartbeat=now()"
+            " WHERE id=%s AND state=0 AND worker='' RETURNING {}").format(
+                sql.SQL(',').join(map(sql.Identifier, fields)))
+        try:
+            r = yield self.selectRecords(query, (worker, id), fields)
+        except psycopg2.IntegrityError:
+            # sideloader_build_running allows one per project
+            defer.returnValue(None)
+
+        defer.returnValue(r[0] if r else None)
+
+    @defer.inlineCallbacks
+    def getRunningBuilds(self, project_id, timeout):
+        """
+        Returns (id, worker, stale) for each running build of a project,
+        stale if the worker hasn't checked in for timeout seconds
+        """
+        q = yield self.p.runQuery(
+            "SELECT id, worker, heartbeat < now() - %s * interval '1 second'"
+            " FROM sideloader_build WHERE project_id=%s AND state=0"
+            " AND worker<>'' ORDER BY id", (timeout, project_id))
+
+        defer.returnValue([tuple(r) for r in q])
+
+    @defer.inlineCallbacks
+    def getPendingBuild(self, project_id):
+        " The oldest build of a project which hasn't been claimed "
+        r = yield self.fetchOne(
+            "SELECT id FROM sideloader_build WHERE project_id=%s AND state=0"
+            " AND worker='' ORDER BY id LIMIT 1", (project_id,))
+
+        defer.returnValue(r and r[0])
+
+    def beatBuilds(self, worker):
+        " Checks in for every build worker is running "
+        return self.p.runOperation(
+            'UPDATE sideloader_build SET heartbeat=now()'
+            ' WHERE worker=%s AND state=0', (worker,))
+
+    def expireBuild(self, id, worker):
+        " Fails a build whose worker has gone away "
+        return self.p.runOperation(
+            'UPDATE sideloader_build SET state=2'
+            ' WHERE id=%s AND worker=%s AND state=0', (id, worker))
+
     # Release queries
 
     def createRelease(self, release):
@@ -167,26 +551,6 @@ class SideloaderDB(object):
 
         defer.returnValue(True)
 
-    @defer.inlineCallbacks
-    def countReleases(self, id, waiting=False, lock=False):
-        q = yield self.p.runQuery('SELECT count(*) FROM sideloader_release'
-            ' WHERE flow_id=%s AND waiting=%s AND lock=%s', (id, waiting, lock)
-        )
-
-        defer.returnValue(q[0][0])
-
-    def getReleases(self, flowid=None, waiting=None, lock=None):
-        q = {}
-        if flowid is not None:
-            q['flowid'] = flowid
-        if waiting is not None:
-            q['waiting'] = waiting
-        if lock is not None:
-            q['lock'] = lock
-
-        return self.select('sideloader_release', 
-            ['id', 'release_date', 'scheduled', 'waiting', 'lock', 'build_id', 'flow_id'], **q)
-
     @defer.inlineCallbacks
     def getRelease(self, id):
         r = yield self.select('sideloader_release', 
@@ -207,13 +571,49 @@ class SideloaderDB(object):
     def updateReleaseState(self, id, lock=False, waiting=False):
         return self.p.runOperation('UPDATE sideloader_release SET lock=%s, waiting=%s WHERE id=%s', (lock, waiting, id))
 
+    @defer.inlineCallbacks
+    def getReleaseQueue(self):
+        """
+        Waiting, unlocked releases. Each one is marked stale if a newer
+        release in its flow is waiting or already done, and has the number
+        of its flow's releases which are running.
+        """
+        fields = ['id', 'release_date', 'scheduled', 'build_id', 'flow_id',
+                  'stale', 'running']
+
+        # Only waiting releases are scanned, the newest release in each
+        # flow comes from the (flow_id, release_date) index
+        r = yield self.p.runQuery(
+            'SELECT %s FROM (' % ','.join(fields) +
+            ' SELECT id, release_date, scheduled, build_id, flow_id, lock,'
+            '  release_date < (SELECT max(release_date)'
+            '   FROM sideloader_release l WHERE l.flow_id = r.flow_id)'
+            '   AS stale,'
+            '  count(CASE WHEN lock THEN 1 END)'
+            '   OVER (PARTITION BY flow_id) AS running'
+            ' FROM sideloader_release r WHERE waiting'
+            ') q WHERE NOT lock ORDER BY id')
+
+        record = recordType(fields)
+        defer.returnValue([record(*i) for i in r])
+
+    def expireReleases(self, ids):
+        """ Stop waiting on all the releases in ids """
+        if not ids:
+            return defer.succeed(None)
+
+        return self.p.runOperation('UPDATE sideloader_release'
+            ' SET lock=false, waiting=false WHERE id = ANY(%s)', (list(ids),))
+
     # Flow queries
     @defer.inlineCallbacks
     def getFlow(self, id):
         r = yield self.select('sideloader_releaseflow', [
             'id', 'name', 'stream_mode', 'require_signoff', 'signoff_list',
             'quorum', 'service_restart', 'service_pre_stop', 'puppet_run',
-            'auto_release', 'project_id', 'stream_id', 'notify', 'notify_list'
+            'auto_release', 'project_id', 'stream_id', 'notify', 'notify_list',
+            'max_parallel_targets', 'rollout_batch', 'rollout_batch_percent',
+            'rollout_max_failures'
         ], id=id)
 
         if r:
@@ -236,41 +636,15 @@ class SideloaderDB(object):
         return self.select('sideloader_releaseflow', [
             'id', 'name', 'stream_mode', 'require_signoff', 'signoff_list',
             'quorum', 'service_restart', 'service_pre_stop', 'puppet_run',
-            'auto_release', 'project_id', 'stream_id', 'notify', 'notify_list'
+            'auto_release', 'project_id', 'stream_id', 'notify', 'notify_list',
+            'max_parallel_targets', 'rollout_batch', 'rollout_batch_percent',
+            'rollout_max_failures'
         ], project_id=project, auto_release=True)
 
-    @defer.inlineCallbacks
-    def getNextFlowRelease(self, flow_id):
-        q = yield self.p.runQuery('SELECT id FROM sideloader_release'
-            ' WHERE flow_id=%s AND waiting=true ORDER BY release_date DESC LIMIT 1', (flow_id,)
-        )
-
-        if q:
-            release = yield self.getRelease(q[0][0])
-        else:
-            release = None
-
-        defer.returnValue(release)
-
-    @defer.inlineCallbacks
-    def getLastFlowRelease(self, flow_id):
-        q = yield self.p.runQuery('SELECT id FROM sideloader_release'
-            ' WHERE flow_id=%s AND waiting=false ORDER BY release_date DESC LIMIT 1', (flow_id,)
-        )
-
-        if q:
-            release = yield self.getRelease(q[0][0])
-        else:
-            release = None
-
-        defer.returnValue(release)
-
     # Targets
 
-    def getFlowTargets(self, flow_id):
-        return self.select('sideloader_target', ['id', 'deploy_state', 
-            'log', 'current_build_id', 'release_id', 'server_id'],
-            release_id = flow_id)
+    def getFlowTargets(self, flow_id, fields=TARGET_FIELDS):
+        return self.select('sideloader_target', fields, release_id=flow_id)
 
     @defer.inlineCallbacks
     def getServer(self, id):
@@ -289,6 +663,9 @@ class SideloaderDB(object):
     def updateTargetLog(self, id, log):
         return self.p.runOperation('UPDATE sideloader_target SET log=%s WHERE id=%s', (log, id))
 
+    def appendTargetLog(self, id, log):
+        return self.p.runOperation('UPDATE sideloader_target SET log=log || %s WHERE id=%s', (log, id))
+
     def updateTargetBuild(self, id, build):
         return self.p.runOperation('UPDATE sideloader_target SET current_build_id=%s WHERE id=%s', (build, id))
 
@@ -308,3 +685,27 @@ class SideloaderDB(object):
         return self.p.runOperation(
             'UPDATE sideloader_webhook SET last_response=%s WHERE id=%s',
             (response, id))
+
+
+class AsyncSideloaderDB(SideloaderDB):
+    """
+    Task database queries on non-blocking connections driven by the
+    reactor, which saves a thread hop per query. Needs txpostgres.
+    """
+    def __init__(self, config=None):
+        if txpostgres is None:
+            raise ImportError(
+                'The txpostgres task_db backend needs txpostgres')
+        self.p = AsyncConnectionPool(None, **poolConfig(config))
+
+    def fetchOne(self, *a, **kw):
+        " Fetch one row only with this query "
+        d = self.p.runQuery(*a, **kw)
+        d.addCallback(lambda r: r and r[0] or None)
+        return d
+
+    def selectRecords(self, query, args, fields):
+        " Run a query returning these columns, as Records "
+        d = self.p.runQuery(query, args)
+        d.addCallback(records, fields)
+        return d
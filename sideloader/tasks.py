@@ -1,4 +1,7 @@
 import os
+import errno
+import math
+import socket
 import uuid
 import shutil
 import sys
@@ -9,15 +12,13 @@ import yaml
 
 import treq
 
-from email.MIMEText import MIMEText
-from email.MIMEMultipart import MIMEMultipart
-
-from sideloader import specter, slack, task_db
+from sideloader import (
+    specter, slack, task_db, logstream, logpublisher, scheduler, dbcache,
+    mailer)
 from skeleton import settings
 
-from twisted.mail.smtp import sendmail
-from twisted.internet import defer, reactor, protocol
-from twisted.python import log
+from twisted.internet import defer, reactor, protocol, task, utils
+from twisted.python import log, procutils
 from twisted.enterprise import adbapi
 
 from rhumba.plugin import RhumbaPlugin
@@ -26,43 +27,101 @@ from rhumba import cron
 
 
 class BuildProcess(protocol.ProcessProtocol):
-    def __init__(self, id, prjid, idhash, db, callback):
+    def __init__(self, id, prjid, idhash, db, callback, flush_interval=0.5,
+                 flush_size=65536, clock=reactor, publisher=None):
         self.id = id
         self.project_id = prjid
         self.idhash = idhash
         self.db = db
-        self.data = ""
+        self.seq = 0
+        self.offset = 0
         self.callback = callback
+        # Fires once the build has ended and been finalised
+        self.finished = defer.Deferred()
+
+        # Output is buffered and written out at most every flush_interval
+        # seconds, or as soon as flush_size bytes are waiting
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.clock = clock
+        self.buffer = []
+        self.buffered = 0
+        self.flush_call = None
+        # Writes go out one after another, so chunks land in order
+        self.writing = defer.succeed(None)
+
+        # Live log subscribers are fed from here, not from the database
+        self.publisher = publisher
 
     def log(self, msg):
         log.msg('[%s] %s' % (self.id, msg))
 
-    @defer.inlineCallbacks
+    def appendLog(self, data):
+        # Chunks carry their own sequence number so they can be written
+        # independently of each other and still be read back in order
+        self.seq += 1
+        offset = self.offset
+        self.offset += len(data)
+
+        if self.publisher:
+            self.publisher.publishLog(self.id, offset, data)
+
+        return self.db.appendBuildLog(self.id, self.seq, offset, data)
+
+    def flush(self, final=False):
+        if self.flush_call and self.flush_call.active():
+            self.flush_call.cancel()
+        self.flush_call = None
+
+        data = ''.join(self.buffer)
+        # Chunks end on whole characters so each one can be decoded by
+        # itself, until the output ends
+        complete = final and len(data) or logstream.utf8Boundary(data)
+        self.buffer = [data[complete:]]
+        self.buffered = len(data) - complete
+        data = data[:complete]
+
+        if data:
+            self.writing.addCallback(lambda _: self.appendLog(data))
+            self.writing.addErrback(log.err)
+
+        # Fires once this and every earlier write is done
+        d = defer.Deferred()
+        self.writing.addCallback(d.callback)
+        return d
+
+    def bufferLog(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+
+        if self.buffered >= self.flush_size:
+            self.flush()
+        elif self.flush_call is None:
+            self.flush_call = self.clock.callLater(
+                self.flush_interval, self.flush)
+
     def outReceived(self, data):
         self.log(data)
-        self.data = self.data + data
+        self.bufferLog(data)
 
-        yield self.db.updateBuildLog(self.id, self.data)
-
-    @defer.inlineCallbacks
     def errReceived(self, data):
         self.log(data)
-        self.data = self.data + data
-        
-        yield self.db.updateBuildLog(self.id, self.data)
+        self.bufferLog(data)
 
     def processEnded(self, reason):
-        reactor.callLater(0, self.callback, reason.value.exitCode,
-            self.project_id, self.id, self.idhash)
+        # Make sure the whole log is written before the build is finalised
+        d = self.flush(final=True)
+        d.addCallback(lambda _: self.callback(reason.value.exitCode,
+            self.project_id, self.id, self.idhash))
+        d.addErrback(log.err, 'Could not finish build %s' % self.id)
+        d.chainDeferred(self.finished)
 
 class Plugin(RhumbaPlugin):
     def __init__(self, *a, **kw):
         self.db = kw.pop('task_db', None)
+        self.log_stream = kw.pop('log_stream', None)
         RhumbaPlugin.__init__(self, *a, **kw)
 
-        if self.db is None:
-            self.db = task_db.SideloaderDB()
-
         self.local_path = self.config.get('localdir', 
             os.path.join(os.path.dirname(sys.argv[0]), '../..'))
         self.buildpack = os.path.join(self.local_path, 'bin/build_package')
@@ -70,28 +129,90 @@ class Plugin(RhumbaPlugin):
         self.sl_config = yaml.load(open(
             os.path.join(self.local_path, 'config.yaml')))
 
+        if self.db is None:
+            self.db = task_db.getDB(self.sl_config.get('task_db'))
+
+        # Projects, flows, streams and servers are looked up all the time
+        # during deployments but hardly ever change
+        self.db = dbcache.CachedDB(self.db, ttl=settings.TASK_DB_CACHE_TTL)
+        self.invalidations = None
+
         self.workspace = self.sl_config.get('workspace_base',
             '/workspace')
 
-        self.build_locks = {}
+        self.log_flush_interval = self.sl_config.get(
+            'log_flush_ms', 500) / 1000.0
+        self.log_flush_size = self.sl_config.get('log_flush_kb', 64) * 1024
+
+        if self.log_stream is None and self.sl_config.get('log_stream'):
+            self.log_stream = logpublisher.getPublisher(
+                self.sl_config['log_stream'])
+
+        # The web tier tells every worker about rows it saves. Anything
+        # missed while we weren't subscribed is dropped along with the rest.
+        if self.sl_config.get('log_stream'):
+            self.invalidations = logpublisher.listen(
+                self.sl_config['log_stream'], logstream.INVALIDATE_CHANNEL,
+                self.call_invalidate, self.db.clear)
+
+        # Builds are claimed in the database, so that only one worker at a
+        # time builds a project. Claims are kept alive by a heartbeat and
+        # expire once the worker holding them is gone.
+        self.hostname = socket.gethostname()
+        self.worker_id = '%s:%s' % (self.hostname, os.getpid())
+        self.build_timeout = self.sl_config.get('build_heartbeat_timeout',
+            300)
+        self.running_builds = set()
+        self.heartbeat_call = None
+
+        # Builds for different projects run side by side, up to
+        # build_workers at a time, and anything more waits its turn
+        self.build_pool = defer.DeferredSemaphore(
+            self.sl_config.get('build_workers', 2))
+        self.build_nice = self.sl_config.get('build_nice', 10)
+        self.build_ionice = self.sl_config.get('build_ionice', 7)
+        self.build_cpu_quota = self.sl_config.get('build_cpu_quota')
+        self.build_stats = {'builds': 0, 'wait_total': 0.0, 'wait_max': 0.0}
+
+        # Packages are reused by later builds of the same commit
+        self.reuse_artifacts = self.sl_config.get('reuse_artifacts', True)
+
+        # Runs the release queue as soon as anything in it falls due
+        self.scheduler = scheduler.ReleaseScheduler(self.queueCheck)
+        self.checking = False
+        self.recheck = False
+        self.running_releases = set()
+        # The sweep only runs once a minute, so load the schedule as soon
+        # as the worker is up
+        reactor.callWhenRunning(self.queueCheck)
+
+        # Notifications going to the same Slack channel at around the same
+        # time are sent together
+        self.slack = slack.SlackDispatcher(settings.SLACK_HOST,
+            settings.SLACK_TOKEN, window=settings.SLACK_BATCH_WINDOW,
+            rate=settings.SLACK_RATE, burst=settings.SLACK_BURST)
+
+        # Emails share SMTP sessions, and identical ones are sent once to
+        # all their recipients
+        self.mailer = mailer.MailQueue(settings.SIDELOADER_SMTP_HOST,
+            settings.SIDELOADER_SMTP_PORT, identity=settings.SIDELOADER_DOMAIN,
+            window=settings.SIDELOADER_MAIL_WINDOW,
+            retries=settings.SIDELOADER_MAIL_RETRIES,
+            backoff=settings.SIDELOADER_MAIL_RETRY_BACKOFF)
+
+        # Keep connections to Specter agents open between deployments
+        self.specter_pool = specter.createPool(
+            maxPerHost=settings.SPECTER_POOL_MAX_PER_HOST,
+            idleTimeout=settings.SPECTER_POOL_IDLE_TIMEOUT)
 
-    @defer.inlineCallbacks
     def sendEmail(self, to, content, subject):
         start = '<html><head></head><body style="font-family:arial,sans-serif;">'
         end = '</body></html>'
 
-        cont = MIMEText(start+content+end, 'html')
-
-        msg = MIMEMultipart('related')
-
-        msg['Subject'] = subject
-        msg['From'] = settings.SIDELOADER_FROM
-        msg['To'] = to
-        msg.attach(cont)
-
-        fr = settings.SIDELOADER_FROM.split('<')[-1].strip('>')
-
-        yield sendmail('localhost', fr, msg['To'], msg.as_string())
+        d = self.mailer.send(settings.SIDELOADER_FROM, to, subject,
+            start + content + end)
+        d.addErrback(log.err, 'Could not send %r to %s' % (subject, to))
+        return d
 
     @defer.inlineCallbacks
     def sendNotification(self, message, project_id):
@@ -106,10 +227,7 @@ class Plugin(RhumbaPlugin):
                 else:
                     channel=settings.SLACK_CHANNEL
 
-                sc = slack.SlackClient(settings.SLACK_HOST,
-                        settings.SLACK_TOKEN, channel)
-
-                yield sc.message(name + ": " + message)
+                self.slack.notify(channel, name + ": " + message)
 
 
     def sendSignEmail(self, to, name, release, h):
@@ -156,7 +274,7 @@ class Plugin(RhumbaPlugin):
         build = yield self.db.getBuild(build_id)
         flow = yield self.db.getFlow(flow_id)
 
-        release_id = yield self.db.createRelease({
+        [release_id] = yield self.db.createRelease({
             'flow_id': flow_id,
             'build_id': build_id,
             'waiting': True,
@@ -165,8 +283,12 @@ class Plugin(RhumbaPlugin):
             'lock': False
         })
 
+        release = yield self.db.getRelease(release_id)
+
         if scheduled:
-            release = yield self.db.getRelease(release_id)
+            self.scheduler.schedule(release_id,
+                scheduler.releaseTime(release['scheduled']))
+
             reactor.callLater(0, self.sendNotification,
                 'Deployment scheduled for build %s at %s UTC to %s' % (
                     build['build_file'],
@@ -198,6 +320,37 @@ class Plugin(RhumbaPlugin):
                 reactor.callLater(0, self.sendSignEmail,
                     email, project['name'], flow['name'], h)
 
+        if not scheduled:
+            self.scheduler.schedule(release_id)
+
+    def getSpecter(self, server, output=None):
+        return specter.SpecterClient(server['name'],
+                settings.SPECTER_AUTHCODE, settings.SPECTER_SECRET,
+                pool=self.specter_pool,
+                connectTimeout=settings.SPECTER_CONNECT_TIMEOUT,
+                readTimeout=settings.SPECTER_READ_TIMEOUT,
+                retries=settings.SPECTER_RETRIES,
+                backoff=settings.SPECTER_RETRY_BACKOFF,
+                maxBackoff=settings.SPECTER_RETRY_MAX_BACKOFF,
+                maxMemory=settings.SPECTER_SPOOL_SIZE,
+                maxOutput=settings.SPECTER_MAX_OUTPUT,
+                output=output)
+
+    def getRolloutWaves(self, flow, targets):
+        """
+        Splits a flow's targets into the waves they are deployed in
+        """
+        targets = sorted(targets, key=lambda t: t['id'])
+        size = flow['rollout_batch']
+
+        if size <= 0 or not targets:
+            return [targets]
+
+        if flow['rollout_batch_percent']:
+            size = int(math.ceil(len(targets) * min(size, 100) / 100.0))
+
+        return [targets[i:i + size] for i in range(0, len(targets), size)]
+
     @defer.inlineCallbacks
     def pushTargets(self, release, flow):
         """
@@ -205,131 +358,172 @@ class Plugin(RhumbaPlugin):
         """
         targets = yield self.db.getFlowTargets(flow['id'])
         project = yield self.db.getProject(flow['project_id'])
+        build = yield self.db.getBuild(release['build_id'])
 
-        for target in targets:
-            server = yield self.db.getServer(target['server_id'])
+        # Deploy to up to max_parallel_targets servers at a time
+        sem = defer.DeferredSemaphore(max(flow['max_parallel_targets'], 1))
 
-            self.log("Deploing release %s to target %s" % (repr(release), server['name']))
+        waves = self.getRolloutWaves(flow, targets)
+        failed = 0
 
-            build = yield self.db.getBuild(release['build_id'])
+        for i, wave in enumerate(waves):
+            results = yield defer.DeferredList([
+                sem.run(self.pushTarget, release, flow, project, build, target
+                    ).addErrback(log.err)
+                for target in wave
+            ])
 
-            yield self.sendNotification(
-                'Deployment started for build %s -> %s' % (
-                    build['build_file'],
-                    server['name']
-                ),
-                project['id']
-            )
+            failed += len([r for ok, r in results if not r])
 
-            yield self.db.updateTargetState(target['id'], 1)
+            remaining = sum([len(w) for w in waves[i + 1:]])
+            if remaining and (failed > flow['rollout_max_failures']):
+                self.log("Aborting release %s after %s failed targets" % (
+                    repr(release), failed))
 
-            sc = specter.SpecterClient(server['name'],
-                    settings.SPECTER_AUTHCODE, settings.SPECTER_SECRET)
+                yield self.sendNotification(
+                    'Rollout of build %s aborted after %s failed deployments,'
+                    ' %s servers were skipped' % (
+                        build['build_file'], failed, remaining
+                    ),
+                    project['id']
+                )
+                break
 
-            if project['package_name']:
-                package = project['package_name']
-            else:
-                url = project['github_url']
-                package = url.split(':')[1].split('/')[-1][:-4]
-            
-            url = "%s/%s" % (
-                settings.SIDELOADER_PACKAGEURL, 
-                build['build_file']
-            )
+        yield self.db.updateReleaseState(release['id'])
 
-            stop, start, restart, puppet = "", "", "", ""
+    @defer.inlineCallbacks
+    def pushTarget(self, release, flow, project, build, target):
+        """
+        Pushes a release to a single target, returns True if it succeeded
+        """
+        server = yield self.db.getServer(target['server_id'])
 
-            try:
-                if flow['service_pre_stop']:
-                    stop = yield sc.get_all_stop()
-                    stop = stop['stdout']
+        self.log("Deploing release %s to target %s" % (repr(release), server['name']))
 
-                result = yield sc.post_install({
-                    'package': package,
-                    'url': url
-                })
+        yield self.sendNotification(
+            'Deployment started for build %s -> %s' % (
+                build['build_file'],
+                server['name']
+            ),
+            project['id']
+        )
 
-                if ('error' in result) or (result.get('code',2) > 0) or (
-                    result.get('stderr') and not result.get('stdout')):
-                    # Errors during deployment
-                    yield self.db.updateTargetState(target['id'], 3)
-
-                    if 'error' in result:
-                        yield self.db.updateTargetLog(target['id'], 
-                            '\n'.join([stop, result['error']])
-                        )
-                    else:
-                        yield self.db.updateTargetLog(target['id'], 
-                            '\n'.join([
-                                stop, result['stdout'], result['stderr']
-                            ])
-                        )
-
-                    yield self.sendNotification(
-                        'Deployment of build %s to %s failed!' % (
-                            build['build_file'], server['name']
-                        ),
-                        project['id']
-                    )
+        yield self.db.updateTargetState(target['id'], 1)
+        yield self.db.updateTargetLog(target['id'], '')
 
-                    # Start services back up even on failure
-                    if flow['service_pre_stop']:
-                        start = yield sc.get_all_start()
-                        start = start['stdout']
-                else:
-                    if flow['puppet_run']:
-                        puppet = yield sc.get_puppet_run()
-                        puppet = puppet['stdout']
+        # Output goes into the log as it arrives, the summary replaces it
+        # once the deployment is done
+        sc = self.getSpecter(server, output=lambda key, text:
+            self.db.appendTargetLog(target['id'], text))
 
-                    if flow['service_pre_stop']:
-                        start = yield sc.get_all_start()
-                        start = start['stdout']
-                    elif flow['service_restart']:
-                        r1 = yield sc.get_all_stop()
-                        r2 = yield sc.get_all_start()
+        if project['package_name']:
+            package = project['package_name']
+        else:
+            url = project['github_url']
+            package = url.split(':')[1].split('/')[-1][:-4]
+        
+        url = "%s/%s" % (
+            settings.SIDELOADER_PACKAGEURL, 
+            build['build_file']
+        )
 
-                        restart = r1['stdout'] + r2['stdout']
+        stop, start, restart, puppet = "", "", "", ""
+        success = False
 
-                    yield self.db.updateTargetState(target['id'], 2)
+        try:
+            if flow['service_pre_stop']:
+                stop = yield sc.get_all_stop()
+                stop = stop['stdout']
+
+            result = yield sc.post_install({
+                'package': package,
+                'url': url
+            })
+
+            if ('error' in result) or (result.get('code',2) > 0) or (
+                result.get('stderr') and not result.get('stdout')):
+                # Errors during deployment
+                yield self.db.updateTargetState(target['id'], 3)
 
-                    yield self.db.updateTargetLog(target['id'],
-                        '\n'.join([
-                            stop, result['stdout'], result['stderr'], puppet,
-                            start, restart
+                if 'error' in result:
+                    yield self.db.updateTargetLog(target['id'], 
+                        '\n'.join(sc.history + [stop, result['error']])
+                    )
+                else:
+                    yield self.db.updateTargetLog(target['id'], 
+                        '\n'.join(sc.history + [
+                            stop, result['stdout'], result['stderr']
                         ])
                     )
 
-                    yield self.db.updateTargetBuild(target['id'], build['id'])
+                yield self.sendNotification(
+                    'Deployment of build %s to %s failed!' % (
+                        build['build_file'], server['name']
+                    ),
+                    project['id']
+                )
 
-                    yield self.sendNotification(
-                        'Deployment of build %s to %s complete' % (
-                            build['build_file'],
-                            server['name']
-                        ),
-                        project['id']
-                    )
+                # Start services back up even on failure
+                if flow['service_pre_stop']:
+                    start = yield sc.get_all_start()
+                    start = start['stdout']
+            else:
+                if flow['puppet_run']:
+                    puppet = yield sc.get_puppet_run()
+                    puppet = puppet['stdout']
+
+                if flow['service_pre_stop']:
+                    start = yield sc.get_all_start()
+                    start = start['stdout']
+                elif flow['service_restart']:
+                    r1 = yield sc.get_all_stop()
+                    r2 = yield sc.get_all_start()
 
-                yield self.db.updateServerStatus(server['id'], "Reachable")
+                    restart = r1['stdout'] + r2['stdout']
 
-            except Exception, e:
-                exc_type, exc_value, exc_traceback = sys.exc_info()
-                lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
+                yield self.db.updateTargetState(target['id'], 2)
 
-                yield self.db.updateTargetLog(target['id'], ''.join(lines))
-                yield self.db.updateTargetState(target['id'], 3)
+                yield self.db.updateTargetLog(target['id'],
+                    '\n'.join(sc.history + [
+                        stop, result['stdout'], result['stderr'], puppet,
+                        start, restart
+                    ])
+                )
+
+                yield self.db.updateTargetBuild(target['id'], build['id'])
 
-                yield self.db.updateServerStatus(server['id'], ''.join(lines))
-               
                 yield self.sendNotification(
-                    'Deployment of build %s to %s failed!' % (
+                    'Deployment of build %s to %s complete' % (
                         build['build_file'],
                         server['name']
                     ),
                     project['id']
                 )
 
+                success = True
 
-        yield self.db.updateReleaseState(release['id'])
+            yield self.db.updateServerStatus(server['id'], "Reachable")
+
+        except Exception, e:
+            success = False
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
+
+            yield self.db.updateTargetLog(target['id'],
+                ''.join([l + '\n' for l in sc.history] + lines))
+            yield self.db.updateTargetState(target['id'], 3)
+
+            yield self.db.updateServerStatus(server['id'], ''.join(lines))
+           
+            yield self.sendNotification(
+                'Deployment of build %s to %s failed!' % (
+                    build['build_file'],
+                    server['name']
+                ),
+                project['id']
+            )
+
+        defer.returnValue(success)
 
     @defer.inlineCallbacks
     def streamRelease(self, release):
@@ -358,30 +552,29 @@ class Plugin(RhumbaPlugin):
         yield self.db.updateReleaseState(release['id'])
 
     @defer.inlineCallbacks
-    def cleanRelease(self, release):
-        if release['waiting']:
-            flow = yield self.db.getFlow(release['flow_id'])
-            next_release = yield self.db.getNextFlowRelease(release['flow_id'])
-            last_release = yield self.db.getLastFlowRelease(release['flow_id'])
-
-            # Cleanup stale releases, deprecated by request date
-            if next_release:
-                if release['release_date'] < next_release['release_date']:
-                    yield self.db.updateReleaseState(release['id'])
+    def call_runrelease(self, params):
+        if params['release_id'] in self.running_releases:
+            return
 
-            if last_release:
-                if release['release_date'] < last_release['release_date']:
-                    yield self.db.updateReleaseState(release['id'])
+        self.running_releases.add(params['release_id'])
+        try:
+            yield self.runRelease(params['release_id'])
+        finally:
+            self.running_releases.discard(params['release_id'])
 
     @defer.inlineCallbacks
-    def call_runrelease(self, params):
-        release = yield self.db.getRelease(params['release_id'])
+    def runRelease(self, release_id):
+        release = yield self.db.getRelease(release_id)
         if release['waiting']:
             flow = yield self.db.getFlow(release['flow_id'])
 
             signoff = yield self.db.checkReleaseSignoff(release['id'], flow)
 
-            if self.db.checkReleaseSchedule(release) and signoff:
+            if not self.db.checkReleaseSchedule(release):
+                self.scheduler.schedule(release['id'],
+                    scheduler.releaseTime(release['scheduled']))
+
+            elif signoff:
                 yield self.db.updateReleaseLocks(release['id'], True)
 
                 addrs = self.db.getFlowNotifyList(flow)
@@ -407,6 +600,9 @@ class Plugin(RhumbaPlugin):
                 reactor.callLater(0, self.call_webhooks,
                                   {'release_id': release['id']})
 
+                # Releases may be queued up behind this one
+                self.scheduler.schedule(release['id'])
+
     @defer.inlineCallbacks
     def call_webhooks(self, params):
         release = yield self.db.getRelease(params['release_id'])
@@ -425,38 +621,91 @@ class Plugin(RhumbaPlugin):
             wh['method'], wh['url'], rsp.code, rsp_content))
         yield self.db.setWebhookResponse(wh['id'], rsp_content)
 
-    @cron(secs="*/10")
-    @defer.inlineCallbacks
+    def call_dbstats(self, params):
+        """
+        Reports how saturated the database connection pool is, for sizing
+        pool_min and pool_max against real load.
+        """
+        stats = self.db.stats()
+        self.log("DB pool: %(in_use)s/%(max)s in use, %(waiting)s waiting, "
+            "%(wait_avg).3fs average wait, %(wait_max).3fs max wait, "
+            "cache %(cache_hits)s hits %(cache_misses)s misses" % stats)
+        return stats
+
+    def call_invalidate(self, params):
+        """
+        Drops a row from the metadata cache when the web tier saves or
+        deletes it. This is queued when there's no log stream to
+        broadcast it over.
+        """
+        self.db.invalidate(params['table'], params.get('id'))
+
+    @cron(secs="*/60")
     def call_checkreleases(self, params):
-        releases = yield self.db.getReleases(waiting=True, lock=False)
+        """
+        Sweeps the release queue in case anything was missed, new releases
+        and scheduled ones falling due run the queue straight away.
+        """
+        return self.checkReleases()
+
+    def queueCheck(self, *a):
+        d = self.checkReleases()
+        d.addErrback(log.err, 'Release queue check failed')
+        return d
+
+    @defer.inlineCallbacks
+    def checkReleases(self):
+        """
+        Runs the release queue, or runs it again once the current run
+        finishes if one is in progress
+        """
+        self.recheck = True
+        if self.checking:
+            return
+
+        self.checking = True
+        try:
+            while self.recheck:
+                self.recheck = False
+                yield self.runReleaseQueue()
+        finally:
+            self.checking = False
+
+    @defer.inlineCallbacks
+    def runReleaseQueue(self):
+        releases = yield self.db.getReleaseQueue()
         #self.log("Release queue is at %s" % len(releases))
 
-        skip = []
+        # Clean old releases, deprecated by request date
+        yield self.db.expireReleases(
+            [release['id'] for release in releases if release['stale']])
 
-        # Clean old releases
         for release in releases:
-            yield self.cleanRelease(release)
+            if release['stale'] or (release['id'] in self.running_releases):
+                continue
 
-            current = yield self.db.countReleases(
-                release['flow_id'], waiting=True, lock=True)
+            if not self.db.checkReleaseSchedule(release):
+                # Wake up when it's due
+                self.scheduler.schedule(release['id'],
+                    scheduler.releaseTime(release['scheduled']))
+                continue
 
-            if current > 0:
+            if release['running'] > 0:
                 self.log("Skipping release %s on this run - %s in queue" % (
-                    repr(release), current))
-                skip.append(release['id'])
-
-        # Lock all the release objects we now see
-        r = yield self.db.getReleases(waiting=True, lock=False)
-        releases = [i for i in r if i['id'] not in skip]
+                    repr(release), release['running']))
+                continue
 
-        #for release in releases:
-        #    yield self.db.updateReleaseLocks(release['id'], True)
-
-        for release in releases:
             self.log("Running release %s" % repr(release))
             # XXX Use client queue
-            reactor.callLater(0, self.call_runrelease, 
-                {'release_id': release['id']})
+            d = self.call_runrelease({'release_id': release['id']})
+            d.addErrback(log.err, 'Release %s failed' % release['id'])
+
+    @defer.inlineCallbacks
+    def setBuildState(self, build_id, state):
+        yield self.db.setBuildState(build_id, state)
+
+        if self.log_stream:
+            self.log_stream.publishState(build_id, state)
 
     @defer.inlineCallbacks
     def endBuild(self, code, project_id, build_id, idhash):
@@ -466,10 +715,8 @@ class Plugin(RhumbaPlugin):
         project = yield self.db.getProject(project_id)
         dtype = project['deploy_type']
 
-        del self.build_locks[project_id]
-
         if code != 0:
-            yield self.db.setBuildState(build_id, 2)
+            yield self.setBuildState(build_id, 2)
 
             reactor.callLater(0, self.sendNotification,
                 'Build <http://%s/projects/build/view/%s|#%s> failed' % (
@@ -482,7 +729,7 @@ class Plugin(RhumbaPlugin):
 
             if dtype == 'docker':
                 yield self.db.setBuildFile(build_id, project['package_name'])
-                yield self.db.setBuildState(build_id, 1)
+                yield self.setBuildState(build_id, 1)
 
                 flows = yield self.db.getAutoFlows(project_id)
                 if flows:
@@ -498,7 +745,7 @@ class Plugin(RhumbaPlugin):
 
                 if not debs:
                     # We must have failed actually
-                    yield self.db.setBuildState(build_id, 2)
+                    yield self.setBuildState(build_id, 2)
 
                     reactor.callLater(0, self.sendNotification,
                         'Build <http://%s/projects/build/view/%s|#%s> failed' % (
@@ -509,7 +756,7 @@ class Plugin(RhumbaPlugin):
                     deb = debs[0]
 
                     yield self.db.setBuildFile(build_id, deb)
-                    yield self.db.setBuildState(build_id, 1)
+                    yield self.setBuildState(build_id, 1)
 
                     reactor.callLater(0, self.sendNotification,
                         'Build <http://%s/projects/build/view/%s|#%s> successful' % (
@@ -529,8 +776,140 @@ class Plugin(RhumbaPlugin):
                             reactor.callLater(0, self.doRelease, build_id,
                                 flow['id'])
 
+    def workerAlive(self, build_id, worker, stale):
+        """
+        Checks whether the worker which claimed a build still has it. We
+        can look at processes on our own host, anything else has to keep
+        up its heartbeat.
+        """
+        if worker == self.worker_id:
+            return build_id in self.running_builds
+
+        host, pid = worker.rsplit(':', 1)
+        if host != self.hostname:
+            return not stale
+
+        try:
+            os.kill(int(pid), 0)
+        except OSError, e:
+            return e.errno == errno.EPERM
+        return True
+
+    @defer.inlineCallbacks
+    def claimBuild(self, build_id, project_id):
+        """
+        Claims a build for this worker, first failing any build of the same
+        project whose worker has gone away. Returns the build as it was
+        claimed, or None if we didn't get it.
+        """
+        running = yield self.db.getRunningBuilds(
+            project_id, self.build_timeout)
+        for id, worker, stale in running:
+            if not self.workerAlive(id, worker, stale):
+                self.log("Expiring build %s, %s is gone" % (id, worker))
+                yield self.db.expireBuild(id, worker)
+
+        claimed = yield self.db.claimBuild(build_id, self.worker_id)
+        if claimed:
+            self.running_builds.add(build_id)
+            if self.heartbeat_call is None:
+                self.heartbeat_call = reactor.callLater(
+                    self.build_timeout / 4.0, self.heartbeat)
+
+        defer.returnValue(claimed)
+
+    def heartbeat(self):
+        """ Keeps our claims on running builds alive """
+        d = self.db.beatBuilds(self.worker_id)
+        d.addErrback(log.err)
+        self.heartbeat_call = reactor.callLater(
+            self.build_timeout / 4.0, self.heartbeat)
+        return d
+
+    @defer.inlineCallbacks
+    def resolveCommit(self, url, branch):
+        """
+        Finds the commit at the head of a branch, or None if we can't
+        """
+        try:
+            out, err, code = yield utils.getProcessOutputAndValue('git',
+                ['ls-remote', url, 'refs/heads/%s' % branch], env=os.environ)
+        except Exception, e:
+            self.log("Could not resolve %s %s: %s" % (url, branch, e))
+            defer.returnValue(None)
+
+        if code != 0 or not out.strip():
+            defer.returnValue(None)
+
+        defer.returnValue(out.split()[0])
+
+    def buildCommand(self, args):
+        """
+        Wraps build_package in whichever of systemd-run, nice and ionice we
+        have, so that builds running together can't starve each other or
+        the worker
+        """
+        cmd = [self.buildpack] + args[1:]
+
+        ionice = procutils.which('ionice')
+        if self.build_ionice is not None and ionice:
+            # -t: still build if we're not allowed to set the IO class
+            cmd = [ionice[0], '-c', '2', '-n', str(self.build_ionice),
+                '-t'] + cmd
+
+        nice = procutils.which('nice')
+        if self.build_nice and nice:
+            cmd = [nice[0], '-n', str(self.build_nice)] + cmd
+
+        systemd_run = procutils.which('systemd-run')
+        if self.build_cpu_quota and systemd_run:
+            cmd = [systemd_run[0], '--scope', '--quiet',
+                '-p', 'CPUQuota=%s' % self.build_cpu_quota] + cmd
+
+        return cmd
+
+    @defer.inlineCallbacks
+    def runBuild(self, build_id, build, project, queued):
+        """
+        Runs a build once it has a worker, and holds on to the worker until
+        the build has ended
+        """
+        waited = time.time() - queued
+        self.build_stats['builds'] += 1
+        self.build_stats['wait_total'] += waited
+        self.build_stats['wait_max'] = max(
+            self.build_stats['wait_max'], waited)
+        self.log("Starting build %s after %.1fs in the queue" % (
+            build_id, waited))
+
+        try:
+            try:
+                yield self.doBuild(build_id, build, project, waited)
+            except Exception, e:
+                yield self.db.updateBuildLog(build_id, str(e))
+                yield self.endBuild(11, project['id'], build_id,
+                    project['idhash'])
+        finally:
+            # Stop renewing our claim even if the build couldn't be ended
+            self.running_builds.discard(build_id)
+            if not self.running_builds and self.heartbeat_call:
+                self.heartbeat_call.cancel()
+                self.heartbeat_call = None
+
+            # Anything asked for while we were building has waited for us
+            d = self.db.getPendingBuild(project['id'])
+            d.addCallback(self.startPendingBuild)
+            d.addErrback(log.err,
+                'Could not start the next build of project %s' % project['id'])
+
+    def startPendingBuild(self, build_id):
+        if build_id:
+            d = task.deferLater(reactor, 0, self.call_build,
+                {'build_id': build_id})
+            d.addErrback(log.err, 'Build %s failed to start' % build_id)
+
     @defer.inlineCallbacks
-    def doBuild(self, build_id, build, project):
+    def doBuild(self, build_id, build, project, waited=0):
         project_id = project['id']
         
         try:
@@ -563,6 +942,20 @@ class Plugin(RhumbaPlugin):
         args = ['build_package', '--branch', project['branch'], '--build',
             str(build_num), '--id', project['idhash']]
 
+        # Webhooks record the commit they were pushed, otherwise we build
+        # whatever the branch points at now
+        commit = build['commit']
+        if not commit:
+            commit = yield self.resolveCommit(
+                project['github_url'], project['branch'])
+            if commit:
+                yield self.db.setBuildCommit(build_id, commit)
+        if commit:
+            args.extend(['--commit', commit])
+
+        if not self.reuse_artifacts:
+            args.append('--no-reuse')
+
         if project['deploy_file']:
             args.extend(['--deploy-file', project['deploy_file']])
 
@@ -586,10 +979,18 @@ class Plugin(RhumbaPlugin):
             self.buildpack, repr(args)))
 
         buildProcess = BuildProcess(build_id, project_id, project['idhash'],
-            self.db, self.endBuild)
+            self.db, self.endBuild, flush_interval=self.log_flush_interval,
+            flush_size=self.log_flush_size, publisher=self.log_stream)
+
+        if waited >= 1:
+            buildProcess.bufferLog(
+                "Waited %.1fs for a build worker\n" % waited)
 
-        proc = reactor.spawnProcess(buildProcess, self.buildpack,
-            args=args, path=self.local_path, env=os.environ)
+        cmd = self.buildCommand(args)
+        reactor.spawnProcess(buildProcess, cmd[0],
+            args=cmd, path=self.local_path, env=os.environ)
+
+        yield buildProcess.finished
 
     @defer.inlineCallbacks
     def call_build(self, params):
@@ -602,17 +1003,38 @@ class Plugin(RhumbaPlugin):
         build = yield self.db.getBuild(build_id)
         project_id = build['project_id']
 
-        if project_id in self.build_locks:
-            if (time.time() - self.build_locks[project_id]) < 1800:
-                # Don't build
-                defer.returnValue(None)
-
-        self.build_locks[project_id] = time.time()
+        # Pushes are folded into this build until it's claimed, so build
+        # what it looked like then rather than what we read above
+        build = yield self.claimBuild(build_id, project_id)
+        if not build:
+            # It's been started already, or it will be once the project's
+            # current build ends
+            defer.returnValue(None)
 
         project = yield self.db.getProject(project_id)
 
-        try:
-            yield self.doBuild(build_id, build, project)
-        except Exception, e:
-            yield self.db.updateBuildLog(build_id, str(e))
-            yield self.endBuild(11, project_id, build_id, project['idhash'])
+        # Waiting for a worker shouldn't hold up the rest of the task queue
+        d = self.build_pool.run(
+            self.runBuild, build_id, build, project, time.time())
+        d.addErrback(log.err, 'Build %s failed' % build_id)
+
+    def call_buildstats(self, params):
+        """
+        Reports how busy the build workers are and how long builds wait for
+        one, for sizing build_workers
+        """
+        pool = self.build_pool
+        builds = self.build_stats['builds']
+        stats = {
+            'workers': pool.limit,
+            'running': pool.limit - pool.tokens,
+            'waiting': len(pool.waiting),
+            'builds': builds,
+            'wait_avg': (self.build_stats['wait_total'] / builds
+                if builds else 0.0),
+            'wait_max': self.build_stats['wait_max'],
+        }
+        self.log("Builds: %(running)s/%(workers)s running, %(waiting)s "
+            "waiting, %(wait_avg).1fs average wait, %(wait_max).1fs max "
+            "wait" % stats)
+        return stats
@@ -46,6 +46,10 @@ RELEASEFLOW_QA = {
     'service_pre_stop': False,
     'puppet_run': True,
     'auto_release': True,
+    'max_parallel_targets': 1,
+    'rollout_batch': 0,
+    'rollout_batch_percent': False,
+    'rollout_max_failures': 0,
 }
 
 RELEASEFLOW_PROD = {
@@ -63,6 +67,10 @@ RELEASEFLOW_PROD = {
     'service_pre_stop': False,
     'puppet_run': True,
     'auto_release': False,
+    'max_parallel_targets': 1,
+    'rollout_batch': 0,
+    'rollout_batch_percent': False,
+    'rollout_max_failures': 0,
 }
 
 BUILD_1 = {
@@ -73,6 +81,9 @@ BUILD_1 = {
     'project_id': 1,
     'state': 0,
     'build_file': '',
+    'commit': '',
+    'worker': '',
+    'heartbeat': None,
 }
 
 RELEASE_1 = {
@@ -108,3 +119,22 @@ WEBHOOK_QA_2 = {
     'after_id': None,
     'last_response': '',
 }
+
+SERVER_1 = {
+    'id': 1,
+    'name': 'server1.example.com',
+    'last_checkin': datetime_utc(2016, 4, 1, 0, 0, 0),
+    'last_puppet_run': datetime_utc(2016, 4, 1, 0, 0, 0),
+    'status': '',
+    'change': True,
+    'specter_status': '',
+}
+
+TARGET_1 = {
+    'id': 1,
+    'server_id': 1,
+    'release_id': RELEASEFLOW_QA['id'],
+    'deploy_state': 0,
+    'current_build_id': None,
+    'log': '',
+}
@@ -1,8 +1,11 @@
 from copy import deepcopy
 from functools import wraps
+import time
 
 from twisted.internet import task
 
+from sideloader.task_db import BUILD_FIELDS, TARGET_FIELDS
+
 
 def async(f):
     """
@@ -14,6 +17,10 @@ def async(f):
     return wrapper
 
 
+def project(row, fields):
+    return dict((field, deepcopy(row[field])) for field in fields)
+
+
 class FakeDB(object):
     """
     A test double for sideloader.task_db.
@@ -24,10 +31,13 @@ class FakeDB(object):
         self._releasestream = {}
         self._project = {}
         self._build = {}
+        self._buildlogchunk = {}
         self._buildnumbers = {}
         self._releaseflow = {}
         self._release = {}
         self._webhook = {}
+        self._server = {}
+        self._target = {}
 
     def _set_id(self, table, row):
         if 'id' not in row:
@@ -43,6 +53,12 @@ class FakeDB(object):
         tbl[id] = row
         return (id,)
 
+    def stats(self):
+        return {
+            'min': 0, 'max': 0, 'waiting': 0, 'in_use': 0, 'requests': 0,
+            'wait_total': 0.0, 'wait_max': 0.0, 'wait_avg': 0.0,
+        }
+
     # Project queries
 
     @async
@@ -54,6 +70,17 @@ class FakeDB(object):
         if id in self._build:
             self._build[id]['log'] = data
 
+    @async
+    def appendBuildLog(self, id, seq, offset, data):
+        if id in self._build:
+            assert (id, seq) not in self._buildlogchunk
+            self._buildlogchunk[(id, seq)] = data
+
+    @async
+    def getBuildLog(self, id):
+        return ''.join([self._buildlogchunk[k]
+                        for k in sorted(self._buildlogchunk) if k[0] == id])
+
     @async
     def getProjectNotificationSettings(self, id):
         prj = self._project[id]
@@ -62,8 +89,8 @@ class FakeDB(object):
     # Build queries
 
     @async
-    def getBuild(self, id):
-        return deepcopy(self._build[id])
+    def getBuild(self, id, fields=BUILD_FIELDS):
+        return project(self._build[id], fields)
 
     @async
     def getBuildNumber(self, repo):
@@ -88,6 +115,52 @@ class FakeDB(object):
         if id in self._build:
             self._build[id]['build_file'] = file
 
+    @async
+    def setBuildCommit(self, id, commit):
+        if id in self._build:
+            self._build[id]['commit'] = commit
+
+    @async
+    def claimBuild(self, id, worker, fields=BUILD_FIELDS):
+        build = self._build.get(id)
+        if build is None or build['state'] != 0 or build['worker']:
+            return None
+        for other in self._build.values():
+            if (other['project_id'] == build['project_id']
+                    and other['state'] == 0 and other['worker']):
+                return None
+        build['worker'] = worker
+        build['heartbeat'] = self.clock.seconds()
+        return project(build, fields)
+
+    @async
+    def getRunningBuilds(self, project_id, timeout):
+        now = self.clock.seconds()
+        return [(b['id'], b['worker'], b['heartbeat'] < now - timeout)
+                for _, b in sorted(self._build.items())
+                if b['project_id'] == project_id and b['state'] == 0
+                and b['worker']]
+
+    @async
+    def getPendingBuild(self, project_id):
+        for _, b in sorted(self._build.items()):
+            if (b['project_id'] == project_id and b['state'] == 0
+                    and not b['worker']):
+                return b['id']
+        return None
+
+    @async
+    def beatBuilds(self, worker):
+        for b in self._build.values():
+            if b['worker'] == worker and b['state'] == 0:
+                b['heartbeat'] = self.clock.seconds()
+
+    @async
+    def expireBuild(self, id, worker):
+        b = self._build.get(id)
+        if b and b['worker'] == worker and b['state'] == 0:
+            b['state'] = 2
+
     # Release queries
 
     def createRelease(self, release):
@@ -97,7 +170,9 @@ class FakeDB(object):
     def checkReleaseSchedule(self, release):
         if not release['scheduled']:
             return True
-        raise NotImplementedError("TODO")
+
+        t = int(time.mktime(release['scheduled'].timetuple()))
+        return (time.time() - t) > 0
 
     def releaseSignoffCount(self, release_id):
         raise NotImplementedError("TODO")
@@ -111,12 +186,6 @@ class FakeDB(object):
             return True
         raise NotImplementedError("TODO")
 
-    def countReleases(self, id, waiting=False, lock=False):
-        raise NotImplementedError("TODO")
-
-    def getReleases(self, flowid=None, waiting=None, lock=None):
-        raise NotImplementedError("TODO")
-
     @async
     def getRelease(self, id):
         return deepcopy(self._release[id])
@@ -137,6 +206,39 @@ class FakeDB(object):
         self._release[id]['lock'] = lock
         self._release[id]['waiting'] = waiting
 
+    @async
+    def getReleaseQueue(self):
+        queue = []
+        for id in sorted(self._release):
+            release = self._release[id]
+            if not release['waiting'] or release['lock']:
+                continue
+
+            flow = [r for r in self._release.values()
+                    if r['flow_id'] == release['flow_id']]
+
+            queue.append({
+                'id': id,
+                'release_date': release['release_date'],
+                'scheduled': release['scheduled'],
+                'build_id': release['build_id'],
+                'flow_id': release['flow_id'],
+                'stale': any(r['release_date'] > release['release_date']
+                             for r in flow),
+                'running': len([r for r in flow
+                                if r['waiting'] and r['lock']]),
+            })
+
+        return queue
+
+    @async
+    def expireReleases(self, ids):
+        for id in ids:
+            if id not in self._release:
+                continue
+            self._release[id]['lock'] = False
+            self._release[id]['waiting'] = False
+
     # Flow queries
 
     @async
@@ -159,31 +261,43 @@ class FakeDB(object):
         return [flow for flow in self._releaseflow.values()
                 if flow['auto_release'] and flow['project_id'] == id]
 
-    def getNextFlowRelease(self, flow_id):
-        raise NotImplementedError("TODO")
-
-    def getLastFlowRelease(self, flow_id):
-        raise NotImplementedError("TODO")
-
     # Targets
 
-    def getFlowTargets(self, flow_id):
-        raise NotImplementedError("TODO")
+    @async
+    def getFlowTargets(self, flow_id, fields=TARGET_FIELDS):
+        return [project(target, fields) for target in self._target.values()
+                if target['release_id'] == flow_id]
 
+    @async
     def getServer(self, id):
-        raise NotImplementedError("TODO")
+        if id in self._server:
+            return deepcopy(self._server[id])
+        return None
 
+    @async
     def updateTargetState(self, id, state):
-        raise NotImplementedError("TODO")
+        if id in self._target:
+            self._target[id]['deploy_state'] = int(state)
 
+    @async
     def updateTargetLog(self, id, log):
-        raise NotImplementedError("TODO")
+        if id in self._target:
+            self._target[id]['log'] = log
 
+    @async
+    def appendTargetLog(self, id, log):
+        if id in self._target:
+            self._target[id]['log'] += log
+
+    @async
     def updateTargetBuild(self, id, build):
-        raise NotImplementedError("TODO")
+        if id in self._target:
+            self._target[id]['current_build_id'] = build
 
+    @async
     def updateServerStatus(self, id, status):
-        raise NotImplementedError("TODO")
+        if id in self._server:
+            self._server[id]['status'] = status
 
     # Webhooks
 
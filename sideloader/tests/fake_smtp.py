@@ -0,0 +1,110 @@
+"""
+A fake SMTP server to point MailQueue at.
+"""
+
+from twisted.internet import defer, protocol, reactor
+from twisted.protocols import basic
+
+
+class FakeSMTPProtocol(basic.LineReceiver):
+    delimiter = '\r\n'
+
+    def connectionMade(self):
+        self.server = self.factory.server
+        self.server.connections += 1
+        self.closed = defer.Deferred()
+        self.server.sessions.append(self.closed)
+        self.mailFrom = None
+        self.rcpts = []
+        self.data = None
+        self.reply(self.server.next_reply('connect', 220))
+
+    def connectionLost(self, reason):
+        self.closed.callback(None)
+
+    def reply(self, code, text='OK'):
+        self.sendLine('%d %s' % (code, text))
+        if code == 421:
+            self.transport.loseConnection()
+
+    def lineReceived(self, line):
+        if self.data is not None:
+            if line == '.':
+                self.endData()
+            else:
+                self.data.append(line[1:] if line.startswith('..') else line)
+            return
+
+        command = line.split(' ', 1)[0].upper()
+        self.server.commands.append(command)
+
+        if command == 'HELO':
+            self.reply(250)
+        elif command == 'MAIL':
+            self.mailFrom = line.split(':', 1)[1].strip('<>')
+            self.reply(self.server.next_reply('mail', 250))
+        elif command == 'RCPT':
+            rcpt = line.split(':', 1)[1].strip('<>')
+            code = self.server.rcpt_codes.get(rcpt, [250])
+            code = code.pop(0) if len(code) > 1 else code[0]
+            if code == 250:
+                self.rcpts.append(rcpt)
+            self.reply(code)
+        elif command == 'DATA':
+            self.data = []
+            self.reply(354, 'Go ahead')
+        elif command == 'RSET':
+            self.mailFrom = None
+            self.rcpts = []
+            self.reply(250)
+        elif command == 'QUIT':
+            self.reply(221, 'Bye')
+            self.transport.loseConnection()
+        else:
+            self.reply(500, 'Unknown command')
+
+    def endData(self):
+        data, self.data = '\n'.join(self.data), None
+        code = self.server.next_reply('data', 250)
+        if code == 250:
+            self.server.messages.append((self.mailFrom, self.rcpts, data))
+        self.reply(code)
+
+
+class FakeSMTP(object):
+    """
+    An SMTP server which keeps the messages it accepts and counts its
+    connections. Replies can be overridden for the next few commands of a
+    kind through `replies`, and for recipients through `rcpt_codes`.
+    """
+
+    def __init__(self):
+        self.connections = 0
+        self.sessions = []
+        self.commands = []
+        self.messages = []
+        self.replies = {}
+        self.rcpt_codes = {}
+        self._listener = None
+        self.port = None
+
+    @defer.inlineCallbacks
+    def start(self):
+        factory = protocol.ServerFactory()
+        factory.protocol = FakeSMTPProtocol
+        factory.server = self
+        factory.noisy = False
+        self._listener = yield reactor.listenTCP(
+            0, factory, interface='127.0.0.1')
+        self.port = self._listener.getHost().port
+
+    def stop(self):
+        """ Stops listening once every session has been closed """
+        d = defer.gatherResults(self.sessions)
+        d.addCallback(lambda _: self._listener.stopListening())
+        return d
+
+    def next_reply(self, kind, default):
+        if self.replies.get(kind):
+            return self.replies[kind].pop(0)
+        return default
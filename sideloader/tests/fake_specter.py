@@ -0,0 +1,99 @@
+"""
+A fake Specter agent to point SpecterClient at.
+"""
+
+import json
+
+from twisted.internet import defer, reactor
+from twisted.web import resource, server
+
+
+class FakeSpecterResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, specter):
+        resource.Resource.__init__(self)
+        self.specter = specter
+
+    def render(self, request):
+        self.specter.requests.append((request.method, request.path))
+        body = json.dumps(self.specter.response_for(request))
+        request.setHeader('Content-Type', 'application/json')
+
+        delay = self.specter.next_delay()
+        if delay:
+            def finish():
+                if not finished:
+                    request.write(body)
+                    request.finish()
+
+            def done(result):
+                finished.append(result)
+                self.specter.active -= 1
+            finished = []
+            self.specter.active += 1
+            self.specter.max_active = max(
+                self.specter.max_active, self.specter.active)
+            request.notifyFinish().addBoth(done)
+            self.specter.pending.append(reactor.callLater(delay, finish))
+            return server.NOT_DONE_YET
+
+        return body
+
+
+class FakeSpecter(object):
+    """
+    A webserver which answers Specter requests and counts the connections
+    it accepts. Responses are delayed by the next value in `delays`, or
+    by `delay` once that's exhausted, and the most delayed requests open
+    at once is kept in `max_active`.
+    """
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.delays = []
+        self.pending = []
+        self.requests = []
+        self.responses = {}
+        self.connections = 0
+        self.active = 0
+        self.max_active = 0
+        self._webserver = None
+        self.port = None
+
+    @defer.inlineCallbacks
+    def start(self):
+        site = server.Site(FakeSpecterResource(self))
+        site.noisy = False
+
+        buildProtocol = site.buildProtocol
+
+        def countingBuildProtocol(addr):
+            self.connections += 1
+            return buildProtocol(addr)
+
+        site.buildProtocol = countingBuildProtocol
+
+        self._webserver = yield reactor.listenTCP(
+            0, site, interface='127.0.0.1')
+        self.port = self._webserver.getHost().port
+
+    def stop(self):
+        for call in self.pending:
+            if call.active():
+                call.cancel()
+        return self._webserver.stopListening()
+
+    def next_delay(self):
+        if self.delays:
+            return self.delays.pop(0)
+        return self.delay
+
+    def response_for(self, request):
+        if request.path in self.responses:
+            return self.responses[request.path]
+        return {
+            'stdout': '%s %s' % (request.method, request.path),
+            'stderr': '',
+            'code': 0,
+        }
@@ -3,6 +3,7 @@ Some tools for working with repos in tests.
 """
 
 import os
+import subprocess
 
 
 class LocalRepo(object):
@@ -42,3 +43,7 @@ class LocalRepo(object):
 
     def commit(self, msg):
         self.run_in_dir("git commit -a -m '%s'" % (msg,))
+
+    def head(self):
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=self.path).strip()
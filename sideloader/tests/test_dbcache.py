@@ -0,0 +1,182 @@
+"""
+Tests for sideloader.dbcache.
+"""
+
+from twisted.internet import defer, reactor, task
+from twisted.trial import unittest
+
+from sideloader import dbcache
+from sideloader.tests import fake_db
+from sideloader.tests.fake_data import (
+    RELEASESTREAM_QA, PROJECT_SIDELOADER, RELEASEFLOW_QA, SERVER_1)
+from sideloader.tests.utils import dictmerge
+
+
+class CountingDB(fake_db.FakeDB):
+    """
+    A FakeDB which counts the queries it answers.
+    """
+    def __init__(self, clock):
+        fake_db.FakeDB.__init__(self, clock)
+        self.queries = []
+
+    def getProject(self, id):
+        self.queries.append(('getProject', id))
+        return fake_db.FakeDB.getProject(self, id)
+
+    def getServer(self, id):
+        self.queries.append(('getServer', id))
+        return fake_db.FakeDB.getServer(self, id)
+
+
+class TestCachedDB(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.db = CountingDB(reactor)
+        self.cache = dbcache.CachedDB(self.db, ttl=60, clock=self.clock)
+
+    @defer.inlineCallbacks
+    def setup_rows(self):
+        yield self.cache.runInsert(
+            'sideloader_releasestream', RELEASESTREAM_QA)
+        yield self.cache.runInsert('sideloader_project', PROJECT_SIDELOADER)
+        yield self.cache.runInsert('sideloader_releaseflow', RELEASEFLOW_QA)
+        yield self.cache.runInsert('sideloader_server', SERVER_1)
+
+    @defer.inlineCallbacks
+    def test_hit(self):
+        """
+        Rows are only fetched once while they're fresh.
+        """
+        yield self.setup_rows()
+        project = yield self.cache.getProject(1)
+        assert project == PROJECT_SIDELOADER
+        project = yield self.cache.getProject(1)
+        assert project == PROJECT_SIDELOADER
+        assert self.db.queries == [('getProject', 1)]
+        assert (self.cache.hits, self.cache.misses) == (1, 1)
+
+        stream = yield self.cache.getReleaseStream(1)
+        stream = yield self.cache.getReleaseStream(1)
+        assert stream == RELEASESTREAM_QA
+        flow = yield self.cache.getFlow(1)
+        flow = yield self.cache.getFlow(1)
+        assert flow['name'] == RELEASEFLOW_QA['name']
+        assert (self.cache.hits, self.cache.misses) == (3, 3)
+
+    @defer.inlineCallbacks
+    def test_expiry(self):
+        """
+        Rows are fetched again once they're older than the TTL.
+        """
+        yield self.setup_rows()
+        yield self.cache.getProject(1)
+        self.clock.advance(59)
+        yield self.cache.getProject(1)
+        self.clock.advance(1)
+        yield self.cache.getProject(1)
+        assert self.db.queries == [('getProject', 1), ('getProject', 1)]
+
+    @defer.inlineCallbacks
+    def test_no_ttl(self):
+        """
+        A TTL of zero turns caching off.
+        """
+        yield self.setup_rows()
+        self.cache.ttl = 0
+        yield self.cache.getProject(1)
+        yield self.cache.getProject(1)
+        assert len(self.db.queries) == 2
+
+    @defer.inlineCallbacks
+    def test_invalidate(self):
+        """
+        Invalidated rows are fetched again, other rows are kept.
+        """
+        yield self.setup_rows()
+        yield self.cache.getProject(1)
+        yield self.cache.getProjectNotificationSettings(1)
+        yield self.cache.getServer(1)
+
+        self.db._project[1]['name'] = 'renamed'
+        self.cache.invalidate('sideloader_project', 1)
+
+        project = yield self.cache.getProject(1)
+        assert project['name'] == 'renamed'
+        (name, notify, channel
+            ) = yield self.cache.getProjectNotificationSettings(1)
+        assert name == 'renamed'
+        yield self.cache.getServer(1)
+        assert self.db.queries == [
+            ('getProject', 1), ('getServer', 1), ('getProject', 1)]
+
+        self.cache.invalidate('sideloader_server')
+        yield self.cache.getServer(1)
+        assert self.db.queries[-1] == ('getServer', 1)
+
+    @defer.inlineCallbacks
+    def test_invalidate_during_fetch(self):
+        """
+        A row invalidated while it's being fetched isn't kept.
+        """
+        yield self.setup_rows()
+        d = self.cache.getProject(1)
+        self.cache.invalidate('sideloader_project', 1)
+        yield d
+        yield self.cache.getProject(1)
+        assert len(self.db.queries) == 2
+
+    @defer.inlineCallbacks
+    def test_concurrent_misses(self):
+        """
+        Lookups for a row which is already being fetched share the fetch.
+        """
+        yield self.setup_rows()
+        projects = yield defer.gatherResults([
+            self.cache.getProject(1) for i in range(3)])
+        assert projects == [PROJECT_SIDELOADER] * 3
+        assert self.db.queries == [('getProject', 1)]
+
+    @defer.inlineCallbacks
+    def test_errors_not_cached(self):
+        """
+        Failed lookups fail every waiter, and are tried again next time.
+        """
+        ds = [self.cache.getProject(1) for i in range(2)]
+        for d in ds:
+            yield self.assertFailure(d, KeyError)
+        yield self.setup_rows()
+        project = yield self.cache.getProject(1)
+        assert project == PROJECT_SIDELOADER
+
+    @defer.inlineCallbacks
+    def test_missing_not_cached(self):
+        """
+        Servers which don't exist yet aren't remembered as missing.
+        """
+        server = yield self.cache.getServer(1)
+        assert server is None
+        yield self.setup_rows()
+        server = yield self.cache.getServer(1)
+        assert server == SERVER_1
+
+    @defer.inlineCallbacks
+    def test_updateServerStatus(self):
+        """
+        Our own server updates invalidate the server.
+        """
+        yield self.setup_rows()
+        yield self.cache.getServer(1)
+        yield self.cache.updateServerStatus(1, 'Reachable')
+        server = yield self.cache.getServer(1)
+        assert server == dictmerge(SERVER_1, status='Reachable')
+
+    def test_stats(self):
+        """
+        Hit and miss counts are reported with the pool's counters.
+        """
+        stats = self.cache.stats()
+        assert stats['cache_hits'] == 0
+        assert stats['cache_misses'] == 0
+        assert stats['in_use'] == 0
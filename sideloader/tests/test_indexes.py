@@ -0,0 +1,199 @@
+"""
+Query plan regression tests for the hot scheduler and dashboard queries.
+"""
+
+from datetime import timedelta
+import json
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase
+from django.utils import timezone
+from psycopg2 import sql
+from twisted.internet import defer
+from twisted.python import failure
+
+from sideloader import task_db
+from sideloader.models import (
+    Build, Project, Release, ReleaseFlow, ReleaseSignoff, ReleaseStream,
+    Server)
+
+
+class RecordingPool(object):
+    """
+    Stands in for the adbapi pool, keeping the queries SideloaderDB runs.
+    """
+
+    def __init__(self):
+        self.queries = []
+
+    def runQuery(self, query, args=None):
+        self.queries.append((query, args))
+        # One placeholder row as wide as the outer SELECT
+        columns = query.split(' FROM ', 1)[0].count(',') + 1
+        return defer.succeed([(0,) * columns])
+
+    runOperation = runQuery
+
+    def runInteraction(self, f, query, args, fields=None):
+        # SideloaderDB.selectRecords and fetchOne run interactions
+        self.queries.append((query, args))
+        if fields is None:
+            return defer.succeed((0,))
+        record = task_db.recordType(fields)
+        return defer.succeed([record(*(0,) * len(fields))])
+
+
+def plan_scans(plan):
+    """
+    Yields (node type, relation, index) for every scan in a JSON plan.
+    """
+    if 'Relation Name' in plan or 'Index Name' in plan:
+        yield (plan['Node Type'], plan.get('Relation Name'),
+               plan.get('Index Name'))
+    for child in plan.get('Plans', []):
+        for scan in plan_scans(child):
+            yield scan
+
+
+class TestQueryPlans(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create_user("me", "me@example.com", "pass")
+        stream = ReleaseStream.objects.create(name="QA", push_command="true")
+        now = timezone.now()
+
+        Project.objects.bulk_create([
+            Project(name='project%s' % i, github_url='project%s.git' % i,
+                    branch='develop', created_by_user=user,
+                    release_stream=stream, idhash='hash%s' % i)
+            for i in range(2000)])
+        projects = list(Project.objects.all())
+
+        ReleaseFlow.objects.bulk_create([
+            ReleaseFlow(name='flow%s' % i, project=projects[i % 100])
+            for i in range(200)])
+        flows = list(ReleaseFlow.objects.all())
+
+        # Almost every build and release is finished, only a few are
+        # queued up.
+        Build.objects.bulk_create([
+            Build(project=projects[i % 100], state=(i % 500) and 1 or 0,
+                  build_time=now - timedelta(minutes=i))
+            for i in range(20000)], batch_size=2000)
+        builds = list(Build.objects.values_list('id', flat=True)[:100])
+
+        Release.objects.bulk_create([
+            Release(flow=flows[i % 200], build_id=builds[i % 100],
+                    waiting=(i % 1000 == 0), lock=False,
+                    release_date=now - timedelta(minutes=i))
+            for i in range(20000)], batch_size=2000)
+        releases = list(Release.objects.values_list('id', flat=True)[:100])
+
+        Server.objects.bulk_create([
+            Server(name='server%s.example.com' % i) for i in range(5000)])
+        ReleaseSignoff.objects.bulk_create([
+            ReleaseSignoff(release_id=releases[i % 100],
+                           signature='user%s@example.com' % i,
+                           idhash='sign%s' % i)
+            for i in range(5000)])
+
+        cursor = connection.cursor()
+        for tbl in ['project', 'releaseflow', 'build', 'release', 'server',
+                    'releasesignoff']:
+            cursor.execute('ANALYZE sideloader_%s' % tbl)
+
+    def explain(self, query, args=None):
+        cursor = connection.cursor()
+        if isinstance(query, sql.Composable):
+            query = query.as_string(connection.connection)
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + query, args or None)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, basestring):
+            plan = json.loads(plan)
+        return list(plan_scans(plan[0]['Plan']))
+
+    def explain_queryset(self, qs):
+        return self.explain(*qs.query.sql_with_params())
+
+    def assert_indexed(self, scans, table):
+        # Bitmap heap scans name the table, their index scans don't
+        table = 'sideloader_' + table
+        tables = [r for t, r, i in scans if r]
+        self.assertIn(table, tables)
+        self.assertNotIn(table, [r for t, r, i in scans if t == 'Seq Scan'],
+            'Sequential scan on %s: %r' % (table, scans))
+
+    def task_db_queries(self, method, *args):
+        db = task_db.SideloaderDB.__new__(task_db.SideloaderDB)
+        db.p = RecordingPool()
+        # The pool answers straight away, so the result is already here
+        result = []
+        getattr(db, method)(*args).addBoth(result.append)
+        if isinstance(result[0], failure.Failure):
+            result[0].raiseException()
+        return db.p.queries
+
+    def assert_uses_index(self, scans, index):
+        self.assertIn(index, [i for t, r, i in scans],
+            'No scan on %s: %r' % (index, scans))
+
+    def test_getReleaseQueue(self):
+        [(query, args)] = self.task_db_queries('getReleaseQueue')
+        scans = self.explain(query, args)
+        self.assert_indexed(scans, 'release')
+        # Only waiting releases are read, and each flow's newest release
+        # comes from its release history index
+        self.assert_uses_index(scans, 'sideloader_release_waiting')
+        self.assertNotIn('Seq Scan', [t for t, r, i in scans])
+
+    def test_claimBuild(self):
+        build = Build.objects.filter(state=0)[0]
+        [(query, args)] = self.task_db_queries(
+            'claimBuild', build.id, 'buildhost:1234')
+        self.assertTrue(query.as_string(connection.connection).startswith(
+            'UPDATE sideloader_build'))
+        self.assert_indexed(self.explain(query, args), 'build')
+
+    def test_getPendingBuild(self):
+        project = Project.objects.all()[0]
+        [(query, args)] = self.task_db_queries('getPendingBuild', project.id)
+        self.assert_indexed(self.explain(query, args), 'build')
+
+    def test_getRunningBuilds(self):
+        project = Project.objects.all()[0]
+        [(query, args)] = self.task_db_queries(
+            'getRunningBuilds', project.id, 300)
+        self.assert_indexed(self.explain(query, args), 'build')
+
+    def test_flow_releases(self):
+        flow = ReleaseFlow.objects.all()[0]
+        self.assert_indexed(self.explain_queryset(
+            flow.release_set.all().order_by('-release_date')), 'release')
+        self.assert_indexed(self.explain_queryset(
+            flow.release_set.filter(waiting=True).order_by('-release_date')),
+            'release')
+
+    def test_queued_builds(self):
+        self.assert_indexed(self.explain_queryset(
+            Build.objects.filter(state=0).order_by('-build_time')), 'build')
+
+    def test_last_builds(self):
+        self.assert_indexed(self.explain_queryset(
+            Build.objects.filter(state__gt=0).order_by('-build_time')[:10]),
+            'build')
+
+    def test_project_builds(self):
+        project = Project.objects.all()[0]
+        self.assert_indexed(self.explain_queryset(
+            Build.objects.filter(project=project).order_by('-build_time')),
+            'build')
+
+    def test_lookups(self):
+        self.assert_indexed(self.explain_queryset(
+            Project.objects.filter(idhash='hash5')), 'project')
+        self.assert_indexed(self.explain_queryset(
+            Server.objects.filter(name='server5.example.com')), 'server')
+        self.assert_indexed(self.explain_queryset(
+            ReleaseSignoff.objects.filter(idhash='sign5')), 'releasesignoff')
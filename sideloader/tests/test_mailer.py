@@ -0,0 +1,171 @@
+"""
+Tests for sideloader.mailer.
+"""
+
+import email
+
+from twisted.internet import defer, error
+from twisted.mail import smtp
+from twisted.trial import unittest
+
+from sideloader import mailer
+from sideloader.tests.fake_smtp import FakeSMTP
+
+
+FROM = 'Sideloader <no-reply@example.com>'
+
+
+class TestMailQueue(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.smtp = FakeSMTP()
+        yield self.smtp.start()
+        self.addCleanup(self.smtp.stop)
+        self.mailer = self.make_mailer(self.smtp.port)
+
+    def make_mailer(self, port, **kw):
+        kw.setdefault('window', 0.01)
+        kw.setdefault('backoff', 0.01)
+        mq = mailer.MailQueue('127.0.0.1', port, **kw)
+        self.addCleanup(mq.stop)
+        return mq
+
+    def send(self, to, subject='Subject', html='<p>Hello</p>'):
+        return self.mailer.send(FROM, to, subject, html)
+
+    @defer.inlineCallbacks
+    def test_one_session(self):
+        """
+        Messages queued together are sent over a single session.
+        """
+        r = yield defer.gatherResults([
+            self.send('a@example.com', 'One'),
+            self.send('b@example.com', 'Two'),
+            self.send('c@example.com', 'Three'),
+        ])
+        self.assertEqual(r, ['a@example.com', 'b@example.com',
+                             'c@example.com'])
+        yield self.mailer.stop()
+        self.assertEqual(self.smtp.connections, 1)
+        self.assertEqual(self.mailer.sessions, 1)
+        self.assertEqual(
+            [(f, rcpts) for f, rcpts, data in self.smtp.messages], [
+                ('no-reply@example.com', ['a@example.com']),
+                ('no-reply@example.com', ['b@example.com']),
+                ('no-reply@example.com', ['c@example.com'])])
+        self.assertEqual(self.smtp.commands[-1], 'QUIT')
+
+    @defer.inlineCallbacks
+    def test_batched(self):
+        """
+        The same email to several people is sent once.
+        """
+        yield defer.gatherResults([
+            self.send('a@example.com'),
+            self.send('b@example.com'),
+            self.send('a@example.com'),
+            self.send('c@example.com', html='<p>Something else</p>'),
+        ])
+        [(f1, rcpts1, data1), (f2, rcpts2, data2)] = self.smtp.messages
+        self.assertEqual(rcpts1, ['a@example.com', 'b@example.com'])
+        self.assertEqual(rcpts2, ['c@example.com'])
+        self.assertEqual(
+            email.message_from_string(data2)['To'], 'c@example.com')
+
+        msg = email.message_from_string(data1)
+        self.assertEqual(msg['To'], 'undisclosed-recipients:;')
+        self.assertNotIn('a@example.com', data1)
+        self.assertNotIn('b@example.com', data1)
+        self.assertEqual(msg['From'], FROM)
+        self.assertEqual(msg['Subject'], 'Subject')
+        [part] = msg.get_payload()
+        self.assertEqual(part.get_content_type(), 'text/html')
+        self.assertIn('<p>Hello</p>', part.get_payload(decode=True))
+
+    @defer.inlineCallbacks
+    def test_max_recipients(self):
+        """
+        Big batches are split up.
+        """
+        self.mailer.maxRecipients = 2
+        yield defer.gatherResults([
+            self.send('%s@example.com' % i) for i in range(5)])
+        self.assertEqual(
+            [len(rcpts) for f, rcpts, data in self.smtp.messages],
+            [2, 2, 1])
+
+    @defer.inlineCallbacks
+    def test_transient_recipient(self):
+        """
+        Recipients the server can't take right now are tried again.
+        """
+        self.smtp.rcpt_codes['b@example.com'] = [451, 250]
+        r = yield defer.gatherResults([
+            self.send('a@example.com'), self.send('b@example.com')])
+        self.assertEqual(r, ['a@example.com', 'b@example.com'])
+        self.assertEqual(
+            [rcpts for f, rcpts, data in self.smtp.messages],
+            [['a@example.com'], ['b@example.com']])
+
+    @defer.inlineCallbacks
+    def test_permanent_recipient(self):
+        """
+        Recipients the server refuses outright fail, without holding up
+        anyone else.
+        """
+        self.smtp.rcpt_codes['b@example.com'] = [550]
+        d = self.send('b@example.com')
+        a = yield self.send('a@example.com')
+        self.assertEqual(a, 'a@example.com')
+        err = yield self.assertFailure(d, smtp.SMTPDeliveryError)
+        self.assertEqual(err.code, 550)
+        self.assertEqual(len(self.smtp.messages), 1)
+
+    @defer.inlineCallbacks
+    def test_transient_data(self):
+        """
+        Messages the server defers are sent again.
+        """
+        self.smtp.replies['data'] = [451]
+        r = yield self.send('a@example.com')
+        self.assertEqual(r, 'a@example.com')
+        self.assertEqual(len(self.smtp.messages), 1)
+        self.assertEqual(self.smtp.commands.count('DATA'), 2)
+
+    @defer.inlineCallbacks
+    def test_gives_up(self):
+        """
+        Messages are only retried so many times.
+        """
+        self.mailer.retries = 2
+        self.smtp.replies['data'] = [451] * 3
+        err = yield self.assertFailure(
+            self.send('a@example.com'), smtp.SMTPDeliveryError)
+        self.assertEqual(err.code, 451)
+        self.assertEqual(self.smtp.commands.count('DATA'), 3)
+        self.assertEqual(self.smtp.messages, [])
+
+    @defer.inlineCallbacks
+    def test_server_unavailable(self):
+        """
+        Servers which turn us away are tried again later.
+        """
+        self.smtp.replies['connect'] = [421]
+        r = yield self.send('a@example.com')
+        self.assertEqual(r, 'a@example.com')
+        self.assertEqual(self.smtp.connections, 2)
+
+    @defer.inlineCallbacks
+    def test_connection_refused(self):
+        """
+        Mail fails once we've tried to connect enough times.
+        """
+        port = self.smtp.port
+        yield self.smtp.stop()
+        self.addCleanup(self.smtp.start)
+        yield self.mailer.stop()
+        self.mailer = self.make_mailer(port, retries=1)
+        yield self.assertFailure(
+            self.send('a@example.com'), error.ConnectionRefusedError)
+        self.assertEqual(self.mailer.sessions, 2)
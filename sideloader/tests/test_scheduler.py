@@ -0,0 +1,104 @@
+"""
+Tests for sideloader.scheduler.
+"""
+
+from datetime import datetime
+import time
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+from sideloader import scheduler
+
+
+class TestReleaseScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.woken = []
+        self.scheduler = scheduler.ReleaseScheduler(
+            self.woken.append, clock=self.clock)
+
+    def test_releaseTime(self):
+        """
+        Scheduled times are read the same way checkReleaseSchedule does.
+        """
+        dt = datetime(2016, 4, 1, 12, 30, 0)
+        self.assertEqual(
+            scheduler.releaseTime(dt), time.mktime(dt.timetuple()))
+
+    def test_wake_when_due(self):
+        """
+        We wake up when the earliest release falls due, and not before.
+        """
+        self.scheduler.schedule(1, 20)
+        self.scheduler.schedule(2, 10)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+        self.clock.advance(9)
+        self.assertEqual(self.woken, [])
+        self.clock.advance(1)
+        self.assertEqual(self.woken, [[2]])
+        self.clock.advance(10)
+        self.assertEqual(self.woken, [[2], [1]])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(len(self.scheduler), 0)
+
+    def test_wake_together(self):
+        """
+        Releases falling due at the same time wake us once.
+        """
+        self.scheduler.schedule(1, 10)
+        self.scheduler.schedule(2, 10)
+        self.scheduler.schedule(3, 5)
+        self.clock.advance(10)
+        self.assertEqual(self.woken, [[3, 1, 2]])
+
+    def test_schedule_now(self):
+        """
+        Releases without a time wake us on the next reactor turn.
+        """
+        self.clock.advance(100)
+        self.scheduler.schedule(1)
+        self.assertEqual(self.woken, [])
+        self.clock.advance(0)
+        self.assertEqual(self.woken, [[1]])
+
+    def test_past_due(self):
+        """
+        Releases which are already due wake us straight away.
+        """
+        self.clock.advance(100)
+        self.scheduler.schedule(1, 50)
+        self.clock.advance(0)
+        self.assertEqual(self.woken, [[1]])
+
+    def test_reschedule(self):
+        """
+        Rescheduling a release replaces its previous time.
+        """
+        self.scheduler.schedule(1, 10)
+        self.scheduler.schedule(1, 30)
+        self.scheduler.schedule(1, 30)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.clock.advance(10)
+        self.assertEqual(self.woken, [])
+        self.clock.advance(20)
+        self.assertEqual(self.woken, [[1]])
+
+    def test_discard(self):
+        """
+        Discarded releases don't wake us.
+        """
+        self.scheduler.schedule(1, 10)
+        self.scheduler.schedule(2, 20)
+        self.scheduler.discard(1)
+        self.scheduler.discard(3)
+        self.clock.advance(10)
+        self.assertEqual(self.woken, [])
+        self.clock.advance(10)
+        self.assertEqual(self.woken, [[2]])
+
+        self.scheduler.schedule(4, 30)
+        self.scheduler.discard(4)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
@@ -0,0 +1,159 @@
+"""
+Tests for sideloader.slack.
+"""
+
+import json
+import urlparse
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from sideloader import slack
+
+
+class FakeSlackClient(object):
+    """
+    Records messages instead of sending them.
+    """
+    messages = []
+
+    def __init__(self, host, token, channel):
+        self.channel = channel
+
+    def message(self, text, fields=[], fallback=None):
+        self.messages.append((self.channel, text, fields, fallback))
+        return defer.succeed('ok')
+
+
+class TestSlackClient(unittest.TestCase):
+
+    def test_message(self):
+        """
+        Messages are posted to the webhook as a single attachment.
+        """
+        requests = []
+
+        def getBody(url, method, data, headers):
+            requests.append((url, method, data))
+            return defer.succeed('ok')
+
+        self.patch(slack.HTTPRequest, 'getBody', staticmethod(getBody))
+        sc = slack.SlackClient('example.slack.com', 'token', '#mychan')
+        sc.message('2 notifications', fields=[{'value': 'a'}],
+            fallback='a\nb')
+
+        [(url, method, data)] = requests
+        self.assertEqual(method, 'POST')
+        self.assertEqual(url, 'https://example.slack.com/services/hooks/'
+            'incoming-webhook?token=token')
+        payload = json.loads(urlparse.parse_qs(data)['payload'][0])
+        self.assertEqual(payload['channel'], '#mychan')
+        [attachment] = payload['attachments']
+        self.assertEqual(attachment['pretext'], '2 notifications')
+        self.assertEqual(attachment['fallback'], 'a\nb')
+        self.assertEqual(attachment['fields'], [{'value': 'a'}])
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_take(self):
+        """
+        Bursts are allowed, after which tokens trickle in at the rate.
+        """
+        clock = task.Clock()
+        bucket = slack.TokenBucket(2, burst=2, clock=clock)
+        self.assertEqual([bucket.take(), bucket.take()], [0, 0])
+        self.assertEqual(bucket.take(), 0.5)
+        clock.advance(0.25)
+        self.assertEqual(bucket.take(), 0.25)
+        clock.advance(0.25)
+        self.assertEqual(bucket.take(), 0)
+        clock.advance(10)
+        self.assertEqual([bucket.take(), bucket.take()], [0, 0])
+        self.assertEqual(bucket.take(), 0.5)
+
+
+class TestSlackDispatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        FakeSlackClient.messages = []
+        self.messages = FakeSlackClient.messages
+        self.dispatcher = slack.SlackDispatcher(
+            'example.slack.com', 'token', window=2.0, rate=1.0, burst=1,
+            maxFields=3, clock=self.clock, client=FakeSlackClient)
+
+    def test_single(self):
+        """
+        A lone notification is sent as is once the window closes.
+        """
+        self.dispatcher.notify('#mychan', 'Deployment started')
+        self.assertEqual(self.messages, [])
+        self.clock.advance(2)
+        self.assertEqual(self.messages, [
+            ('#mychan', 'Deployment started', [], None)])
+
+    def test_coalesced(self):
+        """
+        Notifications within the window go out together, per channel.
+        """
+        self.dispatcher.notify('#mychan', 'one')
+        self.clock.advance(1)
+        self.dispatcher.notify('#mychan', 'two')
+        self.dispatcher.notify('#other', 'three')
+        self.clock.advance(1)
+        self.assertEqual(self.messages, [
+            ('#mychan', '2 notifications',
+             [{'value': 'one', 'short': False},
+              {'value': 'two', 'short': False}], 'one\ntwo')])
+
+        # The other channel waits for a token
+        self.clock.advance(1)
+        self.assertEqual(self.messages[1], ('#other', 'three', [], None))
+        self.assertEqual(self.dispatcher.sent, 2)
+        self.assertEqual(self.dispatcher.coalesced, 1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_rate_limited(self):
+        """
+        Notifications keep collecting while we wait for the bucket, and
+        big batches are split.
+        """
+        self.dispatcher.notify('#mychan', 'one')
+        self.clock.advance(2)
+        for i in range(5):
+            self.dispatcher.notify('#mychan', str(i))
+        self.clock.advance(2)
+        self.assertEqual(len(self.messages), 2)
+        self.assertEqual(
+            [f['value'] for f in self.messages[1][2]], ['0', '1', '2'])
+
+        self.dispatcher.notify('#mychan', '5')
+        self.clock.advance(0)
+        self.assertEqual(len(self.messages), 2)
+        self.clock.advance(1)
+        self.assertEqual(
+            [f['value'] for f in self.messages[2][2]], ['3', '4', '5'])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_send_failure(self):
+        """
+        Failures to reach Slack are logged and don't stop later messages.
+        """
+        failures = [IOError("Connection refused")]
+
+        def message(sc, text, fields=[], fallback=None):
+            if failures:
+                return defer.fail(failures.pop())
+            return FakeSlackClient.__dict__['message'](
+                sc, text, fields, fallback)
+
+        self.dispatcher.client = type(
+            'FailingSlackClient', (FakeSlackClient,), {'message': message})
+        self.dispatcher.notify('#mychan', 'one')
+        self.clock.advance(2)
+        self.assertEqual(len(self.flushLoggedErrors(IOError)), 1)
+
+        self.dispatcher.notify('#mychan', 'two')
+        self.clock.advance(2)
+        self.assertEqual(self.messages, [('#mychan', 'two', [], None)])
@@ -0,0 +1,279 @@
+"""
+Tests for sideloader.specter.
+"""
+
+import json
+from StringIO import StringIO
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from sideloader import specter
+from sideloader.tests.fake_specter import FakeSpecter
+
+
+class TestSpecterClient(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.specter = FakeSpecter()
+        yield self.specter.start()
+        self.addCleanup(self.specter.stop)
+
+    def make_client(self, pool=None):
+        return specter.SpecterClient(
+            '127.0.0.1', 'auth', 'key', port=self.specter.port, pool=pool,
+            ssl=False)
+
+    def make_pool(self, **kw):
+        pool = specter.createPool(**kw)
+        self.addCleanup(pool.closeCachedConnections)
+        return pool
+
+    @defer.inlineCallbacks
+    def test_get(self):
+        """
+        We can make GET requests.
+        """
+        sc = self.make_client()
+        result = yield sc.get_all_stop()
+        self.assertEqual(result['stdout'], 'GET /all/stop')
+        self.assertEqual(self.specter.requests, [('GET', '/all/stop')])
+
+    @defer.inlineCallbacks
+    def test_post(self):
+        """
+        We can make POST requests.
+        """
+        sc = self.make_client()
+        result = yield sc.post_install({'package': 'foo', 'url': 'bar'})
+        self.assertEqual(result['stdout'], 'POST /install')
+
+    @defer.inlineCallbacks
+    def test_pool_reuses_connections(self):
+        """
+        Clients sharing a pool reuse its connections.
+        """
+        pool = self.make_pool()
+        for i in range(3):
+            sc = self.make_client(pool)
+            yield sc.get_all_stop()
+            yield sc.post_install({'package': 'foo', 'url': 'bar'})
+            yield sc.get_all_start()
+
+        self.assertEqual(len(self.specter.requests), 9)
+        self.assertEqual(self.specter.connections, 1)
+
+    @defer.inlineCallbacks
+    def test_pool_max_per_host(self):
+        """
+        Clients sharing a pool make at most maxPerHost requests to a host
+        at once, over that many connections.
+        """
+        self.specter.delay = 0.05
+        pool = self.make_pool(maxPerHost=2)
+        clients = [self.make_client(pool) for i in range(2)]
+        yield defer.gatherResults(
+            [sc.get_all_stop() for sc in clients for i in range(3)])
+        self.assertEqual(len(self.specter.requests), 6)
+        self.assertEqual(self.specter.max_active, 2)
+        self.assertEqual(self.specter.connections, 2)
+
+        yield defer.gatherResults([sc.get_all_start() for sc in clients])
+        self.assertEqual(self.specter.connections, 2)
+
+    @defer.inlineCallbacks
+    def test_read_timeout(self):
+        """
+        Requests which aren't answered within readTimeout fail.
+        """
+        self.specter.delay = 5
+        sc = self.make_client()
+        sc.readTimeout = 0.05
+        try:
+            yield sc.post_install({'package': 'foo', 'url': 'bar'})
+        except specter.SpecterTimeout, e:
+            self.assertEqual(
+                str(e), 'No response from 127.0.0.1 after 0.05s')
+        else:
+            self.fail('Expected SpecterTimeout')
+
+        # POSTs aren't retried
+        self.assertEqual(len(self.specter.requests), 1)
+
+    @defer.inlineCallbacks
+    def test_get_retries(self):
+        """
+        GETs are retried after failures, and the attempts are recorded.
+        """
+        self.specter.delays = [5, 5]
+        sc = self.make_client()
+        sc.readTimeout = 0.05
+        sc.retries = 2
+        sc.backoff = 0.01
+
+        result = yield sc.get_all_stop()
+        self.assertEqual(result['stdout'], 'GET /all/stop')
+        self.assertEqual(len(self.specter.requests), 3)
+        self.assertEqual(len(sc.history), 3)
+        self.assertTrue(sc.history[0].startswith(
+            'GET /all/stop failed (No response from 127.0.0.1 after 0.05s),'
+            ' retrying in '))
+        self.assertEqual(
+            sc.history[2], 'GET /all/stop succeeded after 3 attempts')
+
+    @defer.inlineCallbacks
+    def test_get_retries_exhausted(self):
+        """
+        GETs fail once they run out of retries.
+        """
+        self.specter.delay = 5
+        sc = self.make_client()
+        sc.readTimeout = 0.05
+        sc.retries = 1
+        sc.backoff = 0.01
+
+        yield self.assertFailure(sc.get_puppet_run(), specter.SpecterTimeout)
+        self.assertEqual(len(self.specter.requests), 2)
+        self.assertEqual(
+            sc.history[-1], 'GET /puppet/run failed after 2 attempts:'
+            ' No response from 127.0.0.1 after 0.05s')
+
+    def test_backoff(self):
+        """
+        Backoff doubles with each attempt, with jitter, up to maxBackoff.
+        """
+        sc = self.make_client()
+        sc.backoff = 1.0
+        sc.maxBackoff = 5.0
+        for attempt, delay in [(1, 1.0), (2, 2.0), (3, 4.0), (4, 5.0)]:
+            for i in range(20):
+                backoff = sc.getBackoff(attempt)
+                self.assertTrue(delay / 2 <= backoff <= delay)
+
+    @defer.inlineCallbacks
+    def test_large_body_spooled(self):
+        """
+        Large responses are spooled to disk and their output truncated.
+        """
+        self.specter.responses['/puppet/run'] = {
+            'stdout': 'x' * 5000 + 'done', 'stderr': 'oops', 'code': 0}
+        sc = self.make_client()
+        sc.maxMemory = 1024
+        sc.maxOutput = 100
+
+        bodies = []
+        parseBody = sc.parseBody
+        sc.parseBody = lambda body: parseBody(bodies.append(body) or body)
+
+        result = yield sc.get_puppet_run()
+        self.assertEqual(
+            result['stdout'], '[4904 characters truncated]\n' + 'x' * 96 + 'done')
+        self.assertEqual(result['stderr'], 'oops')
+        self.assertTrue(bodies[0]._rolled)
+        self.assertTrue(bodies[0].closed)
+
+    @defer.inlineCallbacks
+    def test_small_body_in_memory(self):
+        """
+        Small responses stay in memory.
+        """
+        sc = self.make_client()
+        bodies = []
+        parseBody = sc.parseBody
+        sc.parseBody = lambda body: parseBody(bodies.append(body) or body)
+
+        result = yield sc.get_all_start()
+        self.assertEqual(result['stdout'], 'GET /all/start')
+        self.assertFalse(bodies[0]._rolled)
+
+    def test_truncateOutput(self):
+        """
+        Only the tail of long output is kept.
+        """
+        self.assertEqual(specter.truncateOutput('abcdef', 10), 'abcdef')
+        self.assertEqual(specter.truncateOutput('abcdef', None), 'abcdef')
+        self.assertEqual(specter.truncateOutput('abcdef', 2),
+            '[4 characters truncated]\nef')
+
+    def test_parseBody(self):
+        """
+        Bodies decode as json.loads decodes them, with only the tail of
+        command output kept.
+        """
+        output = u'caf\xe9 "quoted" \\ \U0001f600\n' * 1000
+        response = {'stdout': output, 'stderr': u'\u20ac', 'code': 1,
+                    'nested': {'stdout': [u'a}', None]}}
+        sc = self.make_client()
+        sc.maxOutput = 50
+
+        for body in [json.dumps(response), json.dumps(response, indent=1,
+                                                      ensure_ascii=False)]:
+            if isinstance(body, unicode):
+                body = body.encode('utf-8')
+            result = sc.parseBody(StringIO(body))
+
+            self.assertEqual(result['stdout'],
+                specter.truncateOutput(output, 50))
+            self.assertEqual(result['stderr'], u'\u20ac')
+            self.assertEqual(result['code'], 1)
+            self.assertEqual(result['nested'], {'stdout': [u'a}', None]})
+
+        # Lone surrogates, next to pairs or not
+        for escaped in ['"\\ud800\\ud83d\\ude00"', '"\\udc00x"',
+                        '"\\ud83d\\ude00\\ud800"']:
+            body = '{"stdout": %s}' % escaped
+            result = sc.parseBody(StringIO(body))
+            self.assertEqual(result['stdout'], json.loads(escaped))
+
+    def test_parseBody_bounded(self):
+        """
+        Output is handed over as it's decoded, and parsing a body holds
+        no more than maxMemory of it at once however much output it has.
+        """
+        line = u'caf\xe9 \U0001f600 "building"\n'
+        output = line * (4 * 1024 * 1024 / len(line))
+        body = json.dumps({'stdout': output, 'stderr': output[:1000],
+                           'code': 0})
+        pieces = []
+        parser = specter.BodyParser(StringIO(body), 64 * 1024, 1000,
+            lambda key, text: pieces.append((key, text)))
+
+        result = parser.parse()
+
+        self.assertTrue(len(body) > 4 * 1024 * 1024)
+        self.assertTrue(parser.peak <= 64 * 1024)
+        self.assertEqual(result['stdout'], specter.truncateOutput(output, 1000))
+        self.assertEqual(result['stderr'], output[:1000])
+        self.assertEqual(
+            u''.join(t for k, t in pieces if k == 'stdout'), output)
+        self.assertEqual(
+            u''.join(t for k, t in pieces if k == 'stderr'), output[:1000])
+        self.assertTrue(len(pieces) > 100)
+
+        # Other values can't take up the memory output may not
+        body = json.dumps({'stdout': 'x', 'code': [output]})
+        parser = specter.BodyParser(StringIO(body), 64 * 1024)
+        self.assertRaises(ValueError, parser.parse)
+        self.assertTrue(parser.peak <= 64 * 1024)
+
+    @defer.inlineCallbacks
+    def test_output_streamed(self):
+        """
+        Clients pass command output to their output callable while the
+        response is parsed.
+        """
+        self.specter.responses['/puppet/run'] = {
+            'stdout': 'x' * 5000 + 'done', 'stderr': 'oops', 'code': 0}
+        pieces = []
+        sc = self.make_client()
+        sc.maxMemory = 1024
+        sc.maxOutput = 100
+        sc.output = lambda key, text: pieces.append((key, text))
+
+        result = yield sc.get_puppet_run()
+        self.assertEqual(
+            result['stdout'], '[4904 characters truncated]\n' + 'x' * 96 + 'done')
+        self.assertEqual(
+            u''.join(t for k, t in pieces if k == 'stdout'), 'x' * 5000 + 'done')
+        self.assertIn(('stderr', 'oops'), pieces)
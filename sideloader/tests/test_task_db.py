@@ -2,6 +2,9 @@
 Tests for sideloader.task_db.
 """
 
+from datetime import datetime, timedelta
+
+import psycopg2
 from twisted.internet import defer, reactor
 from twisted.python.failure import Failure
 from twisted.trial import unittest
@@ -10,8 +13,18 @@ from sideloader import task_db
 from sideloader.tests import fake_db
 from sideloader.tests.fake_data import (
     RELEASESTREAM_QA, RELEASESTREAM_PROD, PROJECT_SIDELOADER, BUILD_1,
-    RELEASEFLOW_QA, RELEASEFLOW_PROD, RELEASE_1, WEBHOOK_QA_1, WEBHOOK_QA_2)
-from sideloader.tests.utils import dictmerge, now_utc
+    RELEASEFLOW_QA, RELEASEFLOW_PROD, RELEASE_1, WEBHOOK_QA_1, WEBHOOK_QA_2,
+    SERVER_1, TARGET_1)
+from sideloader.tests.utils import dictmerge, now_utc, datetime_utc
+from skeleton import settings
+
+
+# pytest-django points Django's default database at its own test database
+# for TestCases, the worker tests always use the real one
+TEST_DB = {'database': 'sideloader'}
+
+BUILD_LOG_FIELDS = task_db.BUILD_FIELDS + ('log',)
+TARGET_LOG_FIELDS = task_db.TARGET_FIELDS + ('log',)
 
 
 def maybe_fail(f, *args, **kw):
@@ -65,9 +78,9 @@ class BothDBsProxy(object):
             [(rs, rr), (fs, fr)] = yield defer.DeferredList([dr, df])
             defer.returnValue(result(rs, rr, fs, fr))
 
-        def callboth(self, *args, **kw):
-            fs, fr = maybe_fail(fakeattr, self, *args, **kw)
-            rs, rr = maybe_fail(realattr, self, *args, **kw)
+        def callboth(*args, **kw):
+            fs, fr = maybe_fail(fakeattr, *args, **kw)
+            rs, rr = maybe_fail(realattr, *args, **kw)
             if isinstance(rr, defer.Deferred):
                 return result_async(fr, rr)
             return result(rs, rr, fs, fr)
@@ -75,13 +88,121 @@ class BothDBsProxy(object):
         return callboth
 
 
+class TestRecord(unittest.TestCase):
+
+    def test_mapping(self):
+        """
+        Records are read like the dicts they replace.
+        """
+        record = task_db.recordType(('id', 'name'))(1, 'foo')
+        assert record['id'] == 1
+        assert record.get('name') == 'foo'
+        assert record.get('log') is None
+        assert 'name' in record and 'log' not in record
+        assert list(record) == ['id', 'name']
+        assert len(record) == 2
+        assert record.items() == [('id', 1), ('name', 'foo')]
+        assert record == {'id': 1, 'name': 'foo'}
+        assert record != {'id': 1}
+        assert dict(record) == {'id': 1, 'name': 'foo'}
+        self.assertRaises(KeyError, lambda: record['log'])
+        self.assertRaises(KeyError, lambda: record['keys'])
+
+    def test_read_only(self):
+        """
+        Records can't be changed and don't carry a __dict__.
+        """
+        record = task_db.recordType(('id',))(1)
+        self.assertRaises(AttributeError, setattr, record, 'id', 2)
+        self.assertRaises(AttributeError, setattr, record, 'log', '')
+        assert not hasattr(record, '__dict__')
+
+    def test_recordType_cached(self):
+        """
+        Each set of columns gets one record class.
+        """
+        assert task_db.recordType(['id', 'name']) is task_db.recordType(
+            ('id', 'name'))
+        assert task_db.recordType(('id',)) is not task_db.recordType(
+            ('name',))
+
+
+class TestPool(unittest.TestCase):
+
+    def test_poolConfig_defaults(self):
+        """
+        Connections default to Django's database, without empty parameters.
+        """
+        kw = task_db.poolConfig()
+        assert kw == {
+            'cp_min': 3, 'cp_max': 10, 'host': 'localhost',
+            'user': 'postgres',
+            'database': settings.DATABASES['default']['NAME']}
+
+    def test_poolConfig_overrides(self):
+        """
+        config.yaml can resize the pool, set a statement timeout and
+        change connection parameters.
+        """
+        kw = task_db.poolConfig({
+            'pool_min': 1, 'pool_max': 20, 'statement_timeout': 5000,
+            'database': 'sideloader', 'host': 'db.example.com', 'port': 6432,
+            'options': '-c work_mem=8MB'})
+        assert kw == {
+            'cp_min': 1, 'cp_max': 20, 'database': 'sideloader',
+            'host': 'db.example.com', 'port': 6432, 'user': 'postgres',
+            'options': '-c work_mem=8MB -c statement_timeout=5000'}
+
+    def connect(self, **config):
+        db = task_db.SideloaderDB(dictmerge(TEST_DB, **config))
+        self.addCleanup(db.p.close)
+        return db
+
+    @defer.inlineCallbacks
+    def test_statement_timeout(self):
+        """
+        Statements running past the timeout are cancelled.
+        """
+        db = self.connect(statement_timeout=50)
+        [(timeout,)] = yield db.p.runQuery('SHOW statement_timeout')
+        assert timeout == '50ms'
+        yield self.assertFailure(
+            db.p.runQuery('SELECT pg_sleep(1)'),
+            psycopg2.extensions.QueryCanceledError)
+
+    @defer.inlineCallbacks
+    def test_stats(self):
+        """
+        The pool counts interactions waiting for a connection, holding one,
+        and how long they waited.
+        """
+        db = self.connect(pool_min=1, pool_max=1)
+        stats = db.stats()
+        assert (stats['min'], stats['max']) == (1, 1)
+        assert stats['requests'] == 0 and stats['wait_avg'] == 0.0
+
+        # The second query waits for the first to give up the connection
+        d1 = db.p.runQuery('SELECT pg_sleep(0.2)')
+        d2 = db.p.runQuery('SELECT 1')
+        assert db.stats()['waiting'] + db.stats()['in_use'] == 2
+        yield defer.gatherResults([d1, d2])
+
+        stats = db.stats()
+        assert stats['waiting'] == 0
+        assert stats['in_use'] == 0
+        assert stats['requests'] == 2
+        assert stats['wait_max'] >= 0.15
+        assert stats['wait_avg'] == stats['wait_total'] / 2
+
+
 class TestDB(unittest.TestCase):
     """
     Tests for both task_db and fake_db.
     """
+    backend = 'adbapi'
 
     def setUp(self):
-        self.real_db = task_db.SideloaderDB()
+        self.real_db = task_db.getDB(dictmerge(TEST_DB, backend=self.backend))
         self.addCleanup(self.real_db.p.close)
         self.addCleanup(self.clear_db)
         self.fake_db = fake_db.FakeDB(reactor)
@@ -91,7 +212,10 @@ class TestDB(unittest.TestCase):
     @defer.inlineCallbacks
     def clear_db(self):
         for tbl in ['sideloader_webhook',
+                    'sideloader_target',
+                    'sideloader_server',
                     'sideloader_release',
+                    'sideloader_buildlogchunk',
                     'sideloader_build',
                     'sideloader_buildnumbers',
                     'sideloader_releaseflow',
@@ -135,7 +259,7 @@ class TestDB(unittest.TestCase):
         yield self.db.runInsert('sideloader_project', PROJECT_SIDELOADER)
         yield self.db.runInsert('sideloader_build', BUILD_1)
         yield self.db.updateBuildLog(1, "Stardate 19564.3: Building a thing.")
-        build = yield self.db.getBuild(1)
+        build = yield self.db.getBuild(1, fields=BUILD_LOG_FIELDS)
         assert build['log'] == "Stardate 19564.3: Building a thing."
 
     @defer.inlineCallbacks
@@ -145,6 +269,30 @@ class TestDB(unittest.TestCase):
         """
         yield self.db.updateBuildLog(42, "Stardate 19564.3: Building a thing.")
 
+    @defer.inlineCallbacks
+    def test_appendBuildLog(self):
+        """
+        We can append chunks to a build's log and read them back in order.
+        """
+        yield self.db.runInsert('sideloader_releasestream', RELEASESTREAM_QA)
+        yield self.db.runInsert('sideloader_project', PROJECT_SIDELOADER)
+        yield self.db.runInsert('sideloader_build', BUILD_1)
+        yield self.db.appendBuildLog(1, 2, 18, "Building a thing.\n")
+        yield self.db.appendBuildLog(1, 1, 0, "Stardate 19564.3: ")
+        log = yield self.db.getBuildLog(1)
+        assert log == "Stardate 19564.3: Building a thing.\n"
+        build = yield self.db.getBuild(1, fields=BUILD_LOG_FIELDS)
+        assert build['log'] == ""
+
+    @defer.inlineCallbacks
+    def test_appendBuildLog_missing(self):
+        """
+        Appends to missing builds go to /dev/null.
+        """
+        yield self.db.appendBuildLog(42, 1, 0, "Stardate 19564.3: Building.")
+        log = yield self.db.getBuildLog(42)
+        assert log == ""
+
     @defer.inlineCallbacks
     def test_getProjectNotificationSettings(self):
         """
@@ -175,9 +323,63 @@ class TestDB(unittest.TestCase):
         yield self.db.runInsert('sideloader_releasestream', RELEASESTREAM_QA)
         yield self.db.runInsert('sideloader_project', PROJECT_SIDELOADER)
         yield self.db.runInsert('sideloader_build', BUILD_1)
-        build = yield self.db.getBuild(1)
+        build = yield self.db.getBuild(1, fields=BUILD_LOG_FIELDS)
         assert build == BUILD_1
 
+    @defer.inlineCallbacks
+    def test_getBuild_fields(self):
+        """
+        Builds are fetched without their log unless we ask for it.
+        """
+        yield self.db.runInsert('sideloader_releasestream', RELEASESTREAM_QA)
+        yield self.db.runInsert('sideloader_project', PROJECT_SIDELOADER)
+        yield self.db.runInsert('sideloader_build', BUILD_1)
+        build = yield self.db.getBuild(1)
+        assert 'log' not in build
+        assert build == dict((k, v) for k, v in BUILD_1.items() if k != 'log')
+        build = yield self.db.getBuild(1, fields=('build_file', 'project_id'))
+        assert build == {'build_file': BUILD_1['build_file'], 'project_id': 1}
+
+    @defer.inlineCallbacks
+    def test_claimBuild(self):
+        """
+        Only one worker at a time gets to build a project.
+        """
+        yield self.db.runInsert('sideloader_releasestream', RELEASESTREAM_QA)
+        yield self.db.runInsert('sideloader_project', PROJECT_SIDELOADER)
+        yield self.db.runInsert('sideloader_build', BUILD_1)
+        yield self.db.runInsert('sideloader_build', dictmerge(BUILD_1, id=2))
+
+        pending = yield self.db.getPendingBuild(1)
+        assert pending == 1
+        yield self.db.setBuildCommit(1, 'abc123')
+        claimed = yield self.db.claimBuild(
+            1, 'host:1', fields=('id', 'commit', 'worker'))
+        assert claimed == {'id': 1, 'commit': 'abc123', 'worker': 'host:1'}
+        assert not (yield self.db.claimBuild(1, 'host:2'))
+        assert not (yield self.db.claimBuild(2, 'host:2'))
+        pending = yield self.db.getPendingBuild(1)
+        assert pending == 2
+
+        running = yield self.db.getRunningBuilds(1, 300)
+        assert running == [(1, 'host:1', False)]
+        yield self.db.beatBuilds('host:1')
+        running = yield self.db.getRunningBuilds(1, -1)
+        assert running == [(1, 'host:1', True)]
+
+        # Only the worker we think has the build can expire it
+        yield self.db.expireBuild(1, 'host:2')
+        assert not (yield self.db.claimBuild(2, 'host:2'))
+        yield self.db.expireBuild(1, 'host:1')
+        build = yield self.db.getBuild(1, fields=('state', 'worker'))
+        assert build == {'state': 2, 'worker': 'host:1'}
+        claimed = yield self.db.claimBuild(2, 'host:2', fields=('id',))
+        assert claimed == {'id': 2}
+        running = yield self.db.getRunningBuilds(1, 300)
+        assert running == [(2, 'host:2', False)]
+        pending = yield self.db.getPendingBuild(1)
+        assert pending is None
+
     @defer.inlineCallbacks
     def test_getBuild_missing(self):
         """
@@ -313,6 +515,15 @@ class TestDB(unittest.TestCase):
         scheduled_now = self.db.checkReleaseSchedule(RELEASE_1)
         assert scheduled_now is True
 
+    def test_checkReleaseSchedule_scheduled(self):
+        """
+        Scheduled releases are only due once their time has passed.
+        """
+        past = dictmerge(RELEASE_1, scheduled=datetime(2016, 4, 1, 1, 0, 0))
+        future = dictmerge(RELEASE_1, scheduled=datetime.now() + timedelta(1))
+        assert self.db.checkReleaseSchedule(past) is True
+        assert self.db.checkReleaseSchedule(future) is False
+
     @defer.inlineCallbacks
     def test_checkReleaseSignoff_none_required(self):
         """
@@ -369,6 +580,70 @@ class TestDB(unittest.TestCase):
         assert release['lock'] is False
         assert release['waiting'] is False
 
+    @defer.inlineCallbacks
+    def setup_release_queue(self):
+        yield self.db.runInsert('sideloader_releasestream', RELEASESTREAM_QA)
+        yield self.db.runInsert('sideloader_releasestream', RELEASESTREAM_PROD)
+        yield self.db.runInsert('sideloader_project', PROJECT_SIDELOADER)
+        yield self.db.runInsert('sideloader_releaseflow', RELEASEFLOW_QA)
+        yield self.db.runInsert('sideloader_releaseflow', RELEASEFLOW_PROD)
+        yield self.db.runInsert('sideloader_build', BUILD_1)
+
+        def release(id, flow_id, hour, waiting=True, lock=False):
+            return self.db.runInsert('sideloader_release', dictmerge(
+                RELEASE_1, id=id, flow_id=flow_id, waiting=waiting, lock=lock,
+                release_date=datetime_utc(2016, 4, 1, hour, 0, 0)))
+
+        # QA has a finished release, an old waiting one and a new one
+        yield release(1, 1, 1, waiting=False)
+        yield release(2, 1, 2)
+        yield release(3, 1, 3)
+        # Prod has a running release and one waiting behind it
+        yield release(4, 2, 1, lock=True)
+        yield release(5, 2, 2)
+        # A waiting release older than the last finished one
+        yield release(6, 2, 0)
+        yield release(7, 2, 3, waiting=False)
+
+    @defer.inlineCallbacks
+    def test_getReleaseQueue(self):
+        """
+        We can get the waiting releases, with whether they've been
+        superseded and how many releases are running in their flow.
+        """
+        yield self.setup_release_queue()
+        queue = yield self.db.getReleaseQueue()
+        self.assertEqual(
+            [(r['id'], r['flow_id'], r['stale'], r['running']) for r in queue],
+            [(2, 1, True, 0), (3, 1, False, 0),
+             (5, 2, True, 1), (6, 2, True, 1)])
+        self.assertEqual(queue[1]['build_id'], 1)
+        self.assertEqual(
+            queue[1]['release_date'], datetime_utc(2016, 4, 1, 3, 0, 0))
+
+    @defer.inlineCallbacks
+    def test_getReleaseQueue_empty(self):
+        """
+        The release queue is empty when nothing is waiting.
+        """
+        queue = yield self.db.getReleaseQueue()
+        self.assertEqual(queue, [])
+
+    @defer.inlineCallbacks
+    def test_expireReleases(self):
+        """
+        We can stop waiting on several releases at once.
+        """
+        yield self.setup_release_queue()
+        yield self.db.expireReleases([2, 4])
+        yield self.db.expireReleases([])
+        for id in [2, 4]:
+            release = yield self.db.getRelease(id)
+            assert release['waiting'] is False
+            assert release['lock'] is False
+        release = yield self.db.getRelease(3)
+        assert release['waiting'] is True
+
     @defer.inlineCallbacks
     def test_getFlow(self):
         """
@@ -417,6 +692,62 @@ class TestDB(unittest.TestCase):
         flows = yield self.db.getAutoFlows(1)
         assert flows == []
 
+    @defer.inlineCallbacks
+    def setup_target(self):
+        yield self.db.runInsert('sideloader_releasestream', RELEASESTREAM_QA)
+        yield self.db.runInsert('sideloader_project', PROJECT_SIDELOADER)
+        yield self.db.runInsert('sideloader_releaseflow', RELEASEFLOW_QA)
+        yield self.db.runInsert('sideloader_build', BUILD_1)
+        yield self.db.runInsert('sideloader_server', SERVER_1)
+        yield self.db.runInsert('sideloader_target', TARGET_1)
+
+    @defer.inlineCallbacks
+    def test_getFlowTargets(self):
+        """
+        We can get all the targets for a release flow.
+        """
+        yield self.setup_target()
+        targets = yield self.db.getFlowTargets(
+            RELEASEFLOW_QA['id'], fields=TARGET_LOG_FIELDS)
+        assert targets == [TARGET_1]
+        [target] = yield self.db.getFlowTargets(RELEASEFLOW_QA['id'])
+        assert 'log' not in target
+
+    @defer.inlineCallbacks
+    def test_getServer(self):
+        """
+        We can get information about a server.
+        """
+        yield self.setup_target()
+        server = yield self.db.getServer(1)
+        assert server == SERVER_1
+
+    @defer.inlineCallbacks
+    def test_getServer_missing(self):
+        """
+        We get nothing for a server that doesn't exist.
+        """
+        server = yield self.db.getServer(42)
+        assert server is None
+
+    @defer.inlineCallbacks
+    def test_updateTarget(self):
+        """
+        We can update a target's state, log and build.
+        """
+        yield self.setup_target()
+        yield self.db.updateTargetState(1, 2)
+        yield self.db.updateTargetLog(1, "Deploy")
+        yield self.db.appendTargetLog(1, "ed.")
+        yield self.db.updateTargetBuild(1, 1)
+        yield self.db.updateServerStatus(1, "Reachable")
+        [target] = yield self.db.getFlowTargets(
+            RELEASEFLOW_QA['id'], fields=TARGET_LOG_FIELDS)
+        assert target == dictmerge(
+            TARGET_1, deploy_state=2, log="Deployed.", current_build_id=1)
+        server = yield self.db.getServer(1)
+        assert server['status'] == "Reachable"
+
     @defer.inlineCallbacks
     def test_getWebhooks(self):
         """
@@ -458,3 +789,61 @@ class TestDB(unittest.TestCase):
         yield self.db.setWebhookResponse(WEBHOOK_QA_1['id'], "Hello.")
         [webhook] = yield self.db.getWebhooks(RELEASEFLOW_QA['id'])
         assert webhook['last_response'] == "Hello."
+
+
+class TestAsyncDB(TestDB):
+    """
+    The same tests against the txpostgres backend.
+    """
+    backend = 'txpostgres'
+    if task_db.txpostgres is None:
+        skip = 'txpostgres is not installed'
+
+    def test_getDB(self):
+        assert isinstance(self.real_db, task_db.AsyncSideloaderDB)
+        self.assertRaises(
+            ValueError, task_db.getDB, {'backend': 'carrier-pigeon'})
+
+    @defer.inlineCallbacks
+    def test_queued_before_connect(self):
+        """
+        Queries made before the pool has connected wait for it.
+        """
+        db = task_db.getDB(dictmerge(
+            TEST_DB, backend='txpostgres', pool_max=2))
+        self.addCleanup(db.p.close)
+        r = yield defer.gatherResults([
+            db.p.runQuery('SELECT %s', (i,)) for i in range(5)])
+        assert r == [[(i,)] for i in range(5)]
+        assert db.stats()['requests'] == 5
+
+    @defer.inlineCallbacks
+    def test_pool_grows(self):
+        """
+        The pool starts with pool_min connections and opens more, up to
+        pool_max, while they're all in use.
+        """
+        db = task_db.getDB(dictmerge(
+            TEST_DB, backend='txpostgres', pool_min=1, pool_max=3))
+        self.addCleanup(db.p.close)
+        yield db.p.runQuery('SELECT 1')
+        assert len(db.p.connections) == 1
+        assert (db.stats()['min'], db.stats()['max']) == (1, 3)
+
+        yield defer.gatherResults([
+            db.p.runQuery('SELECT pg_sleep(0.1)') for i in range(5)])
+        assert len(db.p.connections) == 3
+        assert db.stats()['requests'] == 6
+
+    @defer.inlineCallbacks
+    def test_stats(self):
+        """
+        The async pool keeps the same counters as the threaded one.
+        """
+        d1 = self.real_db.p.runQuery('SELECT pg_sleep(0.1)')
+        d2 = self.real_db.p.runQuery('SELECT 1')
+        yield defer.gatherResults([d1, d2])
+        stats = self.real_db.stats()
+        assert stats['max'] == 10
+        assert stats['waiting'] == 0 and stats['in_use'] == 0
+        assert stats['requests'] >= 2
@@ -1,4 +1,4 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 import os
 
 import pytest
@@ -6,14 +6,19 @@ from twisted.trial import unittest
 from twisted.internet import defer, reactor, task
 from twisted.web import resource, server
 
-from sideloader import tasks
+from sideloader import (
+    tasks, logstream, logpublisher, scheduler, task_db)
 from sideloader.tests import fake_db, repotools
 from sideloader.tests.fake_data import (
     RELEASESTREAM_QA, RELEASESTREAM_PROD, PROJECT_SIDELOADER,
-    RELEASEFLOW_QA, RELEASEFLOW_PROD, BUILD_1, WEBHOOK_QA_1, WEBHOOK_QA_2)
+    RELEASEFLOW_QA, RELEASEFLOW_PROD, BUILD_1, RELEASE_1, WEBHOOK_QA_1,
+    WEBHOOK_QA_2, SERVER_1, TARGET_1)
 from sideloader.tests.utils import dictmerge
 
 
+TARGET_LOG_FIELDS = task_db.TARGET_FIELDS + ('log',)
+
+
 @pytest.fixture
 def env_tz(monkeypatch):
     monkeypatch.setenv('TZ', 'test-5')
@@ -68,6 +73,177 @@ class FakeClient(object):
     pass
 
 
+class FakeSpecterTracker(object):
+    """
+    Hands out fake Specter clients and keeps track of what they're asked.
+    """
+
+    def __init__(self, delay=0.01):
+        self.delay = delay
+        self.active = 0
+        self.max_active = 0
+        self.calls = []
+        self.install_results = {}
+        self.history = {}
+
+    def client(self, server, output=None):
+        return FakeSpecter(self, server['name'], output)
+
+
+class FakeSpecter(object):
+    def __init__(self, tracker, host, output=None):
+        self.tracker = tracker
+        self.host = host
+        self.output = output
+        self.history = tracker.history.get(host, [])
+
+    @defer.inlineCallbacks
+    def _respond(self, call, result):
+        tracker = self.tracker
+        tracker.calls.append((self.host, call))
+        tracker.active += 1
+        tracker.max_active = max(tracker.max_active, tracker.active)
+
+        for key in ('stdout', 'stderr'):
+            if self.output and result.get(key):
+                yield self.output(key, result[key])
+
+        yield task.deferLater(reactor, tracker.delay, lambda: None)
+        tracker.active -= 1
+        defer.returnValue(result)
+
+    def get_all_stop(self):
+        return self._respond('stop', {'stdout': 'stopped'})
+
+    def get_all_start(self):
+        return self._respond('start', {'stdout': 'started'})
+
+    def get_puppet_run(self):
+        return self._respond('puppet', {'stdout': 'puppet'})
+
+    def post_install(self, data):
+        return self._respond('install', self.tracker.install_results.get(
+            self.host, {'stdout': 'installed', 'stderr': '', 'code': 0}))
+
+
+class FakeReason(object):
+    def __init__(self, exitCode):
+        self.value = self
+        self.exitCode = exitCode
+
+
+class TestBuildProcess(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.db = fake_db.FakeDB(self.clock)
+        self.db._build[1] = dictmerge(BUILD_1)
+        self.ended = []
+        self.proto = tasks.BuildProcess(
+            1, 1, 'idhash', self.db, self.end, flush_interval=0.5,
+            flush_size=10, clock=self.clock)
+
+    def end(self, *args):
+        self.ended.append(args)
+
+    def get_log(self):
+        d = self.db.getBuildLog(1)
+        self.clock.advance(0.001)
+        return self.successResultOf(d)
+
+    def test_flush_interval(self):
+        """
+        Small chunks of output are coalesced until the flush interval passes.
+        """
+        self.proto.outReceived("foo ")
+        self.proto.errReceived("bar ")
+        self.clock.advance(0.1)
+        self.assertEqual(self.get_log(), "")
+        self.clock.advance(0.5)
+        self.assertEqual(self.get_log(), "foo bar ")
+        self.assertEqual(self.db._buildlogchunk, {(1, 1): "foo bar "})
+
+    def test_flush_size(self):
+        """
+        Output is written out straight away once enough is buffered.
+        """
+        self.proto.outReceived("foo ")
+        self.proto.outReceived("bar baz ")
+        self.assertEqual(self.get_log(), "foo bar baz ")
+        self.assertEqual(self.proto.flush_call, None)
+        self.assertEqual(self.proto.offset, 12)
+
+    def test_flush_whole_characters(self):
+        """
+        Chunks don't split multi-byte characters, until the output ends.
+        """
+        self.proto.outReceived("caf\xc3")
+        self.clock.advance(0.5)
+        self.assertEqual(self.get_log(), "caf")
+        self.proto.outReceived("\xa9 ok \xe2\x82")
+        self.clock.advance(0.5)
+        self.assertEqual(self.get_log(), "caf\xc3\xa9 ok ")
+        self.assertEqual(self.db._buildlogchunk[(1, 2)], "\xc3\xa9 ok ")
+        self.proto.processEnded(FakeReason(0))
+        self.assertEqual(self.get_log(), "caf\xc3\xa9 ok \xe2\x82")
+        self.assertEqual(self.proto.offset, 11)
+
+    def test_flush_on_end(self):
+        """
+        Buffered output is written before the build callback runs.
+        """
+        self.proto.outReceived("foo ")
+        self.proto.processEnded(FakeReason(0))
+        self.assertEqual(self.ended, [])
+        self.assertEqual(self.get_log(), "foo ")
+        self.assertEqual(self.ended, [(0, 1, 1, 'idhash')])
+
+    def test_flush_in_order(self):
+        """
+        Each write waits for the one before it, and the build only ends
+        once they're all done.
+        """
+        writes = []
+
+        def appendBuildLog(id, seq, offset, data):
+            d = defer.Deferred()
+            writes.append((seq, data, d))
+            return d
+
+        self.db.appendBuildLog = appendBuildLog
+        self.proto.outReceived("foo bar baz ")
+        self.proto.outReceived("qux ")
+        self.clock.advance(0.5)
+        self.proto.outReceived("quux")
+        self.proto.processEnded(FakeReason(0))
+        self.assertEqual([w[:2] for w in writes], [(1, "foo bar baz ")])
+
+        writes[0][2].callback(None)
+        self.assertEqual([w[:2] for w in writes], [
+            (1, "foo bar baz "), (2, "qux ")])
+        writes[1][2].callback(None)
+        self.assertEqual(self.ended, [])
+        self.assertEqual([w[:2] for w in writes], [
+            (1, "foo bar baz "), (2, "qux "), (3, "quux")])
+        writes[2][2].callback(None)
+        self.assertEqual(self.ended, [(0, 1, 1, 'idhash')])
+
+    def test_publish(self):
+        """
+        Log chunks are published as they are written.
+        """
+        broker = logstream.LocalBroker()
+        sub = broker.subscribe(logstream.channel(1))
+        self.proto.publisher = logpublisher.BuildLogPublisher(broker)
+        self.proto.outReceived("foo bar baz ")
+        self.proto.outReceived("qux")
+        self.clock.advance(0.5)
+        self.assertEqual(sub.get(0), {
+            "offset": 0, "end": 12, "log": "foo bar baz "})
+        self.assertEqual(sub.get(0), {"offset": 12, "end": 15, "log": "qux"})
+        self.assertEqual(sub.get(0), None)
+
+
 class TestTasks(unittest.TestCase):
 
     def setUp(self):
@@ -77,6 +253,12 @@ class TestTasks(unittest.TestCase):
             'name': 'sideloader',
             'localdir': localdir,
         }, self.client, task_db=fake_db.FakeDB(reactor))
+        # Releases are only dispatched when a test advances this clock
+        self.clock = task.Clock()
+        self.plug.scheduler.clock = self.clock
+        # Builds share a workspace, so keep them from reusing each other's
+        # packages unless we're testing that
+        self.plug.reuse_artifacts = False
 
     def wait(self, seconds):
         return task.deferLater(reactor, seconds, lambda: None)
@@ -154,6 +336,357 @@ class TestTasks(unittest.TestCase):
             yield self.plug.db.setBuildNumber(
                 'sideloader', build_number, create=True)
 
+    @defer.inlineCallbacks
+    def setup_targets(self, count, **flow_kw):
+        yield self.setup_db(PROJECT_SIDELOADER, flow_defs=[
+            dictmerge(RELEASEFLOW_QA, stream_mode=1, **flow_kw)])
+        yield self.plug.db.setBuildFile(1, 'test-package_0.2_amd64.deb')
+        yield self.runInsert('sideloader_release', RELEASE_1)
+        for i in range(1, count + 1):
+            yield self.runInsert('sideloader_server', dictmerge(
+                SERVER_1, id=i, name='server%s.example.com' % i))
+            yield self.runInsert('sideloader_target', dictmerge(
+                TARGET_1, id=i, server_id=i))
+
+        tracker = FakeSpecterTracker()
+        self.plug.getSpecter = tracker.client
+        defer.returnValue(tracker)
+
+    @defer.inlineCallbacks
+    def test_pushTargets_parallel(self):
+        """
+        Targets are deployed to concurrently, up to the flow's limit.
+        """
+        tracker = yield self.setup_targets(5, max_parallel_targets=2)
+        notifications = self.patch_notifications()
+        release = yield self.plug.db.getRelease(1)
+        flow = yield self.plug.db.getFlow(1)
+
+        yield self.plug.pushTargets(release, flow)
+
+        self.assertEqual(tracker.max_active, 2)
+        self.assertEqual(len(tracker.calls), 5 * 4)
+        targets = yield self.plug.db.getFlowTargets(
+            1, fields=TARGET_LOG_FIELDS)
+        self.assertEqual(
+            [(t['deploy_state'], t['current_build_id'])
+             for t in id_sorted(targets)],
+            [(2, 1)] * 5)
+        self.assertEqual(
+            targets[0]['log'], '\n'.join(
+                ['', 'installed', '', 'puppet', '', 'stoppedstarted']))
+        self.assertEqual(len(notifications), 5 * 2)
+        release = yield self.plug.db.getRelease(1)
+        self.assertEqual(release['waiting'], False)
+
+    @defer.inlineCallbacks
+    def test_pushTargets_partial_failure(self):
+        """
+        A failed deployment to one target doesn't affect the others.
+        """
+        tracker = yield self.setup_targets(3, max_parallel_targets=3)
+        tracker.install_results['server2.example.com'] = {'error': 'Nope.'}
+        notifications = self.patch_notifications()
+        release = yield self.plug.db.getRelease(1)
+        flow = yield self.plug.db.getFlow(1)
+
+        yield self.plug.pushTargets(release, flow)
+
+        self.assertEqual(tracker.max_active, 3)
+        targets = yield self.plug.db.getFlowTargets(
+            1, fields=TARGET_LOG_FIELDS)
+        self.assertEqual(
+            [t['deploy_state'] for t in id_sorted(targets)], [2, 3, 2])
+        self.assertEqual(id_sorted(targets)[1]['log'], '\nNope.')
+        self.assertIn(
+            'Deployment of build test-package_0.2_amd64.deb to'
+            ' server2.example.com failed!', notifications)
+
+    @defer.inlineCallbacks
+    def test_pushTarget_streams_output(self):
+        """
+        Output goes into the target log while the deployment runs, and is
+        replaced with its summary at the end.
+        """
+        tracker = yield self.setup_targets(1)
+        self.patch_notifications()
+        release = yield self.plug.db.getRelease(1)
+        flow = yield self.plug.db.getFlow(1)
+
+        logs = []
+        post_install = FakeSpecter.post_install
+
+        def install(sc, data):
+            def installed(result):
+                logs.append(self.plug.db.db._target[1]['log'])
+                return result
+            return post_install(sc, data).addCallback(installed)
+        self.patch(FakeSpecter, 'post_install', install)
+
+        yield self.plug.pushTargets(release, flow)
+
+        self.assertEqual(logs, ['installed'])
+        [target] = yield self.plug.db.getFlowTargets(
+            1, fields=TARGET_LOG_FIELDS)
+        self.assertEqual(
+            target['log'], '\n'.join(
+                ['', 'installed', '', 'puppet', '', 'stoppedstarted']))
+
+    @defer.inlineCallbacks
+    def test_pushTargets_records_retries(self):
+        """
+        Retried Specter requests are recorded in the target log.
+        """
+        tracker = yield self.setup_targets(1)
+        tracker.history['server1.example.com'] = [
+            'GET /all/stop failed (timeout), retrying in 1.0s',
+            'GET /all/stop succeeded after 2 attempts']
+        self.patch_notifications()
+        release = yield self.plug.db.getRelease(1)
+        flow = yield self.plug.db.getFlow(1)
+
+        yield self.plug.pushTargets(release, flow)
+
+        [target] = yield self.plug.db.getFlowTargets(
+            1, fields=TARGET_LOG_FIELDS)
+        self.assertEqual(target['deploy_state'], 2)
+        self.assertTrue(target['log'].startswith(
+            'GET /all/stop failed (timeout), retrying in 1.0s\n'
+            'GET /all/stop succeeded after 2 attempts\n'))
+
+    @defer.inlineCallbacks
+    def test_sendNotification(self):
+        """
+        Notifications are queued for the project's Slack channel rather
+        than sent while we wait.
+        """
+        self.patch(tasks.settings, 'SLACK_TOKEN', 'token')
+        queued = []
+        self.patch(self.plug.slack, 'notify',
+            lambda channel, text: queued.append((channel, text)))
+        yield self.setup_db(dictmerge(PROJECT_SIDELOADER, notifications=True))
+        yield self.plug.sendNotification('Deployment started', 1)
+        self.assertEqual(
+            queued, [('#mychan', 'Test project: Deployment started')])
+
+    def test_sendEmail(self):
+        """
+        Emails are handed to the mail queue, which batches the same email
+        to several people.
+        """
+        sent = []
+
+        def send(fromAddr, to, subject, html):
+            sent.append((fromAddr, to, subject, html))
+            return defer.succeed(to)
+
+        self.patch(self.plug.mailer, 'send', send)
+        self.plug.sendEmail('me@example.com', 'Hello', 'Greetings')
+        [(fromAddr, to, subject, html)] = sent
+        self.assertEqual(fromAddr, tasks.settings.SIDELOADER_FROM)
+        self.assertEqual((to, subject), ('me@example.com', 'Greetings'))
+        self.assertTrue(html.startswith('<html>'))
+        self.assertIn('Hello', html)
+
+    def test_dbstats(self):
+        """
+        We can ask the worker how busy its database pool is.
+        """
+        stats = self.plug.call_dbstats({})
+        self.assertEqual(stats, self.plug.db.stats())
+
+    @defer.inlineCallbacks
+    def test_invalidate(self):
+        """
+        Rows saved in the web tier are dropped from the worker's cache.
+        """
+        yield self.setup_db(PROJECT_SIDELOADER, flow_defs=[RELEASEFLOW_QA])
+        flow = yield self.plug.db.getFlow(1)
+        self.assertEqual(flow['max_parallel_targets'], 1)
+
+        self.plug.db.db._releaseflow[1]['max_parallel_targets'] = 4
+        flow = yield self.plug.db.getFlow(1)
+        self.assertEqual(flow['max_parallel_targets'], 1)
+
+        self.plug.call_invalidate(
+            {'table': 'sideloader_releaseflow', 'id': 1})
+        flow = yield self.plug.db.getFlow(1)
+        self.assertEqual(flow['max_parallel_targets'], 4)
+
+    @defer.inlineCallbacks
+    def test_checkreleases(self):
+        """
+        Superseded releases are expired, releases queued behind a running
+        one are skipped and the rest are run.
+        """
+        yield self.setup_db(
+            PROJECT_SIDELOADER, flow_defs=[RELEASEFLOW_QA, RELEASEFLOW_PROD])
+        for id, flow_id, hour, lock in [
+                (1, 1, 1, False), (2, 1, 2, False),
+                (3, 2, 1, True), (4, 2, 2, False)]:
+            yield self.runInsert('sideloader_release', dictmerge(
+                RELEASE_1, id=id, flow_id=flow_id, lock=lock,
+                release_date=datetime(2016, 4, 1, hour, 0, 0)))
+
+        runs = []
+        self.plug.call_runrelease = lambda params: defer.succeed(
+            runs.append(params))
+
+        yield self.plug.call_checkreleases({})
+        yield self.wait(0)
+
+        self.assertEqual(runs, [{'release_id': 2}])
+        releases = self.plug.db._release
+        self.assertEqual(
+            [(releases[i]['waiting'], releases[i]['lock']) for i in [1, 2, 3, 4]],
+            [(False, False), (True, False), (True, True), (True, False)])
+
+    @defer.inlineCallbacks
+    def test_release_dispatched(self):
+        """
+        New releases run as soon as the scheduler wakes up.
+        """
+        yield self.setup_db(PROJECT_SIDELOADER, flow_defs=[RELEASEFLOW_QA])
+        runs = []
+        self.plug.call_runrelease = lambda params: defer.succeed(
+            runs.append(params))
+
+        yield self.plug.call_release({'build_id': 1, 'flow_id': 1})
+        self.assertEqual(runs, [])
+
+        self.clock.advance(0)
+        yield self.wait(0.01)
+        self.assertEqual(runs, [{'release_id': 1}])
+
+    @defer.inlineCallbacks
+    def test_scheduled_release_waits(self):
+        """
+        Releases scheduled for later are left in the scheduler until
+        they're due.
+        """
+        yield self.setup_db(PROJECT_SIDELOADER, flow_defs=[RELEASEFLOW_QA])
+        scheduled = datetime.now().replace(microsecond=0) + timedelta(hours=1)
+        yield self.runInsert('sideloader_release', dictmerge(
+            RELEASE_1, scheduled=scheduled, release_date=datetime.utcnow()))
+        runs = []
+        self.plug.call_runrelease = lambda params: defer.succeed(
+            runs.append(params))
+
+        yield self.plug.checkReleases()
+        self.assertEqual(runs, [])
+        self.assertEqual(self.plug.scheduler.due, {
+            1: scheduler.releaseTime(scheduled)})
+
+    @defer.inlineCallbacks
+    def test_schedule_loaded_at_startup(self):
+        """
+        Workers load the release schedule as soon as they start.
+        """
+        yield self.setup_db(PROJECT_SIDELOADER, flow_defs=[RELEASEFLOW_QA])
+        scheduled = datetime.now().replace(microsecond=0) + timedelta(hours=1)
+        yield self.runInsert('sideloader_release', dictmerge(
+            RELEASE_1, scheduled=scheduled, release_date=datetime.utcnow()))
+
+        localdir = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+        plug = tasks.Plugin({
+            'name': 'sideloader',
+            'localdir': localdir,
+        }, self.client, task_db=self.plug.db.db)
+        self.addCleanup(plug.scheduler.disarm)
+        yield self.wait(0.01)
+
+        self.assertEqual(plug.scheduler.due, {
+            1: scheduler.releaseTime(scheduled)})
+
+    @defer.inlineCallbacks
+    def test_checkReleases_coalesced(self):
+        """
+        Checks requested while one is running are folded into a single
+        follow-up run.
+        """
+        checks = []
+
+        def runReleaseQueue():
+            checks.append(True)
+            return self.wait(0.01)
+
+        self.plug.runReleaseQueue = runReleaseQueue
+        d = self.plug.checkReleases()
+        self.plug.checkReleases()
+        self.plug.checkReleases()
+        yield d
+        self.assertEqual(len(checks), 2)
+
+    def test_getRolloutWaves(self):
+        """
+        Targets are split into waves by count or percentage.
+        """
+        targets = [{'id': i} for i in [3, 1, 5, 2, 4]]
+        flow = dictmerge(RELEASEFLOW_QA, rollout_batch=0)
+
+        def wave_ids(**kw):
+            waves = self.plug.getRolloutWaves(dictmerge(flow, **kw), targets)
+            return [[t['id'] for t in wave] for wave in waves]
+
+        self.assertEqual(wave_ids(), [[1, 2, 3, 4, 5]])
+        self.assertEqual(wave_ids(rollout_batch=2), [[1, 2], [3, 4], [5]])
+        self.assertEqual(
+            wave_ids(rollout_batch=40, rollout_batch_percent=True),
+            [[1, 2], [3, 4], [5]])
+        self.assertEqual(
+            wave_ids(rollout_batch=10, rollout_batch_percent=True),
+            [[1], [2], [3], [4], [5]])
+        self.assertEqual(
+            wave_ids(rollout_batch=200, rollout_batch_percent=True),
+            [[1, 2, 3, 4, 5]])
+
+    @defer.inlineCallbacks
+    def test_pushTargets_rolling(self):
+        """
+        A rolling deployment goes out in waves.
+        """
+        tracker = yield self.setup_targets(
+            4, max_parallel_targets=4, rollout_batch=2)
+        self.patch_notifications()
+        release = yield self.plug.db.getRelease(1)
+        flow = yield self.plug.db.getFlow(1)
+
+        yield self.plug.pushTargets(release, flow)
+
+        self.assertEqual(tracker.max_active, 2)
+        installs = [host for host, call in tracker.calls if call == 'install']
+        self.assertEqual(sorted(installs[:2]), [
+            'server1.example.com', 'server2.example.com'])
+        targets = yield self.plug.db.getFlowTargets(
+            1, fields=TARGET_LOG_FIELDS)
+        self.assertEqual(
+            [t['deploy_state'] for t in id_sorted(targets)], [2, 2, 2, 2])
+
+    @defer.inlineCallbacks
+    def test_pushTargets_rolling_abort(self):
+        """
+        A rolling deployment stops once too many targets have failed.
+        """
+        tracker = yield self.setup_targets(
+            5, max_parallel_targets=2, rollout_batch=2, rollout_max_failures=1)
+        tracker.install_results['server1.example.com'] = {'error': 'Nope.'}
+        tracker.install_results['server3.example.com'] = {'error': 'Nope.'}
+        notifications = self.patch_notifications()
+        release = yield self.plug.db.getRelease(1)
+        flow = yield self.plug.db.getFlow(1)
+
+        yield self.plug.pushTargets(release, flow)
+
+        targets = yield self.plug.db.getFlowTargets(
+            1, fields=TARGET_LOG_FIELDS)
+        self.assertEqual(
+            [t['deploy_state'] for t in id_sorted(targets)], [3, 2, 3, 2, 0])
+        self.assert_notification(
+            notifications[-1], "aborted after 2 failed deployments,"
+            " 1 servers were skipped")
+        release = yield self.plug.db.getRelease(1)
+        self.assertEqual(release['waiting'], False)
+
     @defer.inlineCallbacks
     def test_build(self):
         """
@@ -171,6 +704,243 @@ class TestTasks(unittest.TestCase):
             "projects/build/view/1|#1> started for branch develop",
             "projects/build/view/1|#1> successful",
         ])
+        log = yield self.plug.db.getBuildLog(1)
+        self.assertIn("Launching build script", log)
+
+    @defer.inlineCallbacks
+    def test_build_reused(self):
+        """
+        Building a commit which has been built before reuses its package.
+        """
+        self.plug.reuse_artifacts = True
+        repo = self.mkrepo('sideloader')
+        yield self.setup_db(dictmerge(PROJECT_SIDELOADER, github_url=repo.url))
+        self.patch_notifications()
+        yield self.plug.call_build({'build_id': 1})
+        build = yield self._wait_for_build(1)
+        self.assertEqual(build['state'], 1)
+        self.assertEqual(build['commit'], repo.head())
+
+        yield self.runInsert('sideloader_build', dictmerge(BUILD_1, id=2))
+        yield self.plug.call_build({'build_id': 2})
+        build = yield self._wait_for_build(2)
+        self.assertEqual(build['state'], 1)
+        self.assertEqual(build['commit'], repo.head())
+        self.assertEqual(build['build_file'], 'test-package_0.2_amd64.deb')
+        log = yield self.plug.db.getBuildLog(2)
+        self.assertIn("Reusing package test-package_0.2_amd64.deb", log)
+        self.assertNotIn("Launching build script", log)
+
+    @defer.inlineCallbacks
+    def test_build_recorded_commit(self):
+        """
+        A build of a commit that was pushed to us builds that commit, even
+        if the branch has moved on since.
+        """
+        repo = self.mkrepo('sideloader')
+        pushed = repo.head()
+        repo.add_file("NEWS", "Moved on")
+        repo.commit("Move on.")
+        yield self.setup_db(dictmerge(PROJECT_SIDELOADER, github_url=repo.url))
+        self.plug.db.db._build[1]['commit'] = pushed
+
+        resolved = []
+        self.plug.resolveCommit = lambda *a: resolved.append(a)
+        self.patch_notifications()
+        yield self.plug.call_build({'build_id': 1})
+        build = yield self._wait_for_build(1)
+        self.assertEqual(build['state'], 1)
+        self.assertEqual(build['commit'], pushed)
+        self.assertEqual(resolved, [])
+
+    @defer.inlineCallbacks
+    def test_build_commit_pushed_before_claim(self):
+        """
+        A push that lands after we've read a build but before we've claimed
+        it is folded into that build, so we build the newer commit.
+        """
+        repo = self.mkrepo('sideloader')
+        first = repo.head()
+        repo.add_file("NEWS", "Moved on")
+        repo.commit("Move on.")
+        pushed = repo.head()
+        yield self.setup_db(dictmerge(PROJECT_SIDELOADER, github_url=repo.url))
+        self.plug.db.db._build[1]['commit'] = first
+
+        getBuild = self.plug.db.getBuild
+
+        def push_after_read(build_id, *a, **kw):
+            d = getBuild(build_id, *a, **kw)
+
+            def push(build):
+                self.plug.db.db._build[build_id]['commit'] = pushed
+                return build
+            return d.addCallback(push)
+
+        self.plug.db.getBuild = push_after_read
+        commands = []
+        buildCommand = self.plug.buildCommand
+        self.plug.buildCommand = lambda args: (
+            commands.append(args) or buildCommand(args))
+        self.patch_notifications()
+        yield self.plug.call_build({'build_id': 1})
+        self.plug.db.getBuild = getBuild
+        build = yield self._wait_for_build(1)
+        self.assertEqual(build['state'], 1)
+        self.assertEqual(build['commit'], pushed)
+        [args] = commands
+        self.assertEqual(args[args.index('--commit') + 1], pushed)
+
+    @defer.inlineCallbacks
+    def test_build_pool(self):
+        """
+        Builds for different projects share a fixed number of workers, and
+        we keep track of how long they wait for one.
+        """
+        self.plug.build_pool = defer.DeferredSemaphore(1)
+        yield self.setup_db(PROJECT_SIDELOADER)
+        yield self.runInsert('sideloader_project', dictmerge(
+            PROJECT_SIDELOADER, id=2, idhash='b' * 32))
+        yield self.runInsert('sideloader_build', dictmerge(
+            BUILD_1, id=2, project_id=2))
+
+        running = {}
+
+        def doBuild(build_id, build, project, waited=0):
+            running[build_id] = d = defer.Deferred()
+            return d
+
+        self.plug.doBuild = doBuild
+        yield self.plug.call_build({'build_id': 1})
+        yield self.plug.call_build({'build_id': 2})
+        self.assertEqual(running.keys(), [1])
+
+        stats = self.plug.call_buildstats({})
+        self.assertEqual(
+            (stats['workers'], stats['running'], stats['waiting']), (1, 1, 1))
+
+        running[1].callback(None)
+        yield self.wait(0.01)
+        self.assertEqual(sorted(running.keys()), [1, 2])
+        stats = self.plug.call_buildstats({})
+        self.assertEqual((stats['running'], stats['waiting']), (1, 0))
+        self.assertEqual(stats['builds'], 2)
+        running[2].callback(None)
+        yield self.wait(0.01)
+
+    @defer.inlineCallbacks
+    def test_build_claims(self):
+        """
+        A project is only built by one worker at a time. Builds held by a
+        worker which has gone away are failed, and builds asked for in the
+        meantime run once the project is free.
+        """
+        yield self.setup_db(PROJECT_SIDELOADER)
+        db = self.plug.db.db
+        db._build[1].update(worker='otherhost:1', heartbeat=reactor.seconds())
+        yield self.runInsert('sideloader_build', dictmerge(BUILD_1, id=2))
+
+        running = {}
+
+        def doBuild(build_id, build, project, waited=0):
+            running[build_id] = d = defer.Deferred()
+            return d
+
+        self.plug.doBuild = doBuild
+
+        # The other worker is still checking in
+        yield self.plug.call_build({'build_id': 2})
+        self.assertEqual(running, {})
+
+        db._build[1]['heartbeat'] -= self.plug.build_timeout + 1
+        yield self.plug.call_build({'build_id': 2})
+        self.assertEqual(running.keys(), [2])
+        self.assertEqual(db._build[1]['state'], 2)
+        self.assertEqual(db._build[2]['worker'], self.plug.worker_id)
+        self.assertEqual(self.plug.running_builds, set([2]))
+
+        # Asking again doesn't build it twice
+        yield self.plug.call_build({'build_id': 2})
+        self.assertEqual(running.keys(), [2])
+
+        # Pushes while we're building wait for us
+        yield self.runInsert('sideloader_build', dictmerge(BUILD_1, id=3))
+        yield self.plug.call_build({'build_id': 3})
+        self.assertEqual(running.keys(), [2])
+        db._build[2]['state'] = 1
+        running[2].callback(None)
+        yield self.wait(0.01)
+        self.assertEqual(sorted(running.keys()), [2, 3])
+
+        # A worker on this host which has died lets go of its builds
+        db._build[3]['worker'] = '%s:%s' % (self.plug.hostname, 2 ** 30)
+        self.plug.running_builds.discard(3)
+        yield self.runInsert('sideloader_build', dictmerge(BUILD_1, id=4))
+        yield self.plug.call_build({'build_id': 4})
+        self.assertEqual(db._build[3]['state'], 2)
+        self.assertEqual(sorted(running.keys()), [2, 3, 4])
+        db._build[4]['state'] = 1
+        running[3].callback(None)
+        running[4].callback(None)
+        yield self.wait(0.01)
+        self.assertEqual(self.plug.heartbeat_call, None)
+
+    @defer.inlineCallbacks
+    def test_build_claims_released_on_error(self):
+        """
+        A build which can't even be ended stops holding the project, and
+        the next build for it still starts.
+        """
+        yield self.setup_db(PROJECT_SIDELOADER)
+        yield self.runInsert('sideloader_build', dictmerge(BUILD_1, id=2))
+
+        started = []
+
+        def doBuild(build_id, build, project, waited=0):
+            started.append(build_id)
+            if build_id == 1:
+                raise Exception("Build went wrong")
+            return defer.succeed(None)
+
+        def endBuild(*a):
+            raise Exception("Database went away")
+
+        self.plug.doBuild = doBuild
+        self.plug.endBuild = endBuild
+
+        yield self.plug.call_build({'build_id': 1})
+        yield self.wait(0.01)
+
+        self.assertEqual(self.flushLoggedErrors(Exception)[0].getErrorMessage(),
+            "Database went away")
+        self.assertEqual(self.plug.running_builds, set())
+        self.assertEqual(self.plug.heartbeat_call, None)
+        self.assertEqual(started, [1, 2])
+
+    def test_buildCommand(self):
+        """
+        Builds run at a lower CPU and IO priority, and in their own cgroup
+        if asked.
+        """
+        self.patch(tasks.procutils, 'which', lambda name: ['/bin/' + name])
+        args = ['build_package', '--id', 'abc', 'git@github.com:a/b.git']
+        buildpack = self.plug.buildpack
+
+        self.assertEqual(self.plug.buildCommand(args), [
+            '/bin/nice', '-n', '10',
+            '/bin/ionice', '-c', '2', '-n', '7', '-t',
+            buildpack, '--id', 'abc', 'git@github.com:a/b.git'])
+
+        self.plug.build_nice = 0
+        self.plug.build_ionice = None
+        self.plug.build_cpu_quota = '200%'
+        self.assertEqual(self.plug.buildCommand(args), [
+            '/bin/systemd-run', '--scope', '--quiet', '-p', 'CPUQuota=200%',
+            buildpack, '--id', 'abc', 'git@github.com:a/b.git'])
+
+        self.patch(tasks.procutils, 'which', lambda name: [])
+        self.assertEqual(self.plug.buildCommand(args), [
+            buildpack, '--id', 'abc', 'git@github.com:a/b.git'])
 
     @defer.inlineCallbacks
     def test_build_bad_url(self):
@@ -283,8 +1053,8 @@ class TestTasks(unittest.TestCase):
         build = yield self._wait_for_build(1)
         self.assertEqual(build['state'], 1)
 
-        # FIXME: We dig directly into our fake db here, because we haven't
-        #        implemented FakeDB.getReleases() yet.
+        # The task db has no query for every release, so we dig directly
+        # into our fake db here.
         self.assertEqual(self.plug.db._release, {})
         yield self.plug.call_release(
             {'build_id': 1, 'flow_id': RELEASEFLOW_PROD['id']})
@@ -313,8 +1083,8 @@ class TestTasks(unittest.TestCase):
         yield self.plug.call_build({'build_id': 1})
         build = yield self._wait_for_build(1)
         self.assertEqual(build['state'], 1)
-        # FIXME: We dig directly into our fake db here, because we haven't
-        #        implemented FakeDB.getReleases() yet.
+        # The task db has no query for every release, so we dig directly
+        # into our fake db here.
         self.assertEqual(self.plug.db._release, {})
         yield self.plug.call_release(
             {'build_id': 1, 'flow_id': RELEASEFLOW_PROD['id']})
@@ -340,8 +1110,8 @@ class TestTasks(unittest.TestCase):
             flow_defs=[RELEASEFLOW_QA])
         yield self.plug.call_build({'build_id': 1})
 
-        # FIXME: We dig directly into our fake db here, because we haven't
-        #        implemented FakeDB.getReleases() yet.
+        # The task db has no query for every release, so we dig directly
+        # into our fake db here.
         self.assertEqual(self.plug.db._release, {})
 
         build = yield self._wait_for_build(1)
@@ -367,8 +1137,8 @@ class TestTasks(unittest.TestCase):
             flow_defs=[RELEASEFLOW_QA])
         yield self.plug.call_build({'build_id': 1})
 
-        # FIXME: We dig directly into our fake db here, because we haven't
-        #        implemented FakeDB.getReleases() yet.
+        # The task db has no query for every release, so we dig directly
+        # into our fake db here.
         self.assertEqual(self.plug.db._release, {})
         yield self._wait_for_build(1)
         [release] = yield self.plug.db._release.values()
@@ -402,8 +1172,8 @@ class TestTasks(unittest.TestCase):
 
         yield self.plug.call_build({'build_id': 1})
 
-        # FIXME: We dig directly into our fake db here, because we haven't
-        #        implemented FakeDB.getReleases() yet.
+        # The task db has no query for every release, so we dig directly
+        # into our fake db here.
         self.assertEqual(self.plug.db._release, {})
         yield self._wait_for_build(1)
         [release] = yield self.plug.db._release.values()
@@ -443,8 +1213,8 @@ class TestTasks(unittest.TestCase):
 
         yield self.plug.call_build({'build_id': 1})
 
-        # FIXME: We dig directly into our fake db here, because we haven't
-        #        implemented FakeDB.getReleases() yet.
+        # The task db has no query for every release, so we dig directly
+        # into our fake db here.
         self.assertEqual(self.plug.db._release, {})
         yield self._wait_for_build(1)
         [release] = yield self.plug.db._release.values()
@@ -1,9 +1,18 @@
+import base64
+import hashlib
+import hmac
+import json
+
 from django.contrib.auth.models import User
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.core.urlresolvers import reverse
+from django.db.models.query import QuerySet
 import pytest
 
-from sideloader.models import Project, ReleaseFlow, ReleaseStream, WebHook
+from sideloader import dbcache, logpublisher, logstream, models, views
+from sideloader.models import (
+    Build, BuildLogChunk, Project, ReleaseFlow, ReleaseStream, Server,
+    WebHook)
 
 
 class TestIndex(TestCase):
@@ -86,6 +95,166 @@ class TestProject(TestCase):
         self.assertEqual(qa_f.stream, qa_stream)
 
 
+class TestBuild(TestCase):
+    def setUp(self):
+        self.root = User.objects.create_superuser(
+            "root", "root@localhost", "pass")
+        self.proj = Project.objects.create(
+            name="My Project", github_url="foo.git", branch="develop",
+            created_by_user=self.root, idhash="seekrit")
+        self.build = Build.objects.create(project=self.proj)
+
+    def test_build_output(self):
+        """
+        The build output is reassembled from the build's log chunks.
+        """
+        BuildLogChunk.objects.create(
+            build=self.build, seq=2, byte_offset=6, data="world\n")
+        BuildLogChunk.objects.create(
+            build=self.build, seq=1, byte_offset=0, data="hello ")
+        self.client.login(username="root", password="pass")
+        resp = self.client.get(reverse("build_output", args=[self.build.pk]))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.content), {
+            "state": 0,
+            "log": "hello world\n",
+        })
+
+    def get_log_tail(self, offset):
+        resp = self.client.get(
+            reverse("build_output", args=[self.build.pk]), {"offset": offset})
+        self.assertEqual(resp.status_code, 200)
+        return json.loads(resp.content)
+
+    def test_build_output_offset(self):
+        """
+        Given an offset, we only get the log after it and the new offset.
+        """
+        self.client.login(username="root", password="pass")
+        self.assertEqual(
+            self.get_log_tail(0), {"state": 0, "log": "", "offset": 0})
+
+        BuildLogChunk.objects.create(
+            build=self.build, seq=1, byte_offset=0, data="hello ")
+        BuildLogChunk.objects.create(
+            build=self.build, seq=2, byte_offset=6, data="world\n")
+        self.assertEqual(
+            self.get_log_tail(0),
+            {"state": 0, "log": "hello world\n", "offset": 12})
+        self.assertEqual(
+            self.get_log_tail(6), {"state": 0, "log": "world\n", "offset": 12})
+        self.assertEqual(
+            self.get_log_tail(8), {"state": 0, "log": "rld\n", "offset": 12})
+        self.assertEqual(
+            self.get_log_tail(12), {"state": 0, "log": "", "offset": 12})
+
+    def test_build_output_split_character(self):
+        """
+        Chunks are raw bytes, a character split between them is only sent
+        once both halves are there.
+        """
+        self.client.login(username="root", password="pass")
+        BuildLogChunk.objects.create(
+            build=self.build, seq=1, byte_offset=0, data="caf\xc3")
+        self.assertEqual(
+            self.get_log_tail(0), {"state": 0, "log": "caf", "offset": 3})
+
+        BuildLogChunk.objects.create(
+            build=self.build, seq=2, byte_offset=4, data="\xa9\\n")
+        self.assertEqual(
+            self.get_log_tail(3),
+            {"state": 0, "log": u"\xe9\\n", "offset": 7})
+        self.assertEqual(self.build.get_log(), u"caf\xe9\\n")
+
+    def test_build_output_offset_legacy_log(self):
+        """
+        Logs stored directly on the build come before any log chunks.
+        """
+        self.build.log = "Build failed\n"
+        self.build.state = 2
+        self.build.save()
+        self.client.login(username="root", password="pass")
+        self.assertEqual(
+            self.get_log_tail(6), {"state": 2, "log": "failed\n", "offset": 13})
+
+    def test_build_output_bad_offset(self):
+        """
+        An offset which isn't a number is a bad request.
+        """
+        self.client.login(username="root", password="pass")
+        resp = self.client.get(
+            reverse("build_output", args=[self.build.pk]), {"offset": "abc"})
+        self.assertEqual(resp.status_code, 400)
+
+    def parse_events(self, resp):
+        events = []
+        for block in ''.join(resp.streaming_content).split("\n\n"):
+            fields = dict(
+                line.split(": ", 1) for line in block.splitlines()
+                if not line.startswith(":"))
+            if fields:
+                events.append((fields["event"], json.loads(fields["data"])))
+        return events
+
+    @override_settings(SIDELOADER_LOG_STREAM="local://")
+    def test_build_stream(self):
+        """
+        We can stream the build log as it is published, after catching up
+        on what is already there.
+        """
+        BuildLogChunk.objects.create(
+            build=self.build, seq=1, byte_offset=0, data="hello ")
+        self.client.login(username="root", password="pass")
+        resp = self.client.get(reverse("build_stream", args=[self.build.pk]))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp["Content-Type"], "text/event-stream")
+
+        # Published after we subscribed, but before and after catching up.
+        publisher = logpublisher.getPublisher("local://")
+        publisher.publishLog(self.build.pk, 0, "hello ")
+        publisher.publishLog(self.build.pk, 6, "world\n")
+        publisher.publishState(self.build.pk, 1)
+
+        self.assertEqual(self.parse_events(resp), [
+            ("log", {"log": "hello "}),
+            ("log", {"log": "world\n"}),
+            ("state", {"state": 1}),
+        ])
+        self.assertEqual(logstream.localBroker.subscriptions[
+            logstream.channel(self.build.pk)], [])
+
+    @override_settings(SIDELOADER_LOG_STREAM="local://")
+    def test_build_stream_finished(self):
+        """
+        Streaming a finished build sends the log and the final state.
+        """
+        self.build.state = 1
+        self.build.save()
+        BuildLogChunk.objects.create(
+            build=self.build, seq=1, byte_offset=0, data="hello ")
+        self.client.login(username="root", password="pass")
+        resp = self.client.get(
+            reverse("build_stream", args=[self.build.pk]),
+            HTTP_LAST_EVENT_ID="2")
+        self.assertEqual(self.parse_events(resp), [
+            ("log", {"log": "llo "}),
+            ("state", {"state": 1}),
+        ])
+
+    @override_settings(SIDELOADER_LOG_STREAM="local://")
+    def test_build_stream_bad_offset(self):
+        """
+        A Last-Event-ID which isn't a number is a bad request.
+        """
+        self.client.login(username="root", password="pass")
+        resp = self.client.get(
+            reverse("build_stream", args=[self.build.pk]),
+            HTTP_LAST_EVENT_ID="abc")
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(logstream.localBroker.subscriptions.get(
+            logstream.channel(self.build.pk), []), [])
+
+
 class TestReleaseFlow(TestCase):
     def setUp(self):
         self.root = User.objects.create_superuser(
@@ -242,3 +411,204 @@ class TestWebhook(TestCase):
 
         url = reverse("webhooks_create", args=[self.prod_flow.pk])
         self.assert_form_field_choices(url, 'after', [(u'', u'---------')])
+
+
+class FakeRhumbaClient(object):
+    queued = []
+
+    def queue(self, queue, message, params={}, uids=[]):
+        self.queued.append((queue, message, params))
+        return 'id'
+
+
+class BrokenRhumbaClient(object):
+    def queue(self, *a, **kw):
+        raise IOError("Connection refused")
+
+
+class TestCacheInvalidation(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("me", "me@example.com", "pass")
+        self.stream = ReleaseStream.objects.create(name="QA")
+        self.addCleanup(setattr, models, 'RhumbaClient', models.RhumbaClient)
+        models.RhumbaClient = FakeRhumbaClient
+        FakeRhumbaClient.queued = []
+
+    def test_save_and_delete(self):
+        """
+        Saving or deleting cached models tells the worker to forget them.
+        """
+        proj = Project.objects.create(
+            name="My Project", github_url="foo.git", branch="develop",
+            created_by_user=self.user, release_stream=self.stream)
+        proj_id = proj.pk
+        proj.delete()
+        self.stream.save()
+        self.assertEqual(FakeRhumbaClient.queued, [
+            ('sideloader', 'invalidate',
+             {'table': 'sideloader_project', 'id': proj_id}),
+            ('sideloader', 'invalidate',
+             {'table': 'sideloader_project', 'id': proj_id}),
+            ('sideloader', 'invalidate',
+             {'table': 'sideloader_releasestream', 'id': self.stream.pk}),
+        ])
+
+    def test_uncached_models(self):
+        """
+        Models the worker doesn't cache don't queue anything.
+        """
+        Build.objects.create(project=Project.objects.create(
+            name="My Project", github_url="foo.git", branch="develop",
+            created_by_user=self.user, release_stream=self.stream))
+        self.assertEqual(
+            [p['table'] for q, m, p in FakeRhumbaClient.queued],
+            ['sideloader_project'])
+
+    def test_unreachable(self):
+        """
+        Saves still work if the worker can't be told about them.
+        """
+        models.RhumbaClient = BrokenRhumbaClient
+        self.stream.save()
+
+    def test_held_until_request_finished(self):
+        """
+        Rows saved during a request are invalidated once, after it's done.
+        """
+        models.hold_invalidations()
+        self.stream.save()
+        self.stream.save()
+        self.assertEqual(FakeRhumbaClient.queued, [])
+
+        models.send_invalidations()
+        self.assertEqual(FakeRhumbaClient.queued, [
+            ('sideloader', 'invalidate',
+             {'table': 'sideloader_releasestream', 'id': self.stream.pk}),
+        ])
+
+    @override_settings(SIDELOADER_LOG_STREAM="local://")
+    def test_broadcast(self):
+        """
+        With a log stream, every worker drops saved rows from its cache.
+        """
+        kept = ('sideloader_releasestream', 0, 'row')
+        saved = ('sideloader_releasestream', self.stream.pk, 'row')
+        caches = [dbcache.CachedDB(None), dbcache.CachedDB(None)]
+        for cache in caches:
+            cache.rows[kept] = cache.rows[saved] = (float('inf'), {})
+            listener = logpublisher.listen(
+                "local://", logstream.INVALIDATE_CHANNEL,
+                lambda params, cache=cache: cache.invalidate(
+                    params['table'], params['id']))
+            self.addCleanup(listener.close)
+
+        self.stream.save()
+        self.assertEqual([cache.rows.keys() for cache in caches],
+                         [[kept], [kept]])
+        self.assertEqual(FakeRhumbaClient.queued, [])
+
+    @override_settings(SPECTER_AUTHCODE='auth', SPECTER_SECRET='secret')
+    def test_checkin(self):
+        """
+        Server checkins don't touch anything the worker caches.
+        """
+        server = Server.objects.create(name='server1.example.com')
+        FakeRhumbaClient.queued = []
+
+        body = json.dumps({'hostname': 'server1.example.com'})
+        sig = hmac.new(key='secret', digestmod=hashlib.sha1, msg='\n'.join(
+            ['auth', 'POST', '/api/checkin', hashlib.sha1(body).hexdigest()]))
+        resp = self.client.post('/api/checkin', body,
+            content_type='application/json', HTTP_AUTHORIZATION='auth',
+            HTTP_SIG=base64.b64encode(sig.digest()))
+        self.assertEqual(json.loads(resp.content), {})
+
+        server = Server.objects.get(pk=server.pk)
+        self.assertTrue(server.age() < 60)
+        self.assertEqual(FakeRhumbaClient.queued, [])
+
+
+class TestBuildQueue(TestCase):
+    def setUp(self):
+        self.root = User.objects.create_superuser(
+            "root", "root@localhost", "pass")
+        self.proj = Project.objects.create(
+            name="My Project", github_url="foo.git", branch="develop",
+            created_by_user=self.root, idhash="seekrit")
+        self.addCleanup(setattr, views, 'RhumbaClient', views.RhumbaClient)
+        views.RhumbaClient = FakeRhumbaClient
+        FakeRhumbaClient.queued = []
+
+    def push(self, commit, branch="develop"):
+        resp = self.client.post(
+            reverse("api_build", args=[self.proj.idhash]),
+            json.dumps({"ref": "refs/heads/" + branch, "after": commit}),
+            content_type="application/json")
+        return json.loads(resp.content)["result"]
+
+    def test_pushes_coalesced(self):
+        """
+        Pushes which arrive before their build starts fold into it, and it
+        takes on the newest commit.
+        """
+        self.assertEqual(self.push("a" * 40), "Building")
+        self.assertEqual(self.push("b" * 40), "Already building")
+        self.assertEqual(self.push("c" * 40, branch="other"),
+                         "Request ignored")
+
+        [build] = Build.objects.all()
+        self.assertEqual(build.commit, "b" * 40)
+        self.assertEqual(build.task_id, "id")
+        self.assertEqual(FakeRhumbaClient.queued, [
+            ('sideloader', 'build', {'build_id': build.pk}),
+            ('sideloader', 'build', {'build_id': build.pk}),
+        ])
+
+    def test_push_while_building(self):
+        """
+        Pushes while a build is running queue the next one.
+        """
+        self.push("a" * 40)
+        Build.objects.update(worker="buildhost:1234")
+        self.assertEqual(self.push("b" * 40), "Building")
+        self.assertEqual(self.push("c" * 40), "Already building")
+        self.assertEqual(
+            [(b.worker, b.commit) for b in Build.objects.order_by('id')],
+            [("buildhost:1234", "a" * 40), ("", "c" * 40)])
+
+    def test_push_while_claimed(self):
+        """
+        A push which finds a build waiting that a worker claims before
+        the push can fold into it queues the next build.
+        """
+        self.push("a" * 40)
+        first = QuerySet.first
+
+        def claimed_first(qs):
+            build = first(qs)
+            Build.objects.update(worker="buildhost:1234")
+            return build
+        self.addCleanup(setattr, QuerySet, 'first', first)
+        QuerySet.first = claimed_first
+
+        self.assertEqual(self.push("b" * 40), "Building")
+        QuerySet.first = first
+        self.assertEqual(
+            [(b.worker, b.commit) for b in Build.objects.order_by('id')],
+            [("buildhost:1234", "a" * 40), ("", "b" * 40)])
+
+    def test_manual_build(self):
+        """
+        Building from the project page shows the waiting build, if there is
+        one.
+        """
+        self.client.login(username="root", password="pass")
+        url = reverse("projects_build", args=[self.proj.pk])
+        resp = self.client.get(url)
+        [build] = Build.objects.all()
+        self.assertRedirects(resp, reverse("build_view", args=[build.pk]),
+                             fetch_redirect_response=False)
+        resp = self.client.get(url)
+        self.assertRedirects(resp, reverse("build_view", args=[build.pk]),
+                             fetch_redirect_response=False)
+        self.assertEqual(Build.objects.count(), 1)
@@ -9,10 +9,11 @@ from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.csrf import csrf_exempt
 from django.core.urlresolvers import reverse
-from django.http import HttpResponse
+from django.http import (HttpResponse, HttpResponseBadRequest,
+    HttpResponseForbidden, StreamingHttpResponse)
 from django.conf import settings
 
-from sideloader import forms, models
+from sideloader import forms, models, logstream
 
 from rhumba.client import RhumbaClient
 
@@ -38,6 +39,25 @@ def verifyHMAC(request, data=None):
 
     return base64.b64encode(mysig) == sig
 
+def queue_build(project, commit=''):
+    """
+    Queues a build of the project. A burst of requests all land on the same
+    build until a worker starts it.
+    """
+    build, created = project.pending_build(commit)
+
+    # Queued again even if it already was, in case its last task found the
+    # project busy and the worker building it has since gone away
+    taskid = RhumbaClient().queue('sideloader', 'build', {
+        'build_id': build.id
+    })
+
+    if created:
+        build.task_id = taskid
+        build.save(update_fields=['task_id'])
+
+    return build, created
+
 def getProjects(request):
     if request.user.is_superuser:
         return models.Project.objects.all().order_by('name')
@@ -543,6 +563,7 @@ def build_view(request, id):
     if (request.user.is_superuser) or (
         build.project in request.user.project_set.all()):
         d['build'] = build
+        d['log_stream'] = bool(settings.SIDELOADER_LOG_STREAM)
 
     return render(request, 'projects/build_view.html', d)
 
@@ -686,22 +707,8 @@ def projects_build(request, id):
     project = models.Project.objects.get(id=id)
     if project and (request.user.is_superuser or (
         project in request.user.project_set.all())):
-        current_builds = models.Build.objects.filter(project=project, state=0)
-        if current_builds:
-            return redirect('build_view', id=current_builds[0].id)
-        else:
-            build = models.Build.objects.create(project=project, state=0)
-
-            build.save()
-
-            taskid = RhumbaClient().queue('sideloader', 'build', {
-                'build_id': build.id
-            })
-
-            build.task_id = taskid
-            build.save()
-
-            return redirect('build_view', id=build.id)
+        build, created = queue_build(project)
+        return redirect('build_view', id=build.id)
 
     return redirect('home')
 
@@ -711,12 +718,103 @@ def build_output(request, id):
 
     if (request.user.is_superuser) or (
         build.project in request.user.project_set.all()):
-        d = {'state': build.state, 'log': build.log}
+        offset = request.GET.get('offset')
+        if offset is not None:
+            try:
+                offset = max(int(offset), 0)
+            except ValueError:
+                return HttpResponseBadRequest('Bad offset')
+
+            # Only send what the client hasn't seen yet
+            log, offset = build.get_log_tail(offset)
+            d = {
+                'state': build.state,
+                'log': log.decode('utf-8', 'replace'),
+                'offset': offset
+            }
+        else:
+            d = {'state': build.state, 'log': build.get_log()}
     else:
         d = {}
 
     return HttpResponse(json.dumps(d), content_type='application/json')
 
+def sse_event(event, data, id=None):
+    msg = ''
+    if id is not None:
+        msg += 'id: %s\n' % id
+    return msg + 'event: %s\ndata: %s\n\n' % (event, json.dumps(data))
+
+@login_required
+def build_stream(request, id):
+    build = models.Build.objects.get(id=id)
+
+    if not ((request.user.is_superuser) or (
+        build.project in request.user.project_set.all())):
+        return HttpResponseForbidden()
+
+    if not settings.SIDELOADER_LOG_STREAM:
+        return redirect('build_output', id=build.id)
+
+    try:
+        offset = int(request.META.get('HTTP_LAST_EVENT_ID') or
+            request.GET.get('offset', 0))
+    except ValueError:
+        return HttpResponseBadRequest('Bad offset')
+
+    # Subscribe before catching up so nothing published in between is lost
+    subscription = logstream.getBroker(
+        settings.SIDELOADER_LOG_STREAM).subscribe(logstream.channel(build.id))
+
+    def stream(offset):
+        try:
+            log, offset = build.get_log_tail(max(offset, 0))
+            yield sse_event('log', {'log': log.decode('utf-8', 'replace')},
+                id=offset)
+
+            state = build.state
+            while state == 0:
+                msg = subscription.get(timeout=15)
+
+                if msg is None:
+                    # Keep the connection open, and make sure we didn't
+                    # miss the end of the build
+                    yield ': keepalive\n\n'
+                    state = models.Build.objects.filter(id=build.id
+                        ).values_list('state', flat=True)[0]
+                    if state == 0:
+                        continue
+                    msg = {'state': state}
+
+                if 'log' in msg:
+                    if msg['end'] <= offset:
+                        # Already sent during catch up
+                        continue
+                    if msg['offset'] == offset:
+                        log, offset = msg['log'], msg['end']
+                    else:
+                        # We missed something, fill it in from the database
+                        log, offset = build.get_log_tail(offset)
+                        log = log.decode('utf-8', 'replace')
+                    yield sse_event('log', {'log': log}, id=offset)
+
+                if 'state' in msg:
+                    state = msg['state']
+                    log, offset = build.get_log_tail(offset)
+                    if log:
+                        yield sse_event('log',
+                            {'log': log.decode('utf-8', 'replace')}, id=offset)
+
+            yield sse_event('state', {'state': state})
+        finally:
+            subscription.close()
+
+    response = StreamingHttpResponse(stream(offset),
+        content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
 @login_required
 def get_servers(request):
     d = [s.name for s in models.Server.objects.all()]
@@ -748,20 +846,12 @@ def api_build(request, hash):
             if branch != project.branch:
                 return HttpResponse('{"result": "Request ignored"}',
                         content_type='application/json')
+            commit = r.get('after', '')
+        else:
+            commit = ''
 
-        current_builds = models.Build.objects.filter(project=project, state=0)
-        if not current_builds:
-            build = models.Build.objects.create(project=project, state=0)
-
-            build.save()
-
-            taskid = RhumbaClient().queue('sideloader', 'build', {
-                'build_id': build.id
-            })
-
-            build.task_id = taskid
-            build.save()
-
+        build, created = queue_build(project, commit)
+        if created:
             return HttpResponse('{"result": "Building"}',
                     content_type='application/json')
         return HttpResponse('{"result": "Already building"}',
@@ -799,7 +889,7 @@ def api_checkin(request):
 
             server.last_checkin = datetime.now()
 
-            server.save()
+            server.save(update_fields=['last_checkin'])
 
             return HttpResponse(json.dumps({}), 
                 content_type='application/json')
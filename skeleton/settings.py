@@ -188,9 +188,64 @@ SIDELOADER_DOMAIN = socket.getfqdn()
 SIDELOADER_FROM = 'Sideloader <no-reply@%s>' % SIDELOADER_DOMAIN
 SIDELOADER_PACKAGEURL = "http://%s/packages" % SIDELOADER_DOMAIN
 
+# Outgoing mail from the worker. Emails queued within SIDELOADER_MAIL_WINDOW
+# seconds are sent over one SMTP session, and transient failures are
+# retried with exponential backoff.
+SIDELOADER_SMTP_HOST = 'localhost'
+SIDELOADER_SMTP_PORT = 25
+SIDELOADER_MAIL_WINDOW = 1.0
+SIDELOADER_MAIL_RETRIES = 3
+SIDELOADER_MAIL_RETRY_BACKOFF = 30.0
+
+# Stream live build logs from this pub/sub server, this must match
+# log_stream in config.yaml. Build pages poll for the log when it's unset.
+# Workers also hear over it which cached rows were saved here.
+# Each stream holds a request open, so serve them from gevent workers as
+# etc/gunicorn.conf.py does.
+SIDELOADER_LOG_STREAM = None
+
+# Requests made to each Specter agent at once, over persistent connections
+# which may sit idle for SPECTER_POOL_IDLE_TIMEOUT seconds
+SPECTER_POOL_MAX_PER_HOST = 2
+SPECTER_POOL_IDLE_TIMEOUT = 240
+# Seconds to wait for a Specter agent to accept a connection, and to
+# answer a request. Failed GETs are retried with jittered exponential
+# backoff starting at SPECTER_RETRY_BACKOFF seconds.
+SPECTER_CONNECT_TIMEOUT = 10
+SPECTER_READ_TIMEOUT = 600
+SPECTER_RETRIES = 3
+SPECTER_RETRY_BACKOFF = 1.0
+SPECTER_RETRY_MAX_BACKOFF = 30.0
+# Specter responses larger than this many bytes are spooled to disk, and
+# only the tail of command output is kept for target logs
+SPECTER_SPOOL_SIZE = 1024 * 1024
+SPECTER_MAX_OUTPUT = 256 * 1024
+
+# Connection pool used by the task worker. Connection parameters come from
+# DATABASES['default'] unless TASK_DB (or task_db in config.yaml) overrides
+# them. Statements running longer than TASK_DB_STATEMENT_TIMEOUT
+# milliseconds are cancelled, 0 means no limit.
+TASK_DB = {}
+# 'adbapi' runs queries on a thread pool, 'txpostgres' on non-blocking
+# connections, TASK_DB_POOL_MIN of them opened up front and more up to
+# TASK_DB_POOL_MAX while they're all busy
+TASK_DB_BACKEND = 'adbapi'
+TASK_DB_POOL_MIN = 3
+TASK_DB_POOL_MAX = 10
+TASK_DB_STATEMENT_TIMEOUT = 0
+# Seconds the worker caches projects, flows, release streams and servers
+# for. Saving them in the web tier invalidates them sooner, 0 disables it.
+TASK_DB_CACHE_TTL = 60
+
 SLACK_TOKEN = None
 SLACK_CHANNEL = ''
 SLACK_HOST = 'foo.slack.com'
+# Notifications for a channel are collected for SLACK_BATCH_WINDOW seconds
+# and sent as one message. At most SLACK_RATE messages a second are sent on
+# average, with bursts of up to SLACK_BURST.
+SLACK_BATCH_WINDOW = 2.0
+SLACK_RATE = 1.0
+SLACK_BURST = 3
 
 try:
     from local_settings import *
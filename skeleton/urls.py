@@ -17,6 +17,7 @@ urlpatterns = patterns('',
 
     url(r'^projects/build/view/(?P<id>[\w-]+)$', 'sideloader.views.build_view', name='build_view'),
     url(r'^projects/build/log/(?P<id>[\w-]+)$', 'sideloader.views.build_output', name='build_output'),
+    url(r'^projects/build/stream/(?P<id>[\w-]+)$', 'sideloader.views.build_stream', name='build_stream'),
     url(r'^projects/build/cancel/(?P<id>[\w-]+)$', 'sideloader.views.build_cancel', name='build_cancel'),
 
     # Workflows
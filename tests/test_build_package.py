@@ -97,7 +97,8 @@ class Builder(object):
             A :class:`BuildResult` object containing the return code and output
             of the build.
         """
-        self.add_executable("fpm", '#!/bin/bash\necho "[[$@]]"')
+        if not self.bindir.join("fpm").check():
+            self.add_executable("fpm", '#!/bin/bash\necho "[[$@]]"')
         output = ""
         self.rundir.ensure(dir=True)
         proc = subprocess.Popen(
@@ -226,6 +227,25 @@ def test_build_with_bad_branch_fails(builder):
         r"\[.*\] Build failed: Can't switch to branch$")
 
 
+def test_build_with_missing_commit_fails(builder):
+    """
+    A build for a commit that isn't in the repo fails rather than building
+    something else.
+    """
+    builder.write_sideloader_config()
+    repo_dir = builder.create_repo("org", "project")
+    builder.create_branch(repo_dir, "master", files={
+        ".deploy.yaml": yaml.dump({"buildscript": "scripts/build.sh"}),
+        "scripts/build.sh": "echo 'hello from builder'",
+    })
+    build_result = builder.run_build(
+        "--id=id0", "file://%s" % repo_dir, "--commit", "f" * 40)
+    assert build_result.code == 1
+    assert not build_result.contains_line("hello from builder")
+    assert build_result.contains_regex(
+        r"\[.*\] Build failed: Commit %s not found$" % ("f" * 40))
+
+
 def test_build_with_bad_file_fails(builder):
     """
     A build with files that can't be copied into the package fails.
@@ -297,3 +317,442 @@ def test_venv_path_config(builder):
     # Extra stuff for "virtualenv" build type
     assert "/usr/bin/virtualenv /opt/plane-python" in postinstall
     assert "VENV=/opt/plane-python" in postinstall
+
+
+def test_git_mirror_reused(builder):
+    """
+    Repos are mirrored in the workspace and later builds fetch into the
+    mirror instead of cloning again.
+    """
+    builder.write_sideloader_config()
+    repo_dir = builder.create_repo("org", "project")
+    builder.create_branch(repo_dir, "master", files={
+        ".deploy.yaml": yaml.dump({"buildscript": "scripts/build.sh"}),
+        "scripts/build.sh": "echo 'hello from builder'",
+    })
+    repo_url = "file://%s" % repo_dir
+    build_result = builder.run_build("--id=id0", repo_url)
+    assert build_result.code == 0
+    assert build_result.contains_regex(r"\[.*\] Fetching github repo$")
+
+    mirror_dir = builder.workspace_base.join("mirrors", "org", "project.git")
+    assert mirror_dir.join("HEAD").check(file=True)
+
+    with repo_dir.as_cwd():
+        repo_dir.join("scripts", "build.sh").write("echo 'hello again'")
+        os.system("git commit -am 'sideloader test'")
+
+    build_result = builder.run_build("--id=id0", repo_url)
+    assert build_result.code == 0
+    assert build_result.contains_regex(r"\[.*\] Updating git mirror$")
+    assert not build_result.contains_regex(r"\[.*\] Fetching github repo$")
+    assert build_result.contains_line("hello again")
+
+    # The checkout still points at the real remote
+    with builder.workspace_dir("id0").join("project").as_cwd():
+        origin = subprocess.check_output(
+            ["git", "config", "remote.origin.url"])
+    assert origin.strip() == repo_url
+
+
+def test_broken_git_mirror_replaced(builder):
+    """
+    A mirror which can't be fetched into is cloned again.
+    """
+    builder.write_sideloader_config()
+    repo_dir = builder.create_repo("org", "project")
+    builder.create_branch(repo_dir, "master", files={
+        ".deploy.yaml": yaml.dump({"buildscript": "scripts/build.sh"}),
+        "scripts/build.sh": "echo 'hello from builder'",
+    })
+    mirror_dir = builder.workspace_base.join("mirrors", "org", "project.git")
+    mirror_dir.ensure(dir=True)
+
+    build_result = builder.run_build("--id=id0", "file://%s" % repo_dir)
+    assert build_result.code == 0
+    assert build_result.contains_regex(
+        r"\[.*\] Mirror is broken, cloning it again$")
+    assert build_result.contains_line("hello from builder")
+    assert mirror_dir.join("HEAD").check(file=True)
+
+
+def test_git_mirror_fetch_failure(builder):
+    """
+    A build fails if its mirror can't be updated, but the mirror is kept.
+    """
+    builder.write_sideloader_config()
+    repo_dir = builder.create_repo("org", "project")
+    builder.create_branch(repo_dir, "master", files={
+        ".deploy.yaml": yaml.dump({"buildscript": "scripts/build.sh"}),
+        "scripts/build.sh": "echo 'hello from builder'",
+    })
+    repo_url = "file://%s" % repo_dir
+    build_result = builder.run_build("--id=id0", repo_url)
+    assert build_result.code == 0
+
+    repo_dir.move(repo_dir.dirpath("moved"))
+    build_result = builder.run_build("--id=id0", repo_url)
+    assert build_result.code == 1
+    assert build_result.contains_regex(
+        r"\[.*\] Build failed: Can't update the git mirror$")
+    assert not build_result.contains_line("hello from builder")
+    mirror_dir = builder.workspace_base.join("mirrors", "org", "project.git")
+    assert mirror_dir.join("HEAD").check(file=True)
+
+
+def test_git_mirror_fetch_failure_commit_present(builder):
+    """
+    A commit the mirror already has is built even if the mirror can't be
+    updated.
+    """
+    builder.write_sideloader_config()
+    repo_dir = builder.create_repo("org", "project")
+    builder.create_branch(repo_dir, "master", files={
+        ".deploy.yaml": yaml.dump({"buildscript": "scripts/build.sh"}),
+        "scripts/build.sh": "echo 'hello from builder'",
+    })
+    with repo_dir.as_cwd():
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"]).strip()
+    repo_url = "file://%s" % repo_dir
+    build_result = builder.run_build("--id=id0", repo_url)
+    assert build_result.code == 0
+
+    repo_dir.move(repo_dir.dirpath("moved"))
+    build_result = builder.run_build("--id=id0", repo_url, "--commit", commit)
+    assert build_result.code == 0
+    assert build_result.contains_regex(
+        r"\[.*\] Mirror update failed, but it has commit %s$" % commit)
+    assert build_result.contains_line("hello from builder")
+
+    # The checkout has its own objects rather than borrowing the mirror's
+    checkout = builder.workspace_dir("id0").join("project")
+    assert not checkout.join(".git", "objects", "info", "alternates").check()
+
+
+def test_git_mirror_branches_and_tags(builder):
+    """
+    Mirrors only keep branches and tags, not other refs like pull requests.
+    """
+    builder.write_sideloader_config()
+    repo_dir = builder.create_repo("org", "project")
+    builder.create_branch(repo_dir, "master", files={
+        ".deploy.yaml": yaml.dump({"buildscript": "scripts/build.sh"}),
+        "scripts/build.sh": "echo 'hello from builder'",
+    })
+    with repo_dir.as_cwd():
+        os.system("git tag v1")
+        os.system("git update-ref refs/pull/1/head HEAD")
+    repo_url = "file://%s" % repo_dir
+
+    for _ in range(2):
+        build_result = builder.run_build("--id=id0", repo_url)
+        assert build_result.code == 0
+        mirror_dir = builder.workspace_base.join(
+            "mirrors", "org", "project.git")
+        refs = subprocess.check_output(
+            ["git", "--git-dir=%s" % mirror_dir, "for-each-ref",
+             "--format=%(refname)"]).split()
+        assert "refs/heads/master" in refs
+        assert "refs/tags/v1" in refs
+        assert "refs/pull/1/head" not in refs
+
+
+FAKE_VIRTUALENV = """#!/bin/bash
+mkdir -p $1/bin
+sed "s|VENV|$1|" $(dirname $0)/fake-pip > $1/bin/pip
+chmod +x $1/bin/pip
+"""
+
+# Wheels are empty files, and installs are recorded for `pip freeze`.
+# Anything named "broken" fails to build or install.
+FAKE_PIP = """#!/bin/bash
+# venv VENV
+echo "[pip] $@"
+reqs="${@: -1}"
+grep -q broken $reqs 2>/dev/null && exit 1
+case "$1" in
+  wheel) grep == $reqs | while read dep; do
+           touch "$3/${dep%%==*}-${dep##*==}-py2-none-any.whl"
+         done;;
+  install) grep == $reqs >> VENV/installed 2>/dev/null;;
+  freeze) grep == VENV/installed;;
+esac
+exit 0
+"""
+
+
+def test_venv_cache(builder):
+    """
+    Build virtualenvs are cached by their dependencies, and reused by any
+    workspace that needs the same ones.
+    """
+    builder.write_sideloader_config()
+    builder.add_executable("virtualenv", FAKE_VIRTUALENV)
+    builder.add_executable("fake-pip", FAKE_PIP)
+    repo_dir = builder.create_repo("org", "project")
+    builder.create_branch(repo_dir, "master", files={
+        ".deploy.yaml": yaml.dump({
+            "buildscript": "scripts/build.sh",
+            "pip": ["Django==1.8", "-r requirements.txt"],
+        }),
+        "requirements.txt": "Twisted\n-r reqs/base.txt\n",
+        "reqs/base.txt": "six\n",
+        "scripts/build.sh": "echo 'hello from builder'",
+    })
+    repo_url = "file://%s" % repo_dir
+
+    build_result = builder.run_build("--id=id0", repo_url)
+    assert build_result.code == 0
+    assert build_result.contains_line("[pip] install --upgrade pip wheel")
+    assert build_result.contains_regex(
+        r"\[pip\] install --upgrade --no-index .*deploy-requirements.txt$")
+    assert len(builder.workspace_base.join("venvs").listdir()) == 1
+
+    build_result = builder.run_build("--id=id1", repo_url)
+    assert build_result.code == 0
+    assert build_result.contains_regex(r"\[.*\] Using cached virtualenv \w+$")
+    assert not build_result.contains_regex(r"\[pip\] install")
+    assert build_result.contains_line("hello from builder")
+
+    # Paths in the copy point at the new workspace
+    ve = builder.workspace_dir("id1").join("ve")
+    assert "# venv %s" % ve in ve.join("bin", "pip").read().splitlines()
+    assert ve.join(".sideloader-prefix").check(exists=False)
+
+    # Changing a requirements file means a new virtualenv, even one named
+    # by another requirements file
+    with repo_dir.as_cwd():
+        repo_dir.join("reqs", "base.txt").write("six==1.10\n")
+        os.system("git commit -am 'sideloader test'")
+    build_result = builder.run_build("--id=id1", repo_url)
+    assert build_result.code == 0
+    assert build_result.contains_regex(
+        r"\[pip\] install --upgrade --no-index"
+        r" .*deploy-requirements(-frozen)?.txt$")
+
+    with repo_dir.as_cwd():
+        repo_dir.join("requirements.txt").write(
+            "Twisted==15.0\n--requirement=reqs/base.txt\n")
+        os.system("git commit -am 'sideloader test'")
+    build_result = builder.run_build("--id=id1", repo_url)
+    assert build_result.code == 0
+    assert build_result.contains_regex(
+        r"\[pip\] install --upgrade --no-index"
+        r" .*deploy-requirements(-frozen)?.txt$")
+
+
+def test_frozen_deps(builder):
+    """
+    The resolved dependencies are frozen, and a new virtualenv for the
+    branch installs them from the wheelhouse without building wheels.
+    """
+    builder.write_sideloader_config()
+    builder.add_executable("virtualenv", FAKE_VIRTUALENV)
+    builder.add_executable("fake-pip", FAKE_PIP)
+    repo_dir = builder.create_repo("org", "project")
+    builder.create_branch(repo_dir, "master", files={
+        ".deploy.yaml": yaml.dump({"pip": ["Django==1.8", "lxml==3.4"]}),
+    })
+    repo_url = "file://%s" % repo_dir
+
+    build_result = builder.run_build("--id=id0", repo_url)
+    assert build_result.code == 0
+    [frozen] = builder.workspace_base.join("frozen").listdir()
+    assert frozen.read().splitlines() == ["Django==1.8", "lxml==3.4"]
+    frozen.setmtime(frozen.mtime() - 3600)
+    frozen_mtime = frozen.mtime()
+
+    with repo_dir.as_cwd():
+        repo_dir.join(".deploy.yaml").write(
+            yaml.dump({"pip": ["Django==1.8"]}))
+        os.system("git commit -am 'sideloader test'")
+    build_result = builder.run_build("--id=id0", repo_url)
+    assert build_result.code == 0
+    pinned = builder.workspace_dir("id0").join(
+        "deploy-requirements-frozen.txt")
+    assert pinned.read().splitlines() == ["Django==1.8", "-c %s" % frozen]
+    assert build_result.contains_line("[pip] install --upgrade --no-index"
+        " --find-links %s -r %s" % (
+            builder.workspace_base.join("wheels"), pinned))
+    assert not build_result.contains_regex(r"\[pip\] wheel")
+    # Reusing the frozen set doesn't put off resolving it again
+    assert frozen.mtime() == frozen_mtime
+
+    # Once it's as old as a stale virtualenv it's resolved again
+    frozen.setmtime(frozen.mtime() - 8 * 86400)
+    with repo_dir.as_cwd():
+        repo_dir.join(".deploy.yaml").write(
+            yaml.dump({"pip": ["Django==1.8", "six==1.10"]}))
+        os.system("git commit -am 'sideloader test'")
+    build_result = builder.run_build("--id=id0", repo_url)
+    assert build_result.code == 0
+    assert build_result.contains_regex(r"\[pip\] wheel")
+    assert frozen.mtime() > frozen_mtime
+
+
+def test_venv_not_cached_on_pip_failure(builder):
+    """
+    A failed pip run fails the build, and the half-built virtualenv isn't
+    cached for later builds.
+    """
+    builder.write_sideloader_config()
+    builder.add_executable("virtualenv", FAKE_VIRTUALENV)
+    builder.add_executable("fake-pip", FAKE_PIP)
+    repo_dir = builder.create_repo("org", "project")
+    builder.create_branch(repo_dir, "master", files={
+        ".deploy.yaml": yaml.dump({"pip": ["Django==1.8", "broken==1.0"]}),
+    })
+
+    build_result = builder.run_build("--id=id0", "file://%s" % repo_dir)
+    assert build_result.code == 1
+    assert build_result.contains_regex(
+        r"\[.*\] Build failed: Building wheels exited with code 1$")
+    assert builder.workspace_base.join("venvs").check(exists=False)
+
+
+def test_wheelhouse(builder):
+    """
+    Dependencies are built into a shared wheelhouse and installed from it,
+    which is kept under its size limit by dropping the least recently used
+    wheels.
+    """
+    builder.write_sideloader_config({
+        "workspace_base": str(builder.workspace_base),
+        "install_location": "/opt",
+        "default_branch": "master",
+        "wheelhouse_max_mb": 0.001,
+    })
+    builder.add_executable("virtualenv", FAKE_VIRTUALENV)
+    builder.add_executable("fake-pip", FAKE_PIP)
+    repo_dir = builder.create_repo("org", "project")
+    builder.create_branch(repo_dir, "master", files={
+        ".deploy.yaml": yaml.dump({"pip": ["Django==1.8", "lxml==3.4"]}),
+    })
+
+    wheelhouse = builder.workspace_base.join("wheels")
+    old = wheelhouse.ensure("psycopg2-2.6-cp27-none-linux_x86_64.whl")
+    old.write("x" * 2048)
+    old.setmtime(old.mtime() - 3600)
+    lxml = wheelhouse.ensure("lxml-3.4-py2-none-any.whl")
+    lxml.setmtime(lxml.mtime() - 3600)
+    lxml_mtime = lxml.mtime()
+
+    build_result = builder.run_build("--id=id0", "file://%s" % repo_dir)
+    assert build_result.code == 0
+    reqs = builder.workspace_dir("id0").join("deploy-requirements.txt")
+    assert build_result.contains_line("[pip] wheel --wheel-dir %s"
+        " --find-links %s -r %s" % (wheelhouse, wheelhouse, reqs))
+    assert build_result.contains_line("[pip] install --upgrade --no-index"
+        " --find-links %s -r %s" % (wheelhouse, reqs))
+    assert build_result.contains_regex(
+        r"\[.*\] Evicting psycopg2-2.6-cp27-none-linux_x86_64.whl from"
+        " the wheelhouse$")
+
+    assert sorted(p.basename for p in wheelhouse.listdir("*.whl")) == [
+        "Django-1.8-py2-none-any.whl", "lxml-3.4-py2-none-any.whl"]
+    # Wheels which were used count as fresh
+    assert lxml.mtime() > lxml_mtime + 3000
+
+
+def test_pip_install_batched(builder):
+    """
+    The pip list is installed with a single pip run, from a generated
+    requirements file, and each step of the build is timed.
+    """
+    builder.write_sideloader_config()
+    builder.add_executable("virtualenv", FAKE_VIRTUALENV)
+    builder.add_executable("fake-pip", FAKE_PIP)
+    repo_dir = builder.create_repo("org", "project")
+    builder.create_branch(repo_dir, "master", files={
+        ".deploy.yaml": yaml.dump({
+            "pip": ["Django==1.8", "-r requirements.txt"],
+            "pip_constraints": "constraints.txt",
+        }),
+        "requirements.txt": "Twisted==15.0\n",
+        "constraints.txt": "zope.interface==4.1\n",
+    })
+    build_result = builder.run_build("--id=id0", "file://%s" % repo_dir)
+    assert build_result.code == 0
+
+    checkout = builder.workspace_dir("id0").join("project")
+    reqs = builder.workspace_dir("id0").join("deploy-requirements.txt")
+    assert reqs.read().splitlines() == [
+        "Django==1.8",
+        "-r %s" % checkout.join("requirements.txt"),
+        "-c %s" % checkout.join("constraints.txt"),
+    ]
+    assert [l for l in build_result.output_lines
+        if l.startswith("[pip] install")] == [
+            "[pip] install --upgrade pip wheel",
+            "[pip] install --upgrade --no-index --find-links %s -r %s" % (
+                builder.workspace_base.join("wheels"), reqs),
+        ]
+
+    for step in ["Fetching repo", "Creating virtualenv", "Upgrading pip",
+                 "Building wheels", "Installing dependencies", "Running fpm"]:
+        assert build_result.contains_regex(
+            r"\[.*\] %s took \d+\.\d\ds$" % step)
+    assert build_result.contains_regex(
+        r"\[.*\] Build timings: Fetching repo \d+\.\d\ds, .*"
+        r"Running fpm \d+\.\d\ds$")
+
+
+def test_package_reused(builder):
+    """
+    Building the same commit with the same settings reuses the package
+    from the earlier build, once it's been archived.
+    """
+    builder.write_sideloader_config()
+    builder.add_executable(
+        "fpm", '#!/bin/bash\necho "[[fpm]]"\ntouch project_${10}.deb')
+    repo_dir = builder.create_repo("org", "project")
+    builder.create_branch(repo_dir, "master", files={
+        ".deploy.yaml": yaml.dump({"buildtype": "static"}),
+    })
+    with repo_dir.as_cwd():
+        first = subprocess.check_output(["git", "rev-parse", "HEAD"]).strip()
+    repo_url = "file://%s" % repo_dir
+    packages = builder.workspace_base.join("packages")
+    package_dir = builder.workspace_dir("id0").join("package")
+
+    def archive():
+        for deb in package_dir.listdir("*.deb"):
+            deb.move(packages.ensure(dir=True).join(deb.basename))
+
+    build_result = builder.run_build("--id=id0", "--build=1", repo_url)
+    assert build_result.contains_line("[[fpm]]")
+    archive()
+
+    build_result = builder.run_build("--id=id0", "--build=2", repo_url)
+    assert build_result.code == 0
+    assert not build_result.contains_line("[[fpm]]")
+    assert build_result.contains_regex(
+        r"\[.*\] Reusing package project_0.1.deb from build 1 of %s$" % first)
+    assert package_dir.join("project_0.1.deb").check(file=True)
+
+    build_result = builder.run_build(
+        "--id=id0", "--build=3", "--no-reuse", repo_url)
+    assert build_result.contains_line("[[fpm]]")
+
+    # New commits and changed settings are built
+    with repo_dir.as_cwd():
+        repo_dir.join("README").write("Hello")
+        os.system("git add README && git commit -m 'sideloader test'")
+    build_result = builder.run_build("--id=id0", "--build=4", repo_url)
+    assert build_result.contains_line("[[fpm]]")
+    build_result = builder.run_build(
+        "--id=id0", "--build=5", "--commit", first, "--name", "other",
+        repo_url)
+    assert build_result.contains_line("[[fpm]]")
+    with repo_dir.as_cwd():
+        os.system("git branch other %s" % first)
+    build_result = builder.run_build(
+        "--id=id0", "--build=5", "--commit", first, "--branch", "other",
+        repo_url)
+    assert build_result.contains_line("[[fpm]]")
+
+    # Unless we ask for a commit we've already built
+    build_result = builder.run_build(
+        "--id=id0", "--build=6", "--commit", first, repo_url)
+    assert not build_result.contains_line("[[fpm]]")
+    assert build_result.contains_regex(r"\[.*\] Reusing package ")